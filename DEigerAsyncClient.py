@@ -0,0 +1,503 @@
+"""
+class DEigerAsyncClient provides an asyncio interface to the EIGER API
+
+It mirrors the request methods of DEigerClient, but every method is a
+coroutine and requests are sent over a bounded pool of keep-alive
+connections, so that many status and configuration reads can be in flight
+at the same time:
+
+    client = DEigerAsyncClient(host)
+    state, temp = await asyncio.gather(client.detectorStatus('state'),
+                                       client.detectorStatus('board_000/th0_temp'))
+    await client.close()
+
+Requires python3.
+"""
+
+import asyncio
+import base64
+import json
+
+Version = '1.5.0'
+
+
+class DEigerAsyncClient(object):
+    """
+    class DEigerAsyncClient provides a low level asyncio interface to the EIGER API
+    """
+
+    def __init__(self, host = '127.0.0.1', port = 80, verbose = False, urlPrefix = None, user = None,
+                 maxConnections = 8):
+        """
+        Create a client object to talk to the EIGER API.
+        Args:
+            host: hostname of the detector computer
+            port: port usually 80 (http)
+            verbose: bool value
+            urlPrefix: String prepended to the urls. Should be None. Added for future convenience.
+            user: "username:password". Should be None. Added for future convenience.
+            maxConnections: maximum number of connections (and requests in flight) to the detector
+        """
+        super(DEigerAsyncClient,self).__init__()
+        self._host = host
+        self._port = port
+        self._version = Version
+        self._verbose = verbose
+        self._urlPrefix = ""
+        self._user = None
+        self._connectionTimeout = 24*3600
+        self._serializer = None
+        self._maxConnections = int(maxConnections)
+        self._idle = []
+        self._slots = None
+
+        self.setUrlPrefix(urlPrefix)
+        self.setUser(user)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def serializer(self):
+        """
+        The serializer object shall have the methods loads(string) and dumps(obj), which load
+        the string from json into a python object or store a python object into a json string
+        """
+        return self._serializer
+
+    def setSerializer(self,serializer):
+        """
+        Set an explicit serializer object that converts native python objects to json string and vice versa.
+        """
+        self._serializer = serializer
+
+    def setVerbose(self,verbose):
+        """ Switch verbose mode on and off.
+        Args:
+            verbose: bool value
+        """
+        self._verbose = bool(verbose)
+
+    def setConnectionTimeout(self, timeout):
+        """
+        If DEigerAsyncClient has not received an reply from EIGER after
+        timeout seconds, the request is aborted. timeout should be at
+        least as long as the triggering command takes.
+        Args:
+            timeout timeout in seconds
+        """
+        self._connectionTimeout = timeout
+
+    def setUrlPrefix(self, urlPrefix):
+        """Set url prefix, which is the string that is prepended to the
+        urls. There is usually no need to call the command explicitly.
+        Args:
+           urlPrefix: String
+        """
+        if urlPrefix is None:
+            self._urlPrefix = ""
+        else:
+            self._urlPrefix = str(urlPrefix)
+            if len(self._urlPrefix) > 0 and self._urlPrefix[-1] != "/":
+                self._urlPrefix += "/"
+
+    def setUser(self, user):
+        """
+        Set username and password for basic authentication.
+        There is usually no need to call the command explicitly.
+        Args:
+           user: String of the form username:password
+        """
+        if user is None:
+            self._user = None
+        else:
+            self._user = base64.b64encode(user.encode()).decode()
+
+    async def close(self):
+        """
+        Close all idle connections of the pool.
+        """
+        idle, self._idle = self._idle, []
+        for reader, writer in idle:
+            writer.close()
+        for reader, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def version(self,module = 'detector'):
+        """
+        Get version of a api module (i.e. 'detector', 'filewriter')
+        Args:
+            module: 'detector' or 'filewriter'
+        """
+        return await self._getRequest(url = '/{0}{1}/api/version/'.format(self._urlPrefix,module))
+
+    async def sendSystemCommand(self, command):
+        """
+        Sending command "restart" restarts the SIMPLON API on the EIGER control unit
+        """
+        return await self._putRequest(self._url('system','command',command), dataType = 'native', data = None)
+
+    async def sendStreamCommand(self, command):
+        """
+        Sending command "initialize" restarts the stream interface and disables it
+        """
+        return await self._putRequest(self._url('stream','command',command), dataType = 'native', data = None)
+
+    async def detectorConfig(self,param = None, dataType = None):
+        """Get detector configuration parameter
+        Args:
+            param: query the configuration parameter param, if None get full configuration, if 'keys' get all configuration parameters.
+            dataType: None (= 'native'), 'native' ( return native python object) or 'tif' (return tif data).
+        Returns:
+            See DEigerClient.detectorConfig
+        """
+        return await self._getRequest(self._url('detector','config',param),dataType)
+
+    async def setDetectorConfig(self, param, value, dataType = None):
+        """
+        Set detector configuration parameter param.
+        Args:
+            param: Parameter
+            value: Value to set
+            dataType: None, 'native' or 'tif'
+        Returns:
+            List of changed parameters.
+        """
+        return await self._putRequest(self._url('detector','config',param), dataType, value)
+
+    async def sendDetectorCommand(self,  command, parameter = None):
+        """
+        Send command to EIGER.
+        Args:
+            command: Detector command
+            parameter: Call command with parameter. If command = "trigger" a float parameter may be passed
+        Returns:
+            The commands 'arm' and 'trigger' return a dictionary containing 'sequence id'.
+        """
+        return await self._putRequest(self._url('detector','command',command), dataType = 'native', data = parameter)
+
+    async def detectorStatus(self, param = 'keys'):
+        """Get detector status information
+        Args:
+            param: query the status parameter param, if 'keys' get all status parameters.
+        Returns:
+            See DEigerClient.detectorStatus
+        """
+        return await self._getRequest(self._url('detector','status',parameter = param))
+
+    async def fileWriterConfig(self,param = 'keys'):
+        """Get filewriter configuration parameter
+        Args:
+            param: query the configuration parameter param, if 'keys' get all configuration parameters.
+        """
+        return await self._getRequest(self._url('filewriter','config',parameter = param))
+
+    async def setFileWriterConfig(self,param,value):
+        """
+        Set file writer configuration parameter param.
+        Returns:
+            List of changed parameters.
+        """
+        return await self._putRequest(self._url('filewriter','config',parameter = param), dataType = 'native', data = value)
+
+    async def sendFileWriterCommand(self, command):
+        """
+        Send filewriter command to EIGER.
+        Args:
+            command: Command to send (up to now only "clear")
+        """
+        return await self._putRequest(self._url("filewriter","command",parameter = command), dataType = "native")
+
+    async def fileWriterStatus(self,param = 'keys'):
+        """Get filewriter status information
+        Args:
+            param: query the status parameter param, if 'keys' get all status parameters.
+        """
+        return await self._getRequest(self._url('filewriter','status',parameter = param))
+
+    async def fileWriterFiles(self, filename = None, method = 'GET'):
+        """
+        Obtain file from detector.
+        Args:
+             filename: Name of file on the detector side. If None return list of available files
+             method: 'GET' (get the content of the file) or 'DELETE' (delete file from server)
+        Returns:
+            List of available files if 'filename' is None,
+            else if method is 'GET' the content of the file.
+        """
+        if method == 'GET':
+            if filename is None:
+                return await self._getRequest(self._url('filewriter','files'))
+            else:
+                return await self._getRequest(url = '/{0}data/{1}'.format(self._urlPrefix, filename), dataType = 'hdf5')
+        elif method == 'DELETE':
+            return await self._delRequest(url = '/{0}data/{1}'.format(self._urlPrefix,filename))
+        else:
+            raise RuntimeError('Unknown method {0}'.format(method))
+
+    async def monitorConfig(self,param = 'keys'):
+        """Get monitor configuration parameter
+        Args:
+            param: query the configuration parameter param, if 'keys' get all configuration parameters.
+        """
+        return await self._getRequest(self._url('monitor','config',parameter = param))
+
+    async def setMonitorConfig(self,param,value):
+        """
+        Set monitor configuration parameter param.
+        Returns:
+            List of changed parameters.
+        """
+        return await self._putRequest(self._url('monitor','config',parameter = param), dataType = 'native', data = value)
+
+    async def monitorImages(self, param = None):
+        """
+        Obtain file from detector.
+        Args:
+             param: Either None (return list of available frames) or "monitor" (return latest frame),
+                    "next"  (next image from buffer) or tuple(sequence id, image id) (return specific image)
+        Returns:
+            List of available frames (param = None) or tiff content of image file (param = "next", "monitor", (seqId,imgId))
+        """
+        if param is None:
+            return await self._getRequest(self._url('monitor','images',parameter = None) )
+        elif param == "next":
+            return await self._getRequest(self._url('monitor',"images", parameter = "next"), dataType = "tif")
+        elif param == "monitor":
+            return await self._getRequest(self._url('monitor','images',parameter = "monitor"), dataType = "tif")
+        else:
+            try:
+                seqId = int(param[0])
+                imgId = int(param[1])
+            except (TypeError, ValueError):
+                pass
+            else:
+                return await self._getRequest(self._url('monitor',"images", parameter = "{0}/{1}".format(seqId,imgId) ), dataType = 'tif')
+        raise RuntimeError('Invalid parameter {0}'.format(param))
+
+    async def monitorStatus(self, param = "keys"):
+        """
+        Get monitor status information
+        Args:
+            param: query the status parameter param, if 'keys' get all status parameters.
+        """
+        return await self._getRequest(self._url('monitor','status',parameter = param))
+
+    async def streamConfig(self,param = 'keys'):
+        """
+        Get stream configuration parameter
+        Args:
+            param: query the configuration parameter param, if 'keys' get all configuration parameters.
+        """
+        return await self._getRequest(self._url('stream','config',parameter = param))
+
+    async def setStreamConfig(self,param,value):
+        """
+        Set stream configuration parameter param.
+        Returns:
+            List of changed parameters.
+        """
+        return await self._putRequest(self._url('stream','config',parameter = param), dataType = 'native', data = value)
+
+    async def streamStatus(self, param):
+        """Get stream status information
+        Args:
+            param: query the status parameter param, if 'keys' get all status parameters.
+        """
+        return await self._getRequest(self._url('stream','status',parameter = param))
+
+
+
+
+    #
+    #
+    #                Private Methods
+    #
+    #
+
+    def _log(self,*args):
+        if self._verbose:
+            print(' '.join([ str(elem) for elem in args ]))
+
+    def _url(self,module,task,parameter = None):
+        url = "/{0}{1}/api/{2}/{3}/".format(self._urlPrefix,module,self._version,task)
+        if not parameter is None:
+            url += '{0}'.format(parameter)
+        return url
+
+    async def _getRequest(self,url,dataType = 'native'):
+        if dataType is None:
+            dataType = 'native'
+        if dataType == 'native':
+            mimeType = 'application/json; charset=utf-8'
+        elif dataType == 'tif':
+            mimeType = 'application/tiff'
+        elif dataType == 'hdf5':
+            mimeType = 'application/hdf5'
+        else:
+            raise ValueError('Unknown data type {0}'.format(dataType))
+        return await self._request(url,'GET',mimeType)
+
+    async def _putRequest(self,url,dataType,data = None):
+        data, mimeType = self._prepareData(data,dataType)
+        return await self._request(url,'PUT',mimeType, data)
+
+    async def _delRequest(self,url):
+        await self._request(url,'DELETE',mimeType = None)
+        return None
+
+    def _isIdempotent(self, method, url):
+        # same rule as DEigerRetryPolicy: commands such as arm or trigger are never sent twice
+        if method in ('GET', 'HEAD', 'DELETE', 'OPTIONS'):
+            return True
+        return method == 'PUT' and '/config/' in url
+
+    async def _acquire(self, fresh = False):
+        # the semaphore bounds the number of requests in flight, idle
+        # connections are reused before new ones are opened unless a fresh one is requested.
+        # Returns the connection and whether it was reused.
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._maxConnections)
+        await self._slots.acquire()
+        while self._idle and not fresh:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer), True
+            writer.close()
+        try:
+            connection = await asyncio.wait_for(asyncio.open_connection(self._host, self._port),
+                                                self._connectionTimeout)
+        except BaseException:
+            self._slots.release()
+            raise
+        return connection, False
+
+    def _release(self, connection, reuse):
+        if reuse:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+        self._slots.release()
+
+    async def _request(self, url, method, mimeType, data = None):
+        if data is None:
+            body = b''
+        elif isinstance(data, str):
+            body = data.encode()
+        else:
+            body = data
+        headers = {'Host': '{0}:{1}'.format(self._host,self._port),
+                   'Content-Length': str(len(body))}
+        if method == 'GET':
+            headers['Accept'] = mimeType
+        elif method == 'PUT':
+            headers['Content-type'] = mimeType
+        if not self._user is None:
+            headers["Authorization"] = "Basic {0}".format(self._user)
+
+        self._log('sending request to {0}'.format(url))
+        head = '{0} {1} HTTP/1.1\r\n'.format(method, url)
+        head += ''.join('{0}: {1}\r\n'.format(k, v) for k, v in headers.items())
+        head += '\r\n'
+
+        fresh = False
+        while True:
+            connection, reused = await self._acquire(fresh)
+            reuse = False
+            try:
+                reader, writer = connection
+                writer.write(head.encode('latin-1') + body)
+                await writer.drain()
+                status, reason, respHeaders, data, reuse = await asyncio.wait_for(
+                    self._readResponse(reader, method), self._connectionTimeout)
+            except ConnectionError as e:
+                # an idle keep-alive connection half-closed by EIGER answers without a status
+                # line, idempotent requests are sent once more over a fresh connection
+                if not reused or fresh or not self._isIdempotent(method, url):
+                    raise
+                self._log('Reused connection failed ({0}), retrying on a new connection'.format(e))
+                fresh = True
+                continue
+            finally:
+                self._release(connection, reuse)
+            break
+
+        mimeType = respHeaders.get('content-type','text/plain')
+        self._log('Return status: ', status, reason)
+        if not status in range(200,300):
+            raise RuntimeError((reason,data))
+        if 'json' in mimeType:
+            if self._serializer is None:
+                return json.loads(data)
+            else:
+                return self._serializer.loads(data)
+        else:
+            return data
+
+    async def _readResponse(self, reader, method):
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionError('Connection closed by {0}'.format(self._host))
+        parts = statusLine.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        reuse = headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        else:
+            data = await reader.read()
+            reuse = False
+        return status, reason, headers, data, reuse
+
+    def _prepareData(self,data, dataType):
+        if data is None:
+            return '', 'text/html'
+        if dataType != 'native':
+            if hasattr(data, 'read'):
+                data = data.read()
+            if dataType is None:
+                mimeType = self._guessMimeType(data)
+                if not mimeType is None:
+                    return data, mimeType
+            elif dataType == 'tif':
+                return data, 'application/tiff'
+        mimeType = 'application/json; charset=utf-8'
+        if self._serializer is None:
+            return json.dumps({'value':data}), mimeType
+        else:
+            return self._serializer.dumps({"value":data}), mimeType
+
+    def _guessMimeType(self,data):
+        if isinstance(data, bytes):
+            if data.startswith(b'\x49\x49\x2A\x00') or data.startswith(b'\x4D\x4D\x00\x2A'):
+                self._log('Determined mimetype: tiff')
+                return 'application/tiff'
+            if data.startswith(b'\x89\x48\x44\x46\x0d\x0a\x1a\x0a'):
+                self._log('Determined mimetype: hdf5')
+                return 'application/hdf5'
+        return None
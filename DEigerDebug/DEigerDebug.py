@@ -66,16 +66,18 @@ class DEigerDebugger():
             print "[*] update status %s" %self.host
             self.cam.sendDetectorCommand("status_update")
             print "[*] write status to %s" %filename
-            status = {key: self.cam.detectorStatus(key) for key in self.cam.detectorStatus()}
-            json.dump(status,f)
+            snapshot = self.cam.snapshot([("detector","status")])
+            print "\t[-] %d parameters in %.2f s" %(snapshot["requests"], snapshot["elapsed"])
+            json.dump(snapshot["detector"]["status"],f)
         return filename
 
     def dumpConfig(self, fname="detectorConfig"):
         filename = os.path.join(self.fpath,fname) + ".json"
         with open(filename, "w") as f:
             print "[*] write config to %s" %filename
-            config = {key: self.cam.detectorConfig(key) for key in self.cam.detectorConfig()}
-            json.dump(config,f)
+            snapshot = self.cam.snapshot([("detector","config")])
+            print "\t[-] %d parameters in %.2f s" %(snapshot["requests"], snapshot["elapsed"])
+            json.dump(snapshot["detector"]["config"],f)
         return filename
 
     def _configFileWriter(self, fname="EIGERDebug"):
@@ -87,10 +89,12 @@ class DEigerDebugger():
 
     def _configDetector(self,config):
         print "[*] configure detector"
-        for key, value in config.iteritems():
-            print "\t[-] setting %s to %s" %(key, value)
-            self.cam.setDetectorConfig(key, value)
-        self.cam.setDetectorConfig("pixel_mask_applied", False)
+        config = dict(config, pixel_mask_applied=False)
+        report = self.cam.applyConfig(config)
+        for key, value, seconds in report["puts"]:
+            print "\t[-] set %s to %s (%.2f s)" %(key, value, seconds)
+        for key in report["skipped"]:
+            print "\t[-] %s unchanged" %key
 
 
 
@@ -13,14 +13,143 @@ import base64
 import os.path
 import httplib
 import json
+import random
 import re
+import struct
 import sys
 import socket
 import fnmatch
+import select
 import shutil
+import threading
+import time
 import urllib2
+import Queue
 
 Version = '1.5.0'
+SegmentMinSize = 16*1024*1024
+# detector parameters that change others when set, in the order they have to be set
+ConfigOrder = ['trigger_mode', 'roi_mode', 'element', 'photon_energy', 'wavelength',
+               'threshold_energy', 'frame_time', 'count_time']
+
+
+class DEigerRetryPolicy(object):
+    """
+    class DEigerRetryPolicy decides if and when DEigerClient retries a failed request.
+    Retries wait with exponential backoff and random jitter and stop after maxTries
+    tries or when the per-call deadline would be exceeded. A request that was not sent
+    completely (connection failed or sending failed) is always retried, a request that
+    may have reached EIGER only if its method is idempotent: GET, HEAD, DELETE and PUT
+    to a config parameter. Commands such as arm or trigger are never sent twice, also not
+    if EIGER closed a keep-alive connection without a reply, so DEigerClient reconnects
+    before sending a command over a connection that was closed while idle.
+    """
+
+    def __init__(self, maxTries = 5, baseDelay = 0.1, maxDelay = 5.0, jitter = 0.5,
+                 deadline = None, connectTimeout = 5.0, readTimeout = None):
+        """
+        Args:
+            maxTries: maximum number of tries per call
+            baseDelay: delay before the first retry in seconds, doubled for every further retry
+            maxDelay: upper limit of the delay in seconds
+            jitter: fraction of the delay that is randomized
+            deadline: maximum duration of a call including retries in seconds, None for no limit
+            connectTimeout: timeout for establishing a connection in seconds
+            readTimeout: timeout for a reply in seconds, None to use the client's connection timeout
+        """
+        super(DEigerRetryPolicy,self).__init__()
+        self.maxTries = maxTries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+
+    def isIdempotent(self, method, url):
+        if method in ('GET', 'HEAD', 'DELETE', 'OPTIONS'):
+            return True
+        return method == 'PUT' and '/config/' in url
+
+    def delay(self, tries):
+        """
+        Delay in seconds before the next try after tries failed tries.
+        """
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (tries - 1))
+        return delay * (1.0 - self.jitter * random.random())
+
+    def remaining(self, start):
+        """
+        Seconds left until the deadline of a call started at start, None if there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - (time.time() - start)
+
+
+class DEigerConfigCache(object):
+    """
+    class DEigerConfigCache holds detector configuration parameters read by DEigerClient.
+    Entries expire after ttl seconds (never if ttl is None).
+    """
+
+    def __init__(self, ttl = 60.0):
+        super(DEigerConfigCache,self).__init__()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, param):
+        """
+        Return the cached value dictionary of param or None.
+        """
+        with self._lock:
+            entry = self._entries.get(param)
+            if entry is not None:
+                if self.ttl is None or time.time() - entry[0] < self.ttl:
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[param]
+            self.misses += 1
+            return None
+
+    def put(self, param, data):
+        with self._lock:
+            self._entries[param] = (time.time(), data)
+
+    def update(self, param, value, changed):
+        """
+        Write through after param was set to value. The parameters in the list changed are
+        invalidated first, then a cached dictionary of param gets the new value unless param
+        itself is listed (EIGER may have adjusted the value). If changed is not a list the whole
+        cache is cleared.
+        """
+        if not isinstance(changed, list):
+            self.clear()
+            return
+        with self._lock:
+            for key in changed:
+                self._entries.pop(key, None)
+            if param in changed:
+                return
+            entry = self._entries.get(param)
+            if entry is not None and isinstance(entry[1], dict):
+                data = dict(entry[1])
+                data['value'] = value
+                self._entries[param] = (time.time(), data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return dictionary with the number of entries, hits and misses.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
 
 
 # noinspection PyInterpreter
@@ -47,12 +176,30 @@ class DEigerClient(object):
         self._urlPrefix = ""
         self._user = None
         self._connectionTimeout = 24*3600
-        self._connection = httplib.HTTPConnection(self._host,self._port, timeout = self._connectionTimeout)
+        self._configCache = None
+        self._retryPolicy = DEigerRetryPolicy()
+        self._metricsLock = threading.Lock()
+        self.resetRequestMetrics()
+        self._local = threading.local()
+        self._connection = self._newConnection()
         self._serializer = None
 
         self.setUrlPrefix(urlPrefix)
         self.setUser(user)
 
+    @property
+    def _connection(self):
+        # every thread talks to EIGER over its own connection
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._newConnection()
+            self._local.connection = connection
+        return connection
+
+    @_connection.setter
+    def _connection(self, connection):
+        self._local.connection = connection
+
     def serializer(self):
         """
         The serializer object shall have the methods loads(string) and dumps(obj), which load
@@ -68,6 +215,30 @@ class DEigerClient(object):
         """
         self._serializer = serializer
 
+    def configCache(self):
+        """
+        Return the DEigerConfigCache used by detectorConfig() or None if caching is disabled.
+        """
+        return self._configCache
+
+    def enableConfigCache(self, ttl = 60.0):
+        """
+        Serve detectorConfig(param) reads of native values from a cache. setDetectorConfig()
+        writes through the cache and invalidates the parameters EIGER reports as changed.
+        Args:
+            ttl: maximum age of a cached value in seconds, None for no limit
+        Returns:
+            The DEigerConfigCache
+        """
+        self._configCache = DEigerConfigCache(ttl)
+        return self._configCache
+
+    def disableConfigCache(self):
+        """
+        Disable the configuration cache.
+        """
+        self._configCache = None
+
     def setVerbose(self,verbose):
         """ Switch verbose mode on and off.
         Args:
@@ -84,7 +255,41 @@ class DEigerClient(object):
             timeout timeout in seconds
         """
         self._connectionTimeout = timeout
-        self._connection = httplib.HTTPConnection(self._host,self._port, timeout = self._connectionTimeout)
+        self._connection = self._newConnection()
+
+    def retryPolicy(self):
+        """
+        Return the DEigerRetryPolicy used for all requests.
+        """
+        return self._retryPolicy
+
+    def setRetryPolicy(self, policy):
+        """
+        Set the DEigerRetryPolicy used for all requests, e.g.
+        setRetryPolicy(DEigerRetryPolicy(maxTries = 3, deadline = 10.0))
+        """
+        self._retryPolicy = policy
+        self._connection = self._newConnection()
+
+    def requestMetrics(self):
+        """
+        Return dictionary with request statistics since the last resetRequestMetrics():
+        'requests', 'retries', 'failures', 'meanSeconds', 'maxSeconds' and 'histogram',
+        a dictionary {upper latency bound in seconds: number of requests}.
+        """
+        with self._metricsLock:
+            metrics = dict(self._metrics)
+            metrics['histogram'] = dict(self._metrics['histogram'])
+        metrics['meanSeconds'] = metrics['totalSeconds'] / metrics['requests'] if metrics['requests'] else 0.0
+        return metrics
+
+    def resetRequestMetrics(self):
+        """
+        Reset the request statistics returned by requestMetrics().
+        """
+        with self._metricsLock:
+            self._metrics = {'requests': 0, 'retries': 0, 'failures': 0, 'totalSeconds': 0.0, 'maxSeconds': 0.0,
+                             'histogram': dict((bound, 0) for bound in self._LatencyBounds)}
 
     def setUrlPrefix(self, urlPrefix):
         """Set url prefix, which is the string that is prepended to the
@@ -152,7 +357,14 @@ class DEigerClient(object):
             allowed_values, unit, value_type and access_mode. If dataType is 'tif', tiff formated data is returned as a python
             string.
         """
-        return self._getRequest(self._url('detector','config',param),dataType)
+        cache = self._configCache
+        if cache is None or param in (None, 'keys') or dataType not in (None, 'native'):
+            return self._getRequest(self._url('detector','config',param),dataType)
+        data = cache.get(param)
+        if data is None:
+            data = self._getRequest(self._url('detector','config',param),dataType)
+            cache.put(param, data)
+        return data
 
     def setDetectorConfig(self, param, value, dataType = None):
         """
@@ -167,7 +379,10 @@ class DEigerClient(object):
         Returns:
             List of changed parameters.
         """
-        return self._putRequest(self._url('detector','config',param), dataType, value)
+        changed = self._putRequest(self._url('detector','config',param), dataType, value)
+        if not self._configCache is None:
+            self._configCache.update(param, value, changed)
+        return changed
 
     def setDetectorConfigMultiple(self,*params):
         """
@@ -190,6 +405,38 @@ class DEigerClient(object):
                 p = None
         return list(set(changeList))
 
+    def applyConfig(self, config):
+        """
+        Set several detector configuration parameters, skipping those that already have the
+        requested value (compared with the cached value if the config cache is enabled).
+        Parameters listed in ConfigOrder (e.g. photon_energy before threshold_energy) are set
+        first; a parameter changed as a side effect of an earlier write is compared with its new
+        value.
+        Args:
+            config: dictionary {param: value}
+        Returns:
+            Dictionary {'puts': list of (param, value, seconds), 'skipped': list of params,
+            'changed': list of changed parameters, 'seconds': total time}
+        """
+        start = time.time()
+        rank = dict((key, i) for i, key in enumerate(ConfigOrder))
+        report = {'puts': [], 'skipped': []}
+        changed = set()
+        for param, value in sorted(config.items(), key = lambda item: rank.get(item[0], len(rank))):
+            current = self.detectorConfig(param)
+            if isinstance(current, dict) and self._configEqual(current.get('value'), value):
+                self._log('Skipping ', param, ' = ', value)
+                report['skipped'].append(param)
+                continue
+            t = time.time()
+            result = self.setDetectorConfig(param, value)
+            report['puts'].append((param, value, time.time() - t))
+            if isinstance(result, list):
+                changed.update(result)
+        report['changed'] = sorted(changed)
+        report['seconds'] = time.time() - start
+        return report
+
     def listDetectorCommands(self):
         """
         Get list of all commands that may be sent to EIGER via sendDetectorCommand().
@@ -207,6 +454,8 @@ class DEigerClient(object):
         Returns:
             The commands 'arm' and 'trigger' return a dictionary containing 'sequence id'.
         """
+        if command == 'initialize' and not self._configCache is None:
+            self._configCache.clear()
         return self._putRequest(self._url('detector','command',command), dataType = 'native', data = parameter)
 
 
@@ -283,31 +532,48 @@ class DEigerClient(object):
         else:
             raise RuntimeError('Unknown method {0}'.format(method))
 
-    def fileWriterSave(self,filename,targetDir,regex = False):
+    def fileWriterSave(self,filename,targetDir,regex = False, segments = 1, workers = 1):
         """
         Saves filename in targetDir. If regex is True, filename is considered to be a regular expression.
         Save all files that match filename
         Args:
             filename: Name of source file, may contain the wildcards '*' and '?' or regular expressions
             targetDir: Directory, where to store the files
+            segments: Download files larger than 2*SegmentMinSize with up to segments concurrent
+                      HTTP Range requests
+            workers: Number of matching files that are downloaded concurrently. Master files are
+                     always downloaded first.
+        Returns:
+            For a single file a dictionary with the keys 'filename', 'bytes', 'seconds' and 'MB/s',
+            for several files a dictionary with the totals and the single file dictionaries as 'files'.
         """
         if regex:
             pattern = re.compile(filename)
-            [ self.fileWriterSave(f,targetDir)  for f in self.fileWriterFiles() if pattern.match(f) ]
+            return self._saveMany([ f for f in self.fileWriterFiles() if pattern.match(f) ], targetDir, segments, workers)
         elif any([ c in filename for c in ['*','?','[',']'] ] ):
             # for f in self.fileWriterFiles():
             #    self._log('DEBUG ', f, '  ', fnmatch.fnmatch(f,filename))
-            [ self.fileWriterSave(f,targetDir)  for f in self.fileWriterFiles() if fnmatch.fnmatch(f,filename) ]
+            return self._saveMany([ f for f in self.fileWriterFiles() if fnmatch.fnmatch(f,filename) ], targetDir, segments, workers)
         else:
             targetPath = os.path.join(targetDir,filename)
-            url = 'http://{0}:{1}/{2}data/{3}'.format(self._host,self._port,self._urlPrefix, filename)
-            req = urllib2.urlopen(url, timeout = self._connectionTimeout)
-            with open(targetPath, 'wb') as fp:
-                self._log('Writing ', targetPath)
-                shutil.copyfileobj(req, fp, 512*1024)
+            start = time.time()
+            size = None
+            if segments > 1:
+                size = self._saveSegmented('/{0}data/{1}'.format(self._urlPrefix, filename), targetPath, segments)
+            if size is None:
+                url = 'http://{0}:{1}/{2}data/{3}'.format(self._host,self._port,self._urlPrefix, filename)
+                req = urllib2.urlopen(url, timeout = self._connectionTimeout)
+                with open(targetPath, 'wb') as fp:
+                    self._log('Writing ', targetPath)
+                    shutil.copyfileobj(req, fp, 512*1024)
+                size = os.path.getsize(targetPath)
             # self._getRequest(url = '/{0}data/{1}'.format(self._urlPrefix, filename), dataType = 'hdf5',fileId = targetFile)
             # targetFile.write(self.fileWriterFiles(filename))
             assert os.access(targetPath,os.R_OK)
+            seconds = time.time() - start
+            rate = size / seconds / 1e6 if seconds > 0 else 0.0
+            self._log('Saved {0} bytes in {1:.3f} s ({2:.1f} MB/s)'.format(size, seconds, rate))
+            return {'filename': filename, 'bytes': size, 'seconds': seconds, 'MB/s': rate}
         return
 
     def monitorConfig(self,param = 'keys'):
@@ -342,18 +608,7 @@ class DEigerClient(object):
         """
         if param is None:
             return self._getRequest(self._url('monitor','images',parameter = None) )
-        elif param == "next":
-            return self._getRequest(self._url('monitor',"images", parameter = "next"), dataType = "tif")
-        elif param == "monitor":
-            return self._getRequest(self._url('monitor','images',parameter = "monitor"), dataType = "tif")
-        else:
-            try:
-                seqId = int(param[0])
-                imgId = int(param[1])
-                return self._getRequest(self._url('monitor',"images", parameter = "{0}/{1}".format(seqId,imgId) ), dataType = 'tif')
-            except (TypeError, ValueError):
-                pass
-        raise RuntimeError('Invalid parameter {0}'.format(param))
+        return self._getRequest(self._monitorImageUrl(param), dataType = 'tif')
 
     def monitorSave(self, param, path):
         """
@@ -383,6 +638,46 @@ class DEigerClient(object):
             assert os.access(path,os.R_OK)
         return
 
+    def monitorImagesInto(self, param, buffer = None):
+        """
+        Obtain a single frame like monitorImages(param), but read the tiff data into a bytearray
+        instead of returning a new string. The frame is read with response.readinto where the
+        http library supports it.
+        Args:
+            param: "monitor" (latest frame), "next" (next image from buffer) or
+                   tuple(sequence id, image id) (specific image)
+            buffer: bytearray (or writable buffer) large enough for the tiff data. If None, the
+                    calling thread's receive buffer of the client is reused, so the returned data
+                    is only valid until the next ...Into() call from the same thread.
+        Returns:
+            memoryview of the tiff data
+        """
+        return self._getRequestInto(self._monitorImageUrl(param), 'application/tiff', buffer)
+
+    def monitorImageArray(self, param, buffer = None):
+        """
+        Obtain a single frame like monitorImagesInto(param) and decode the uncompressed tiff into
+        a numpy array without copying. The array is a view of the buffer and is only valid until
+        the buffer is reused. Requires numpy.
+        Args:
+            param: "monitor", "next" or tuple(sequence id, image id)
+            buffer: see monitorImagesInto()
+        Returns:
+            2d numpy array
+        """
+        return self._tiffArray(self.monitorImagesInto(param, buffer))
+
+    def fileWriterFilesInto(self, filename, buffer = None):
+        """
+        Obtain the content of a file like fileWriterFiles(filename), but read it into a bytearray.
+        Args:
+            filename: Name of file on the detector side
+            buffer: see monitorImagesInto()
+        Returns:
+            memoryview of the file content
+        """
+        return self._getRequestInto('/{0}data/{1}'.format(self._urlPrefix, filename), 'application/hdf5', buffer)
+
     def monitorStatus(self, param = "keys"):
         """
         Get monitor status information
@@ -437,6 +732,70 @@ class DEigerClient(object):
         """
         return self._getRequest(self._url('stream','status',parameter = param))
 
+    def snapshot(self, sections = None, workers = 8):
+        """
+        Fetch all parameters of one or more subsystem sections in one call. The keys of every
+        section are listed first, then the values are fetched by up to 'workers' concurrent
+        requests, each worker thread using its own connection.
+        Args:
+            sections: List of (module, task) tuples, e.g. [('detector','status')]. module is one of
+                      'detector', 'filewriter', 'stream' or 'monitor', task is 'config' or 'status'.
+                      If None, config and status of all four modules are fetched.
+            workers: maximum number of requests in flight
+        Returns:
+            Dictionary {'time': start time (seconds since epoch), 'elapsed': seconds taken,
+            'requests': number of requests, 'errors': list of (module, task, key, message),
+            module: {task: {key: value dictionary}}}
+        """
+        if sections is None:
+            sections = [ (module, task) for module in ('detector','filewriter','stream','monitor')
+                                        for task in ('config','status') ]
+        start = time.time()
+        result = {'time': start, 'errors': []}
+        lock = threading.Lock()
+
+        def fetchAll(jobs, fetch):
+            pending = Queue.Queue()
+            for job in jobs:
+                pending.put(job)
+            def work():
+                try:
+                    while True:
+                        try:
+                            job = pending.get_nowait()
+                        except Queue.Empty:
+                            return
+                        try:
+                            fetch(*job)
+                        except Exception as e:
+                            with lock:
+                                result['errors'].append(job + (str(e),))
+                finally:
+                    self._closeConnection()
+            threads = [ threading.Thread(target = work) for i in range(min(max(1, int(workers)), len(jobs))) ]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                t.join()
+
+        keys = {}
+        def listKeys(module, task, key):
+            keys[(module, task)] = self._getRequest(self._url(module, task, 'keys'))
+        def getValue(module, task, key):
+            value = self._getRequest(self._url(module, task, key))
+            with lock:
+                result[module][task][key] = value
+
+        for module, task in sections:
+            result.setdefault(module, {})[task] = {}
+        fetchAll([ (module, task, 'keys') for module, task in sections ], listKeys)
+        fetchAll([ (module, task, key) for (module, task), names in keys.items() for key in names ], getValue)
+        result['requests'] = len(sections) + sum(len(names) for names in keys.values())
+        result['elapsed'] = time.time() - start
+        self._log('Snapshot of {0} requests in {1:.3f} s'.format(result['requests'], result['elapsed']))
+        return result
+
 
 
 
@@ -446,6 +805,42 @@ class DEigerClient(object):
     #
     #
 
+    _LatencyBounds = (0.001, 0.01, 0.1, 1.0, 10.0, float('inf'))
+
+    def _newConnection(self):
+        timeout = self._retryPolicy.connectTimeout
+        if timeout is None:
+            timeout = self._connectionTimeout
+        return httplib.HTTPConnection(self._host,self._port, timeout = timeout)
+
+    def _isClosed(self, connection):
+        # an idle keep-alive connection is readable only if EIGER closed it
+        try:
+            readable = select.select([connection.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def _closeConnection(self):
+        # close the calling thread's connection, worker threads call it before they end
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _record(self, seconds, tries, failed):
+        with self._metricsLock:
+            metrics = self._metrics
+            metrics['requests'] += 1
+            metrics['retries'] += tries - 1
+            metrics['failures'] += int(failed)
+            metrics['totalSeconds'] += seconds
+            metrics['maxSeconds'] = max(metrics['maxSeconds'], seconds)
+            for bound in self._LatencyBounds:
+                if seconds <= bound:
+                    metrics['histogram'][bound] += 1
+                    break
+
     def _log(self,*args):
         if self._verbose:
             print ' '.join([ str(elem) for elem in args ])
@@ -475,7 +870,7 @@ class DEigerClient(object):
         self._request(url,'DELETE',mimeType = None)
         return None
 
-    def _request(self, url, method, mimeType, data = None, fileId = None):
+    def _getResponse(self, url, method, mimeType, data = None):
         if data is None:
             body = ''
         else:
@@ -489,22 +884,57 @@ class DEigerClient(object):
             headers["Authorization"] = "Basic {0}".format(self._user)
 
         self._log('sending request to {0}'.format(url))
+        policy = self._retryPolicy
+        start = time.time()
         numberOfTries = 0
         response = None
         while response is None:
+            numberOfTries += 1
+            connection = self._connection
+            if connection.sock is not None and not policy.isIdempotent(method, url) and \
+               self._isClosed(connection):
+                connection.close()
+            sent = False
             try:
-                self._connection.request(method,url, body = data, headers = headers)
-                response = self._connection.getresponse()
+                if connection.sock is None:
+                    connectTimeout = policy.connectTimeout
+                    if connectTimeout is None:
+                        connectTimeout = self._connectionTimeout
+                    remaining = policy.remaining(start)
+                    if remaining is not None:
+                        connectTimeout = max(0.001, min(connectTimeout, remaining))
+                    connection.timeout = connectTimeout
+                    connection.connect()
+                readTimeout = policy.readTimeout
+                if readTimeout is None:
+                    readTimeout = self._connectionTimeout
+                remaining = policy.remaining(start)
+                if remaining is not None:
+                    readTimeout = max(0.001, min(readTimeout, remaining))
+                connection.sock.settimeout(readTimeout)
+                connection.request(method,url, body = data, headers = headers)
+                # from here on EIGER may have received and executed the request
+                sent = True
+                response = connection.getresponse()
             except Exception as e:
-                numberOfTries += 1
-                if numberOfTries == 50:
+                connection.close()
+                self._connection = self._newConnection()
+                retry = not sent or policy.isIdempotent(method, url)
+                delay = policy.delay(numberOfTries)
+                remaining = policy.remaining(start)
+                if not retry or numberOfTries >= policy.maxTries or \
+                   (remaining is not None and remaining <= delay):
                     self._log("Terminate after {0} tries\n".format(numberOfTries))
+                    self._record(time.time() - start, numberOfTries, True)
                     raise e
-                self._log("Failed to connect to host. Retrying\n")
-                self._connection = httplib.HTTPConnection(self._host,self._port, timeout = self._connectionTimeout)
+                self._log("Request failed ({0}). Retrying in {1:.3f} s\n".format(e, delay))
+                time.sleep(delay)
                 continue
+        self._record(time.time() - start, numberOfTries, False)
+        return response
 
-
+    def _request(self, url, method, mimeType, data = None, fileId = None):
+        response = self._getResponse(url, method, mimeType, data)
         status = response.status
         reason = response.reason
         if fileId is None:
@@ -530,6 +960,199 @@ class DEigerClient(object):
         else:
             return data
 
+    def _monitorImageUrl(self, param):
+        if param in ("next", "monitor"):
+            return self._url('monitor', 'images', parameter = param)
+        try:
+            seqId = int(param[0])
+            imgId = int(param[1])
+        except (TypeError, ValueError):
+            raise RuntimeError('Invalid parameter {0}'.format(param))
+        return self._url('monitor', 'images', parameter = "{0}/{1}".format(seqId,imgId))
+
+    def _takeBuffer(self, size):
+        # every thread reuses its own receive buffer, grown to the largest response so far
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(size)
+            self._local.buffer = buffer
+        return buffer
+
+    def _getRequestInto(self, url, mimeType, buffer = None):
+        response = self._getResponse(url, 'GET', mimeType)
+        if not response.status in range(200,300):
+            raise RuntimeError((response.reason, response.read()))
+        length = response.getheader('content-length')
+        if length is None:
+            # no length known in advance, fall back to one read
+            data = response.read()
+            length = len(data)
+            if buffer is None:
+                buffer = self._takeBuffer(length)
+            view = memoryview(buffer)
+            view[:length] = data
+            return view[:length]
+        length = int(length)
+        if buffer is None:
+            buffer = self._takeBuffer(length)
+        view = memoryview(buffer)
+        if len(view) < length:
+            response.read()
+            raise ValueError('Buffer of {0} bytes too small for {1} bytes'.format(len(view), length))
+        readinto = getattr(response, 'readinto', None)
+        pos = 0
+        while pos < length:
+            if readinto is not None:
+                n = readinto(view[pos:length])
+            else:
+                chunk = response.read(min(length - pos, 1024*1024))
+                n = len(chunk)
+                view[pos:pos+n] = chunk
+            if not n:
+                raise RuntimeError('Incomplete response: {0} of {1} bytes'.format(pos, length))
+            pos += n
+        return view[:length]
+
+    def _tiffArray(self, data):
+        # decode an uncompressed single image tiff into a numpy array view of data
+        import numpy
+        header = data[:8].tobytes()
+        order = {'II': '<', 'MM': '>'}.get(header[:2])
+        if order is None:
+            raise RuntimeError('Not a tiff file')
+        offset = struct.unpack(order + 'I', header[4:8])[0]
+        count = struct.unpack(order + 'H', data[offset:offset+2].tobytes())[0]
+        tags = {}
+        for i in range(count):
+            entry = data[offset+2+12*i:offset+14+12*i].tobytes()
+            tag, fieldType, n = struct.unpack(order + 'HHI', entry[:8])
+            fmt = {3: 'H', 4: 'I'}.get(fieldType)
+            if fmt is None:
+                continue
+            size = struct.calcsize(fmt)
+            if n * size <= 4:
+                values = struct.unpack(order + fmt * n, entry[8:8+n*size])
+            else:
+                pointer = struct.unpack(order + 'I', entry[8:12])[0]
+                values = struct.unpack(order + fmt * n, data[pointer:pointer+n*size].tobytes())
+            tags[tag] = values
+        width, height = tags[256][0], tags[257][0]
+        bits = tags.get(258, (32,))[0]
+        if tags.get(259, (1,))[0] != 1:
+            raise RuntimeError('Compressed tiff files are not supported')
+        kind = {1: 'u', 2: 'i', 3: 'f'}[tags.get(339, (1,))[0]]
+        dtype = numpy.dtype(order + kind + str(bits // 8))
+        offsets, counts = tags[273], tags[279]
+        size = width*height*dtype.itemsize
+        raw = numpy.asarray(data)
+        contiguous = all(offsets[i] + counts[i] == offsets[i+1] for i in range(len(offsets) - 1))
+        if contiguous:
+            return raw[offsets[0]:offsets[0]+size].view(dtype).reshape(height, width)
+        image = numpy.empty(size, dtype = numpy.uint8)
+        pos = 0
+        for o, c in zip(offsets, counts):
+            image[pos:pos+c] = raw[o:o+c]
+            pos += c
+        return image.view(dtype).reshape(height, width)
+
+    def _configEqual(self, a, b):
+        if isinstance(a, float) or isinstance(b, float):
+            try:
+                return abs(a - b) <= 1e-6 * max(abs(a), abs(b))
+            except TypeError:
+                return False
+        return a == b
+
+    def _saveMany(self, filenames, targetDir, segments, workers):
+        start = time.time()
+        masters = [ f for f in filenames if f.endswith('_master.h5') ]
+        pending = Queue.Queue()
+        for f in filenames:
+            if not f in masters:
+                pending.put(f)
+        results = [ self.fileWriterSave(f, targetDir, segments = segments) for f in masters ]
+        errors = []
+
+        def work():
+            try:
+                while True:
+                    try:
+                        f = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        results.append(self.fileWriterSave(f, targetDir, segments = segments))
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                self._closeConnection()
+
+        threads = [ threading.Thread(target = work) for i in range(max(1, int(workers))) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        size = sum(r['bytes'] for r in results)
+        seconds = time.time() - start
+        rate = size / seconds / 1e6 if seconds > 0 else 0.0
+        self._log('Saved {0} files, {1} bytes in {2:.3f} s ({3:.1f} MB/s)'.format(len(results), size, seconds, rate))
+        return {'files': results, 'bytes': size, 'seconds': seconds, 'MB/s': rate}
+
+    def _saveSegmented(self, url, targetPath, segments):
+        # Download url into targetPath with concurrent HTTP Range requests, each thread
+        # over its own connection. Returns None if the server does not support ranges
+        # or the file is too small to be split.
+        headers = {}
+        if not self._user is None:
+            headers["Authorization"] = "Basic {0}".format(self._user)
+        self._connection.request('HEAD', url, headers = headers)
+        response = self._connection.getresponse()
+        response.read()
+        if not response.status in range(200,300):
+            raise RuntimeError((response.reason, ''))
+        size = int(response.getheader('content-length', 0))
+        segments = min(segments, size // SegmentMinSize)
+        if response.getheader('accept-ranges', '') != 'bytes' or segments < 2:
+            return None
+
+        with open(targetPath, 'wb') as fp:
+            fp.truncate(size)
+        self._log('Writing ', targetPath, ' in ', segments, ' segments')
+        step = -(-size // segments)
+        errors = []
+
+        def fetch(start):
+            end = min(start + step, size) - 1
+            rangeHeaders = dict(headers)
+            rangeHeaders['Range'] = 'bytes={0}-{1}'.format(start, end)
+            try:
+                self._connection.request('GET', url, headers = rangeHeaders)
+                response = self._connection.getresponse()
+                if response.status != 206:
+                    raise RuntimeError((response.reason, response.read()))
+                with open(targetPath, 'r+b') as fp:
+                    fp.seek(start)
+                    shutil.copyfileobj(response, fp, 512*1024)
+                    if fp.tell() != end + 1:
+                        raise RuntimeError('Incomplete segment {0}-{1} of {2}'.format(start, end, url))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self._closeConnection()
+
+        threads = [ threading.Thread(target = fetch, args = (start,)) for start in range(0, size, step) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return size
+
     def _prepareData(self,data, dataType):
         if data is None:
             return '', 'text/html'
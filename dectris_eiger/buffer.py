@@ -10,10 +10,16 @@
 import fnmatch
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from .communication import EigerSession
+
 
 DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024
 
 
 def download_chunks(response, f):
@@ -33,6 +39,140 @@ def download_chunks(response, f):
     return bytes_read
 
 
+def download_segmented(session, url, fd, size, segments,
+                       chunk_size=DOWNLOAD_CHUNK_SIZE, retries=0,
+                       retry_delay=1.0):
+    """
+    Download *size* bytes from *url* into the open file descriptor *fd* with
+    *segments* concurrent HTTP Range requests. Every segment is written in
+    place with ``os.pwrite``, so the file should be preallocated. If a
+    segment's connection drops, the segment is requested again from its last
+    written byte, up to *retries* times.
+
+    :param session: the session to send the requests with
+    :type session: dectris_eiger.communication.EigerSession
+    :param str url: the file's url
+    :param int fd: file descriptor opened for writing
+    :param int size: the file size in bytes
+    :param int segments: number of segments/connections
+    :param int chunk_size: read size per segment
+    :param int retries: number of retries per segment
+    :param float retry_delay: seconds to wait before a retry
+    :returns: number of bytes read
+    :rtype: int
+    :raises DataBufferError: if a segment could not be read completely
+    """
+    step = -(-size // segments)
+
+    def fetch(start):
+        end = min(start + step, size) - 1
+        offset = start
+        attempt = 0
+        while True:
+            try:
+                headers = {"Range": "bytes={0}-{1}".format(offset, end)}
+                response = session.get(url, headers=headers, stream=True)
+                if response.status_code != 206:
+                    response.close()
+                    raise DataBufferError(
+                        "Range request for {0} failed with status "
+                        "{1}".format(url, response.status_code))
+                for chunk in response.iter_content(chunk_size):
+                    view = memoryview(chunk)
+                    while view:
+                        written = os.pwrite(fd, view, offset)
+                        offset += written
+                        view = view[written:]
+                if offset != end + 1:
+                    raise DataBufferError(
+                        "Incomplete segment {0}-{1} of {2}".format(
+                            start, end, url))
+                return offset - start
+            except (requests.RequestException, DataBufferError):
+                attempt += 1
+                if attempt > retries:
+                    raise
+                time.sleep(retry_delay)
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        return sum(pool.map(fetch, range(0, size, step)))
+
+
+class DownloadResult(object):
+    """
+    Outcome of a single file download: the file's name and local path, the
+    number of bytes transferred, the time it took and the number of
+    connections used.
+    """
+
+    def __init__(self, filename, path, size, seconds, segments=1,
+                 transferred=None):
+        super(DownloadResult, self).__init__()
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.seconds = seconds
+        self.segments = segments
+        if transferred is None:
+            transferred = size
+        self.transferred = transferred
+
+    def get_throughput(self):
+        """
+        Returns the transfer rate in MB/s of the bytes actually transferred.
+
+        :rtype: float
+        """
+        if self.seconds <= 0:
+            return 0.0
+        return self.transferred / self.seconds / 1e6
+    throughput = property(get_throughput)
+
+    def __repr__(self):
+        return ("<DownloadResult {0}: {1} bytes in {2:.3f} s ({3:.1f} MB/s, "
+                "{4} segments)>").format(self.filename, self.transferred,
+                                         self.seconds, self.throughput,
+                                         self.segments)
+
+
+class DownloadReport(object):
+    """
+    Aggregate outcome of a multi-file download. *results* holds the
+    :py:class:`DownloadResult` of every file, *seconds* the wall time of the
+    whole transfer.
+    """
+
+    def __init__(self, results, seconds):
+        super(DownloadReport, self).__init__()
+        self.results = results
+        self.seconds = seconds
+
+    def get_size(self):
+        """
+        Returns the total number of bytes transferred.
+
+        :rtype: int
+        """
+        return sum(result.transferred for result in self.results)
+    size = property(get_size)
+
+    def get_throughput(self):
+        """
+        Returns the aggregate transfer rate in MB/s.
+
+        :rtype: float
+        """
+        if self.seconds <= 0:
+            return 0.0
+        return self.size / self.seconds / 1e6
+    throughput = property(get_throughput)
+
+    def __repr__(self):
+        return ("<DownloadReport {0} files: {1} bytes in {2:.3f} s "
+                "({3:.1f} MB/s)>").format(len(self.results), self.size,
+                                          self.seconds, self.throughput)
+
+
 class DataBufferError(Exception):
     pass
 
@@ -44,15 +184,41 @@ class UnknownDataFileError(DataBufferError):
 class EigerDataBuffer(object):
     """
     Interface to the detector's data buffer which is accessible via WebDAV.
+    If no :py:class:`dectris_eiger.communication.EigerSession` is given, the
+    buffer opens its own pooled session.
+
+    Files of at least *segment_min_size* bytes are downloaded with up to
+    *segments* concurrent HTTP Range requests, each at least
+    *segment_min_size* bytes long, and written in place into a preallocated
+    local file. The session's pool should hold at least *segments*
+    connections.
+
+    Downloads are written to a ``.part`` file that is renamed once its size
+    matches the server's Content-Length and that size did not change between
+    two requests. Dropped connections are retried up to *retries* times,
+    resuming from the last byte on disk.
     """
 
     _base_dir = "/data"
 
-    def __init__(self, host, port=80, api_version="1.0.0"):
+    def __init__(self, host, port=80, api_version="1.0.0", session=None,
+                 segments=4, segment_min_size=SEGMENT_MIN_SIZE, retries=3,
+                 retry_delay=1.0):
         super(EigerDataBuffer, self).__init__()
         self._host = host
         self._port = port
         self._api_v = api_version
+        if session is None:
+            session = EigerSession(host, port)
+        self._session = session
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def _file_url(self, filename):
+        return "{0}{1}/{2}".format(self._session.base_url, self._base_dir,
+                                   filename)
 
     def list_files(self):
         """
@@ -61,13 +227,8 @@ class EigerDataBuffer(object):
         :returns: list of files in the buffer
         :rtype: list of string
         """
-        fmt_data = {"host": self._host,
-                    "port": self._port,
-                    "api_version": self._api_v
-                    }
-        url = ("http://{host}:{port}/filewriter/api/"
-               "{api_version}/files").format(**fmt_data)
-        response = requests.get(url)
+        url = self._session.url("filewriter", self._api_v, "files")
+        response = self._session.get(url)
         filenames = json.loads(response.text)
         return filenames
 
@@ -82,40 +243,132 @@ class EigerDataBuffer(object):
         :rtype: bytes
         :raises UnknownDataFileError: if the data file can not be found
         """
-        fmt_data = {"host": self._host,
-                    "port": self._port,
-                    "filename": filename
-                    }
-        url = "http://{host}:{port}/data/{filename}".format(**fmt_data)
-        response = requests.get(url)
+        response = self._session.get(self._file_url(filename))
         if response.status_code == 200:
             return response.content
         else:
             raise UnknownDataFileError(filename)
 
-    def download_file(self, filename, target_dir):
+    def get_file_size(self, filename):
+        """
+        Returns the size of a file in the buffer as reported by the server.
+
+        :param str filename: Data file name
+        :returns: file size in bytes
+        :rtype: int
+        :raises UnknownDataFileError: if the data file can not be found
+        """
+        return self._head(filename)[0]
+
+    def _head(self, filename):
+        response = self._session.head(self._file_url(filename))
+        if response.status_code != 200:
+            raise UnknownDataFileError(filename)
+        size = int(response.headers.get("Content-Length", 0))
+        ranges = response.headers.get("Accept-Ranges", "") == "bytes"
+        return size, ranges
+
+    def _download_segments(self, url, path, size, segments):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            download_segmented(self._session, url, fd, size, segments,
+                               retries=self.retries,
+                               retry_delay=self.retry_delay)
+        except Exception:
+            # a preallocated file can not be resumed from its size
+            os.close(fd)
+            os.remove(path)
+            raise
+        os.close(fd)
+
+    def _download_stream(self, url, path, offset):
+        headers = {}
+        if offset > 0:
+            headers["Range"] = "bytes={0}-".format(offset)
+        response = self._session.get(url, headers=headers, stream=True)
+        try:
+            if response.status_code == 200:
+                offset = 0
+            elif response.status_code != 206:
+                raise DataBufferError("Request for {0} failed with status "
+                                      "{1}".format(url, response.status_code))
+            with open(path, "ab" if offset > 0 else "wb") as f:
+                download_chunks(response, f)
+        finally:
+            # release the pooled connection, also if the body was not read
+            response.close()
+
+    def download_file(self, filename, target_dir, segments=None):
         """
         Downloads a file's content into a file with the same name in the
-        given target directory.
+        given target directory. Large files are split into HTTP Range
+        requests over several connections, interrupted downloads are resumed
+        from the bytes already on disk, see :py:class:`EigerDataBuffer`. A
+        complete local copy of the same size is not downloaded again.
 
         :param str filename: Data file name
         :param str target_dir: Local directory to save the file in
+        :param int segments: maximum number of connections, defaults to the
+                             buffer's *segments* attribute
+        :returns: the download's size, duration and throughput
+        :rtype: DownloadResult
         :raises UnknownDataFileError: if the data file can not be found
         """
-        fmt_data = {"host": self._host,
-                    "port": self._port,
-                    "filename": filename
-                    }
-        url = "http://{host}:{port}/data/{filename}".format(**fmt_data)
-        response = requests.get(url)
-        if response.status_code == 200:
-            target_fn = os.sep.join([target_dir, filename])
-            with open(target_fn, "wb") as f:
-                download_chunks(response, f)
-        else:
-            raise UnknownDataFileError(filename)
+        if segments is None:
+            segments = self.segments
+        url = self._file_url(filename)
+        target_fn = os.sep.join([target_dir, filename])
+        part_fn = target_fn + ".part"
+        start = time.time()
+        size, ranges = self._head(filename)
+        if os.path.exists(target_fn) and os.path.getsize(target_fn) == size:
+            return DownloadResult(filename, target_fn, size,
+                                  time.time() - start, 0, transferred=0)
+        if not ranges:
+            segments = 1
+        segments = max(1, min(segments, size // self.segment_min_size))
+        resumed = 0
+        if os.path.exists(part_fn):
+            resumed = os.path.getsize(part_fn)
+        attempt = 0
+        while True:
+            local = 0
+            if os.path.exists(part_fn):
+                local = os.path.getsize(part_fn)
+            if local > size:
+                local = resumed = 0
+                os.remove(part_fn)
+            try:
+                if local == 0 and segments > 1:
+                    self._download_segments(url, part_fn, size, segments)
+                elif local < size or size == 0:
+                    self._download_stream(url, part_fn, local)
+            except (requests.RequestException, DataBufferError):
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                time.sleep(self.retry_delay)
+                continue
+            # the file is complete once its size is stable on the server
+            server_size = self.get_file_size(filename)
+            if server_size == size:
+                if os.path.getsize(part_fn) == size:
+                    break
+                attempt += 1
+                if attempt > self.retries:
+                    raise DataBufferError("Incomplete download of "
+                                          "{0}".format(filename))
+            size = server_size
+        os.rename(part_fn, target_fn)
+        return DownloadResult(filename, target_fn, size, time.time() - start,
+                              segments, transferred=size - resumed)
 
-    def download(self, filename_pattern, target_dir):
+    def download(self, filename_pattern, target_dir, workers=1,
+                 segments=None):
         """
         Similar to :py:meth:`.download_file`, but performs glob (*) expansion
         on the filename. All files matching the filename pattern are downloaded
@@ -124,12 +377,35 @@ class EigerDataBuffer(object):
 
           buffer.download("series_1*", "/tmp")
 
+        With *workers* > 1, up to *workers* files are transferred at the same
+        time. Master files are always downloaded first. Unless *segments* is
+        given, the buffer's *segments* connections are divided between the
+        workers, so the session's pool is not exceeded.
+
         :param str filename_pattern: Filename or glob pattern
         :param str target_dir: Local directory to save the file(s) in
+        :param int workers: number of files to download concurrently
+        :param int segments: maximum number of connections per file
+        :returns: per-file and total size, duration and throughput
+        :rtype: DownloadReport
         """
+        start = time.time()
         filenames = fnmatch.filter(self.files, filename_pattern)
-        for filename in filenames:
-            self.download_file(filename, target_dir)
+        masters = [f for f in filenames if f.endswith("_master.h5")]
+        others = [f for f in filenames if not f.endswith("_master.h5")]
+        if segments is None:
+            segments = max(1, self.segments // max(1, workers))
+        results = [self.download_file(filename, target_dir, segments)
+                   for filename in masters]
+        if workers > 1 and len(others) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results += list(pool.map(
+                    lambda f: self.download_file(f, target_dir, segments),
+                    others))
+        else:
+            results += [self.download_file(filename, target_dir, segments)
+                        for filename in others]
+        return DownloadReport(results, time.time() - start)
 
     def delete_file(self, filename):
         """
@@ -137,12 +413,7 @@ class EigerDataBuffer(object):
 
         :param str filename: Data file to delete
         """
-        fmt_data = {"host": self._host,
-                    "port": self._port,
-                    "filename": filename
-                    }
-        url = "http://{host}:{port}/data/{filename}".format(**fmt_data)
-        response = requests.delete(url)
+        response = self._session.delete(self._file_url(filename))
 
     def delete_all(self):
         """
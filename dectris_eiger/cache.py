@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: cache
+   :synopsis: This module contains a small time-limited cache for detector
+              configuration values.
+"""
+import threading
+import time
+
+
+class ConfigCache(object):
+    """
+    Cache of configuration values keyed by parameter name. Entries expire
+    after *ttl* seconds (never if *ttl* is None). Writes are stored in the
+    cache and the parameters the detector reports as changed by a write are
+    invalidated, so reads after e.g. a photon energy change fetch the new
+    threshold from the detector.
+
+    :param float ttl: maximum age of an entry in seconds or None
+    """
+
+    def __init__(self, ttl=60.0):
+        super(ConfigCache, self).__init__()
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for *key* or None if there is no valid
+        entry. Every call counts as hit or miss.
+
+        :param str key: parameter name
+        :returns: the cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if self.ttl is None or time.time() - stored < self.ttl:
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Store *value* for *key*.
+
+        :param str key: parameter name
+        :param value: the value to cache
+        """
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+
+    def update(self, key, value, changed):
+        """
+        Write-through update after *key* was set to *value* on the detector:
+        all parameters listed in *changed* are invalidated, then the value is
+        stored unless *key* itself is listed, i.e. the detector may have
+        adjusted the written value. If *changed* is None, i.e. the detector
+        did not report the changed parameters, the whole cache is cleared.
+
+        :param str key: parameter name
+        :param value: the value written
+        :param list changed: parameters changed by the write or None
+        """
+        if changed is None:
+            self.clear()
+            return
+        with self._lock:
+            for name in changed:
+                self._entries.pop(name, None)
+            if key not in changed:
+                self._entries[key] = (time.time(), value)
+
+    def invalidate(self, keys):
+        """
+        Remove the entries for *keys*.
+
+        :param list keys: parameter names
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Returns the number of entries, hits and misses.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits,
+                    "misses": self.misses}
+    stats = property(get_stats)
@@ -1,21 +1,162 @@
 # -*- coding: utf-8 -*-
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
 
+SNAPSHOT_SECTIONS = [(subsystem, section)
+                     for subsystem in ("detector", "filewriter", "stream",
+                                       "monitor")
+                     for section in ("config", "status")]
+
+
+class EigerSession(object):
+    """
+    Connection-pooled HTTP session to a detector control unit. A single
+    session is meant to be shared by all subsystem interfaces of one detector
+    (see :py:class:`dectris_eiger.eiger.EigerDetector`), so that repeated
+    property accesses reuse open keep-alive connections instead of paying a
+    TCP handshake per request.
+
+    :param str host: control unit host name or address
+    :param int port: control unit port
+    :param int pool_connections: number of host pools to cache
+    :param int pool_maxsize: maximum number of connections kept open to the
+                             control unit
+    :param bool keep_alive: keep connections open between requests
+    """
+
+    def __init__(self, host, port=80, pool_connections=1, pool_maxsize=4,
+                 keep_alive=True):
+        super(EigerSession, self).__init__()
+        self._host = host
+        self._port = port
+        self._base_url = "http://{0}:{1}".format(host, port)
+        self._url_cache = {}
+        self._session = requests.Session()
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        # mount for this host only, other hosts keep the default adapter
+        self._session.mount(self._base_url + "/", self._adapter)
+        if not keep_alive:
+            self._session.headers["Connection"] = "close"
+        # the session is shared by worker threads (snapshots, downloads)
+        self._count_lock = threading.Lock()
+        self.requests_sent = 0
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def base_url(self):
+        return self._base_url
+
+    def url(self, subsystem, api_version, section, key=None):
+        """
+        Returns the API url of a subsystem key. The formatted urls are cached,
+        so repeated accesses to the same key do not format the url again.
+
+        :param str subsystem: subsystem name, e.g. "detector"
+        :param str api_version: API version string
+        :param str section: section name, e.g. "config" or "status"
+        :param str key: key name or None for the section itself
+        :returns: the full url
+        :rtype: str
+        """
+        cache_key = (subsystem, api_version, section, key)
+        try:
+            return self._url_cache[cache_key]
+        except KeyError:
+            url = "{0}/{1}/api/{2}/{3}/".format(self._base_url, subsystem,
+                                                api_version, section)
+            if key is not None:
+                url += key
+            self._url_cache[cache_key] = url
+            return url
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request over the pooled session.
+
+        :param str method: HTTP method
+        :param str url: full url, see :py:meth:`url`
+        :returns: the response
+        :rtype: requests.Response
+        """
+        with self._count_lock:
+            self.requests_sent += 1
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def get_connections_opened(self):
+        """
+        Returns the number of TCP connections opened to the control unit so
+        far.
+
+        :returns: number of connections
+        :rtype: int
+        """
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+    connections_opened = property(get_connections_opened)
+
+    def get_stats(self):
+        """
+        Returns the session's reuse counters: the number of requests sent, the
+        number of connections opened and the number of requests that were
+        served by an already open connection.
+
+        :returns: counter dict
+        :rtype: dict
+        """
+        opened = self.connections_opened
+        return {"requests": self.requests_sent,
+                "connections": opened,
+                "reused": max(self.requests_sent - opened, 0)}
+    stats = property(get_stats)
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        self._session.close()
+
+
 def get_value(host, port, api_version, subsystem, section, key, timeout=2,
-              return_full=False):
+              return_full=False, session=None):
     """
     Get a value from the detector. If return_full is True, the complete return
-    value (a dict) is returned.
+    value (a dict) is returned. If a :py:class:`EigerSession` is given, the
+    request is sent over its pooled connections.
     """
-    conf = dict(host=host, port=port, sys=subsystem, version=api_version,
-                section=section, key=key)
-    url_fmt = "http://{host}:{port}/{sys}/api/{version}/{section}/{key}"
-    url = url_fmt.format(**conf)
-    print(url)
-
-    response = requests.get(url, timeout=timeout)
+    if session is None:
+        conf = dict(host=host, port=port, sys=subsystem, version=api_version,
+                    section=section, key=key)
+        url_fmt = "http://{host}:{port}/{sys}/api/{version}/{section}/{key}"
+        url = url_fmt.format(**conf)
+        response = requests.get(url, timeout=timeout)
+    else:
+        url = session.url(subsystem, api_version, section, key)
+        response = session.get(url, timeout=timeout)
     data = json.loads(response.text)
     if return_full:
         return data
@@ -24,19 +165,85 @@ def get_value(host, port, api_version, subsystem, section, key, timeout=2,
 
 
 def set_value(host, port, api_version, subsystem, section, key, value,
-              timeout=2.0, no_data=False):
+              timeout=2.0, no_data=False, session=None):
     """
-    Set a value.
+    Set a value. If a :py:class:`EigerSession` is given, the request is sent
+    over its pooled connections.
     """
-    conf = dict(host=host, port=port, sys=subsystem, version=api_version,
-                section=section, key=key)
-    url_fmt = "http://{host}:{port}/{sys}/api/{version}/{section}/{key}"
-    url = url_fmt.format(**conf)
     payload = json.dumps({"value": value})
     headers = {"Content-type": "application/json"}
-    response = requests.put(url, timeout=timeout, data=payload,
-                            headers=headers)
+    if session is None:
+        conf = dict(host=host, port=port, sys=subsystem, version=api_version,
+                    section=section, key=key)
+        url_fmt = "http://{host}:{port}/{sys}/api/{version}/{section}/{key}"
+        url = url_fmt.format(**conf)
+        response = requests.put(url, timeout=timeout, data=payload,
+                                headers=headers)
+    else:
+        url = session.url(subsystem, api_version, section, key)
+        response = session.put(url, timeout=timeout, data=payload,
+                               headers=headers)
     if no_data:
         return None
     data = json.loads(response.text)
     return data
+
+
+def get_snapshot(session, api_version, sections=None, workers=4, timeout=20.0,
+                 return_full=False):
+    """
+    Fetch all keys of one or more subsystem sections with up to *workers*
+    concurrent requests over the pooled *session*. The keys of every section
+    are listed first, then all values are fetched.
+
+    The result is a dict ``{"time": ..., "elapsed": ..., "requests": ...,
+    "errors": [...], subsystem: {section: {key: value}}}``, where *time* is
+    the start time in seconds since the epoch and *elapsed* the time the
+    snapshot took. Keys that could not be read are reported in *errors* as
+    ``(subsystem, section, key, message)`` tuples.
+    """
+    if sections is None:
+        sections = SNAPSHOT_SECTIONS
+    start = time.time()
+    result = {"time": start, "errors": []}
+    lock = threading.Lock()
+
+    def fetch(subsystem, section, key, full):
+        url = session.url(subsystem, api_version, section, key)
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        data = json.loads(response.text)
+        if full:
+            return data
+        return data["value"]
+
+    def fetch_all(jobs, full):
+        values = {}
+
+        def run(job):
+            # a malformed reply is reported like a failed request
+            try:
+                values[job] = fetch(*job, full=full)
+            except Exception as e:
+                with lock:
+                    result["errors"].append(job + (str(e),))
+
+        if jobs:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                list(pool.map(run, jobs))
+        return values
+
+    for subsystem, section in sections:
+        result.setdefault(subsystem, {})[section] = {}
+    # the key listings are plain lists
+    listings = fetch_all([(subsystem, section, "keys")
+                          for subsystem, section in sections], True)
+    jobs = [(subsystem, section, key)
+            for (subsystem, section, _), keys in listings.items()
+            for key in keys]
+    for (subsystem, section, key), data in fetch_all(jobs,
+                                                     return_full).items():
+        result[subsystem][section][key] = data
+    result["requests"] = len(sections) + len(jobs)
+    result["elapsed"] = time.time() - start
+    return result
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: compression
+   :synopsis: This module contains functions to decode the data blobs of the
+              Dectris Eiger's stream interface and data files.
+
+The optional packages ``numpy``, ``lz4`` (for "lz4<" encoded data) and
+``bitshuffle`` (for "bs32-lz4<" etc. encoded data) are imported on first
+use.
+"""
+import struct
+
+
+# bitshuffle/LZ4 blobs start with the uncompressed size (uint64) and the
+# block size in bytes (uint32), both big endian
+BSLZ4_HEADER_SIZE = 12
+
+
+class DecompressionError(Exception):
+    pass
+
+
+def parse_encoding(encoding):
+    """
+    Split a stream encoding string like "bs32-lz4<" into its compression
+    ("bslz4", "lz4" or None) and byte order ("<" or ">").
+
+    :param str encoding: the encoding string of an image data header
+    :returns: compression, byte order
+    :rtype: tuple
+    """
+    order = encoding[-1] if encoding and encoding[-1] in "<>" else "<"
+    body = encoding.rstrip("<>")
+    if body == "":
+        return None, order
+    if body == "lz4":
+        return "lz4", order
+    if body.startswith("bs") and body.endswith("-lz4"):
+        return "bslz4", order
+    raise DecompressionError("Unknown encoding {0!r}".format(encoding))
+
+
+def decompress(blob, encoding, shape, dtype):
+    """
+    Decode a data blob of the stream interface into a numpy array.
+
+    :param blob: the compressed data
+    :type blob: bytes, memoryview or numpy array
+    :param str encoding: encoding string, e.g. "bs32-lz4<", "lz4<" or "<"
+    :param tuple shape: array shape (rows, columns)
+    :param str dtype: data type name, e.g. "uint32"
+    :returns: the decoded array
+    :rtype: numpy.ndarray
+    :raises DecompressionError: if the encoding is not supported
+    """
+    import numpy
+    compression, order = parse_encoding(encoding)
+    dtype = numpy.dtype(dtype).newbyteorder(order)
+    count = 1
+    for n in shape:
+        count *= n
+    if compression is None:
+        return numpy.frombuffer(blob, dtype=dtype, count=count).reshape(shape)
+    if compression == "lz4":
+        import lz4.block
+        raw = lz4.block.decompress(bytes(blob),
+                                   uncompressed_size=count * dtype.itemsize)
+        return numpy.frombuffer(raw, dtype=dtype).reshape(shape)
+    import bitshuffle
+    data = numpy.frombuffer(blob, dtype=numpy.uint8)
+    block_size = struct.unpack(">I", data[8:BSLZ4_HEADER_SIZE].tobytes())[0]
+    return bitshuffle.decompress_lz4(data[BSLZ4_HEADER_SIZE:], shape, dtype,
+                                     block_size // dtype.itemsize)
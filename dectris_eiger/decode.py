@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: decode
+   :synopsis: This module contains a process pool that decompresses stream
+              frames in parallel.
+
+Decompressing a bitshuffle/LZ4 frame of a large detector takes tens of
+milliseconds on one core, so at high frame rates a single consumer falls
+behind. :py:class:`DecodePool` sends the compressed blobs to worker
+processes, which write the decoded images into shared memory slots. Only the
+slot index goes back to the consumer, the image itself is never pickled.
+"""
+import collections
+import multiprocessing
+import os
+import time
+
+from .compression import decompress, parse_encoding
+
+
+_slots = None
+
+
+def _init_worker(slots):
+    global _slots
+    _slots = slots
+
+
+def _decode(slot, blob, encoding, shape, dtype):
+    import numpy
+    start = time.time()
+    image = decompress(blob, encoding, shape, dtype)
+    target = numpy.frombuffer(_slots[slot], dtype=image.dtype,
+                              count=image.size)
+    target[:] = image.ravel()
+    return os.getpid(), time.time() - start, image.nbytes
+
+
+class DecodeStats(object):
+    """
+    Decode counters of one worker process.
+    """
+
+    def __init__(self):
+        super(DecodeStats, self).__init__()
+        self.frames = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def get_rate(self):
+        """
+        Returns the worker's decode rate in frames per second of decode time.
+
+        :rtype: float
+        """
+        return self.frames / self.seconds if self.seconds > 0 else 0.0
+    rate = property(get_rate)
+
+    def __repr__(self):
+        return "<DecodeStats {0} frames, {1:.1f} Hz>".format(self.frames,
+                                                            self.rate)
+
+
+class DecodePool(object):
+    """
+    Pool of worker processes decoding :py:class:`StreamFrame` objects.
+    :py:meth:`decode` yields the frames in the order they were received with
+    *data* set to a numpy array backed by one of *slots* shared memory
+    slots. The slots are sized by the first frame (and grown if a larger
+    frame arrives) and reused round robin, so a frame's *data* is only valid
+    until the next frame is requested, unless *copy* is True.
+
+    Example::
+
+      receiver = EigerStreamReceiver("192.168.10.42")
+      with DecodePool(workers=4) as pool:
+          for frame in pool.decode(receiver.frames()):
+              print(frame.frame, frame.data.max())
+
+    :param int workers: number of worker processes, the number of CPUs if
+                        None
+    :param int slots: number of shared memory slots, i.e. frames in flight
+                      plus the one held by the consumer, 2 * workers + 1 if
+                      None
+    :param bool copy: copy decoded images out of the shared memory
+    :param metrics: records decode latencies and the number of frames in
+                    flight ("decode" queue depth)
+    :type metrics: dectris_eiger.metrics.StreamMetrics
+    """
+
+    def __init__(self, workers=None, slots=None, copy=False, metrics=None):
+        super(DecodePool, self).__init__()
+        self.workers = workers or multiprocessing.cpu_count()
+        self.slots = slots or 2 * self.workers + 1
+        if self.slots < 2:
+            raise ValueError("The decode pool needs at least 2 slots.")
+        self.copy = copy
+        self.metrics = metrics
+        self._pool = None
+        self._buffers = None
+        self._slot_size = 0
+        self._stats = collections.defaultdict(DecodeStats)
+
+    def _start(self, nbytes):
+        self.close()
+        self._buffers = [multiprocessing.RawArray("b", nbytes)
+                         for _ in range(self.slots)]
+        self._slot_size = nbytes
+        self._pool = multiprocessing.Pool(self.workers, _init_worker,
+                                          (self._buffers,))
+
+    def _finish(self, frame, slot, result):
+        import numpy
+        pid, seconds, nbytes = result.get()
+        stats = self._stats[pid]
+        stats.frames += 1
+        stats.bytes += nbytes
+        stats.seconds += seconds
+        if self.metrics is not None:
+            self.metrics.observe("decode_seconds", seconds)
+        dtype = numpy.dtype(frame.dtype)
+        dtype = dtype.newbyteorder(parse_encoding(frame.encoding)[1])
+        count = nbytes // dtype.itemsize
+        data = numpy.frombuffer(self._buffers[slot], dtype=dtype, count=count)
+        data = data.reshape(frame.shape)
+        frame.data = data.copy() if self.copy else data
+        return frame
+
+    def decode(self, frames):
+        """
+        Decode *frames* in the worker processes and yield them in order.
+
+        :param frames: iterable of :py:class:`StreamFrame`
+        """
+        import numpy
+        pending = collections.deque()
+        free = collections.deque()
+        for frame in frames:
+            nbytes = numpy.dtype(frame.dtype).itemsize
+            for n in frame.shape:
+                nbytes *= n
+            if nbytes > self._slot_size:
+                # drain the frames in flight before resizing the slots
+                while pending:
+                    yield self._finish(*pending.popleft())
+                self._start(nbytes)
+                free = collections.deque(range(self.slots))
+            if not free:
+                item = pending.popleft()
+                yield self._finish(*item)
+                # the consumer asked for the next frame, so the slot is free
+                free.append(item[1])
+            slot = free.popleft()
+            result = self._pool.apply_async(
+                _decode, (slot, bytes(frame.raw), frame.encoding, frame.shape,
+                          frame.dtype))
+            pending.append((frame, slot, result))
+            if self.metrics is not None:
+                self.metrics.set_depth("decode", len(pending))
+            while pending and pending[0][2].ready():
+                item = pending.popleft()
+                yield self._finish(*item)
+                free.append(item[1])
+        while pending:
+            yield self._finish(*pending.popleft())
+
+    def get_stats(self):
+        """
+        Returns the decode counters per worker process id.
+
+        :returns: dict of :py:class:`DecodeStats`
+        :rtype: dict
+        """
+        return dict(self._stats)
+    stats = property(get_stats)
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
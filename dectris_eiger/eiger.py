@@ -8,12 +8,44 @@
 
 .. moduleauthor:: Sven Festersen <festersen@physik.uni-kiel.de>
 """
+import time
+
 from .buffer import EigerDataBuffer
-from .communication import get_value, set_value
+from .cache import ConfigCache
+from .communication import EigerSession, get_snapshot, get_value, set_value
 from .filewriter import EigerFileWriter
+from .monitor import EigerMonitor
 from .stream import EigerStreamInterface
 
 
+# parameters that change others when set, in the order they have to be set
+CONFIG_ORDER = ["trigger_mode", "roi_mode", "element", "photon_energy",
+                "wavelength", "threshold_energy", "frame_time", "count_time"]
+
+
+def config_equal(a, b):
+    """
+    Compare two configuration values, floats with a relative tolerance.
+    """
+    if isinstance(a, float) or isinstance(b, float):
+        try:
+            return abs(a - b) <= 1e-6 * max(abs(a), abs(b))
+        except TypeError:
+            return False
+    return a == b
+
+
+def order_config(config):
+    """
+    Returns the (key, value) pairs of *config* with dependent parameters in
+    :py:data:`CONFIG_ORDER` first, e.g. photon energy before threshold and
+    frame time before count time.
+    """
+    rank = dict((key, i) for i, key in enumerate(CONFIG_ORDER))
+    return sorted(config.items(),
+                  key=lambda item: rank.get(item[0], len(rank)))
+
+
 class EigerDetector(object):
     """
     Interface to the Dectris Eiger detector's data acquisition and control
@@ -22,16 +54,158 @@ class EigerDetector(object):
     ``EigerDectector`` instances have a *filewriter* attribute which points
     to an instance of :py:class:`dectris_eiger.filewrite.EigerFileWriter``.
     This can be used to configure the temporary data storage.
+
+    The detector creates one
+    :py:class:`dectris_eiger.communication.EigerSession` and shares it with
+    its *filewriter*, *stream*, *buffer* and *monitor* children, so that all
+    subsystems reuse the same pool of keep-alive connections. The pool size
+    can be set with *pool_maxsize*; an existing session may be passed as
+    *session*.
+
+    If *cache_ttl* is given, detector configuration reads are served from a
+    :py:class:`dectris_eiger.cache.ConfigCache` whose entries expire after
+    *cache_ttl* seconds. Writes go through to the detector and invalidate
+    the parameters the detector reports as changed. Reads with
+    ``return_full=True`` always query the detector.
     """
 
-    def __init__(self, host, port=80, api_version="1.0.0"):
+    def __init__(self, host, port=80, api_version="1.0.0", session=None,
+                 pool_maxsize=4, cache_ttl=None):
         super(EigerDetector, self).__init__()
-        self.filewriter = EigerFileWriter(host, port, api_version)
-        self.stream = EigerStreamInterface(host, port, api_version)
-        self.buffer = EigerDataBuffer(host, port, api_version)
+        if session is None:
+            session = EigerSession(host, port, pool_maxsize=pool_maxsize)
+        self._session = session
+        self.filewriter = EigerFileWriter(host, port, api_version,
+                                          session=session)
+        self.stream = EigerStreamInterface(host, port, api_version,
+                                           session=session)
+        self.buffer = EigerDataBuffer(host, port, api_version,
+                                      session=session)
+        self.monitor = EigerMonitor(host, port, api_version,
+                                    session=session)
         self._host = host
         self._port = port
         self._api_v = api_version
+        self.config_cache = None
+        if cache_ttl is not None:
+            self.enable_cache(cache_ttl)
+
+    # pooled HTTP session
+    def get_session(self):
+        """
+        Returns the HTTP session shared by all subsystems of this detector.
+        Its ``stats`` property holds the connection reuse counters.
+
+        :returns: the shared session
+        :rtype: dectris_eiger.communication.EigerSession
+        """
+        return self._session
+    session = property(get_session)
+
+    # configuration cache
+    def enable_cache(self, ttl=60.0):
+        """
+        Serve configuration reads from a cache with entries that expire after
+        *ttl* seconds (never if *ttl* is None). The cache's ``stats`` property
+        holds the hit and miss counters.
+
+        :param float ttl: maximum age of a cached value in seconds
+        :returns: the cache
+        :rtype: dectris_eiger.cache.ConfigCache
+        """
+        self.config_cache = ConfigCache(ttl)
+        return self.config_cache
+
+    def disable_cache(self):
+        """
+        Disable the configuration cache, all reads query the detector.
+        """
+        self.config_cache = None
+
+    def _get_config(self, key, timeout=20.0, return_full=False):
+        cache = self.config_cache
+        if cache is not None and not return_full:
+            value = cache.get(key)
+            if value is not None:
+                return value
+        data = get_value(self._host, self._port, self._api_v, "detector",
+                         "config", key, timeout=timeout, return_full=True,
+                         session=self._session)
+        if cache is not None:
+            cache.put(key, data["value"])
+        if return_full:
+            return data
+        return data["value"]
+
+    def _set_config(self, key, value, timeout=20.0):
+        data = set_value(self._host, self._port, self._api_v, "detector",
+                         "config", key, value, timeout=timeout,
+                         session=self._session)
+        if self.config_cache is not None:
+            changed = data if isinstance(data, list) else None
+            self.config_cache.update(key, value, changed)
+        return data
+
+    # batched configuration
+    def apply_config(self, config, timeout=20.0):
+        """
+        Apply several detector configuration parameters at once. Every value
+        is compared with the current (or cached) value first and only
+        parameters that differ are set, in an order where parameters such as
+        the photon energy come before the ones they affect, so a threshold
+        that was already adjusted by an energy change is not set again.
+
+        The result is a dict with the set parameters and the seconds each
+        write took (*puts*, a list of ``(key, value, seconds)`` tuples), the
+        skipped parameters (*skipped*), all parameters the detector reported
+        as changed (*changed*) and the total time (*seconds*).
+
+        :param dict config: parameter names and values
+        :param float timeout: communication timeout in seconds
+        :returns: the apply report
+        :rtype: dict
+        """
+        start = time.time()
+        report = {"puts": [], "skipped": [], "changed": []}
+        changed = set()
+        for key, value in order_config(config):
+            # parameters changed by an earlier write are no longer cached,
+            # so they are compared with the detector's new value
+            current = self._get_config(key, timeout=timeout)
+            if config_equal(current, value):
+                report["skipped"].append(key)
+                continue
+            t = time.time()
+            data = self._set_config(key, value, timeout=timeout)
+            report["puts"].append((key, value, time.time() - t))
+            if isinstance(data, list):
+                changed.update(data)
+        report["changed"] = sorted(changed)
+        report["seconds"] = time.time() - start
+        return report
+
+    # bulk snapshot
+    def snapshot(self, sections=None, workers=4, timeout=20.0,
+                 return_full=False):
+        """
+        Returns the configuration and status of several subsystems in one
+        timestamped dict. *sections* is a list of ``(subsystem, section)``
+        tuples, e.g. ``[("detector", "status")]``, where subsystem is one of
+        "detector", "filewriter", "stream" and "monitor" and section is
+        "config" or "status". By default all of them are fetched. The values
+        are read with up to *workers* concurrent requests; the snapshot's
+        ``elapsed`` entry holds the time it took in seconds.
+
+        :param list sections: list of (subsystem, section) tuples or None
+        :param int workers: maximum number of concurrent requests
+        :param float timeout: communication timeout in seconds
+        :param bool return_full: whether to store the full response dicts
+        :returns: the snapshot
+        :rtype: dict
+        """
+        return get_snapshot(self._session, self._api_v, sections=sections,
+                            workers=workers, timeout=timeout,
+                            return_full=return_full)
 
     # detector state
     def get_state(self, timeout=20.0, return_full=False):
@@ -46,7 +220,7 @@ class EigerDetector(object):
         """
         return get_value(self._host, self._port, self._api_v, "detector",
                          "status", "state", timeout=timeout,
-                         return_full=return_full)
+                         return_full=return_full, session=self._session)
     state = property(get_state)
 
     # board temperature
@@ -64,7 +238,8 @@ class EigerDetector(object):
         """
         return get_value(self._host, self._port, self._api_v, "detector",
                          "status", "{0}/th0_temp".format(board),
-                         timeout=timeout, return_full=return_full)
+                         timeout=timeout, return_full=return_full,
+                         session=self._session)
     temperature = property(get_temperature)
 
     # board humidity
@@ -81,7 +256,8 @@ class EigerDetector(object):
         """
         return get_value(self._host, self._port, self._api_v, "detector",
                          "status", "{0}/th0_humidity".format(board),
-                         timeout=timeout, return_full=return_full)
+                         timeout=timeout, return_full=return_full,
+                         session=self._session)
     humidity = property(get_humidity)
 
     # count time
@@ -94,9 +270,8 @@ class EigerDetector(object):
         :returns: count time in seconds
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "count_time", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("count_time", timeout=timeout,
+                                return_full=return_full)
 
     def set_count_time(self, t, timeout=20.0):
         """
@@ -105,8 +280,7 @@ class EigerDetector(object):
         :param float t: count time in seconds
         :param float timeout: communication timeout in seconds
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "count_time", t, timeout=timeout)
+        self._set_config("count_time", t, timeout=timeout)
     count_time = property(get_count_time, set_count_time)
 
     # frame time
@@ -120,9 +294,8 @@ class EigerDetector(object):
         :returns: frame time in seconds
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "frame_time", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("frame_time", timeout=timeout,
+                                return_full=return_full)
 
     def set_frame_time(self, t, timeout=20.0):
         """
@@ -131,8 +304,7 @@ class EigerDetector(object):
         :param float t: frame time in seconds
         :param float timeout: communication timeout in seconds
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "frame_time", t, timeout=timeout)
+        self._set_config("frame_time", t, timeout=timeout)
     frame_time = property(get_frame_time, set_frame_time)
 
     # number of images
@@ -145,9 +317,8 @@ class EigerDetector(object):
         :returns: number of images
         :rtype: int
         """
-        return int(get_value(self._host, self._port, self._api_v, "detector",
-                             "config", "nimages", timeout=timeout,
-                             return_full=return_full))
+        return int(self._get_config("nimages", timeout=timeout,
+                                    return_full=return_full))
 
     def set_nimages(self, n, timeout=20.0):
         """
@@ -156,8 +327,7 @@ class EigerDetector(object):
         :param int n: number of images
         :param float timeout: communication timeout in seconds
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "nimages", n, timeout=timeout)
+        self._set_config("nimages", n, timeout=timeout)
     nimages = property(get_nimages, set_nimages)
 
     # photon energy
@@ -170,9 +340,8 @@ class EigerDetector(object):
         :returns: photon energy in electron volts
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "photon_energy", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("photon_energy", timeout=timeout,
+                                return_full=return_full)
 
     def set_energy(self, energy, timeout=20.0):
         """
@@ -182,8 +351,7 @@ class EigerDetector(object):
         :param float timeout: communication timeout in seconds
         :param float energy: the new photon energy in electron volts
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "photon_energy", energy, timeout=timeout)
+        self._set_config("photon_energy", energy, timeout=timeout)
     energy = property(get_energy, set_energy)
 
     # photon wavelength
@@ -196,9 +364,8 @@ class EigerDetector(object):
         :returns: photon wavelength in Angstrom
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "wavelength", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("wavelength", timeout=timeout,
+                                return_full=return_full)
 
     def set_wavelength(self, wavelength, timeout=20.0):
         """
@@ -208,8 +375,7 @@ class EigerDetector(object):
         :param float timeout: communication timeout in seconds
         :param float wavelength: photon wavelength in Angstrom
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "wavelength", wavelength, timeout=timeout)
+        self._set_config("wavelength", wavelength, timeout=timeout)
     wavelength = property(get_wavelength, set_wavelength)
 
     # energy threshold
@@ -222,9 +388,8 @@ class EigerDetector(object):
         :returns: energy threshold in electron volts
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "threshold_energy", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("threshold_energy", timeout=timeout,
+                                return_full=return_full)
 
     def set_threshold(self, energy, timeout=20.0):
         """
@@ -233,8 +398,7 @@ class EigerDetector(object):
         :param float timeout: communication timeout in seconds
         :param float energy: threshold energy
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "threshold_energy", energy, timeout=timeout)
+        self._set_config("threshold_energy", energy, timeout=timeout)
     threshold = property(get_threshold, set_threshold)
 
     # flatfield
@@ -247,9 +411,8 @@ class EigerDetector(object):
         :returns: True if the flatfield correction is enabled, False otherwise
         :rtype: boolean
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "flatfield_correction_applied",
-                         timeout=timeout, return_full=return_full)
+        return self._get_config("flatfield_correction_applied",
+                                timeout=timeout, return_full=return_full)
 
     def set_flatfield_enabled(self, enabled, timeout=20.0):
         """
@@ -258,9 +421,8 @@ class EigerDetector(object):
         :param boolean enabled: set the flatfield correction status
         :param float timeout: communication timeout in seconds
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "flatfield_correction_applied", enabled,
-                  timeout=timeout)
+        self._set_config("flatfield_correction_applied", enabled,
+                         timeout=timeout)
     flatfield_enabled = property(get_flatfield_enabled, set_flatfield_enabled)
 
     # auto summation
@@ -274,9 +436,8 @@ class EigerDetector(object):
         :returns: True if auto summation is enabled, False otherwise
         :rtype: boolean
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "auto_summation", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("auto_summation", timeout=timeout,
+                                return_full=return_full)
 
     def set_auto_summation_enabled(self, enabled, timeout=20.0):
         """
@@ -285,8 +446,7 @@ class EigerDetector(object):
         :param boolean enabled: set the auto summation status
         :param float timeout: communication timeout in seconds
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "auto_summation", enabled, timeout=timeout)
+        self._set_config("auto_summation", enabled, timeout=timeout)
     auto_summation_enabled = property(get_auto_summation_enabled,
                                       set_auto_summation_enabled)
 
@@ -310,9 +470,8 @@ class EigerDetector(object):
         :returns: the current trigger mode
         :rtype: string
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "trigger_mode", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("trigger_mode", timeout=timeout,
+                                return_full=return_full)
 
     def set_trigger_mode(self, mode, timeout=20.0):
         """
@@ -324,8 +483,7 @@ class EigerDetector(object):
         """
         if mode not in ["expo", "extt", "extm", "exte", "exts", "ints"]:
             raise ValueError("Invalid trigger mode.")
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "trigger_mode", mode, timeout=timeout)
+        self._set_config("trigger_mode", mode, timeout=timeout)
     trigger_mode = property(get_trigger_mode, set_trigger_mode)
 
     # rate correction
@@ -338,9 +496,8 @@ class EigerDetector(object):
         :returns: True if rate correction is enabled, False otherwise
         :rtype: boolean
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "countrate_correction_applied",
-                         timeout=timeout, return_full=return_full)
+        return self._get_config("countrate_correction_applied",
+                                timeout=timeout, return_full=return_full)
 
     def set_rate_correction_enabled(self, enabled, timeout=20.0):
         """
@@ -349,9 +506,8 @@ class EigerDetector(object):
         :param boolean enabled: set the rate correction status
         :param float timeout: communication timeout in seconds
         """
-        set_value(self._host, self._port, self._api_v, "detector",
-                  "config", "countrate_correction_applied", enabled,
-                  timeout=timeout)
+        self._set_config("countrate_correction_applied", enabled,
+                         timeout=timeout)
     rate_correction_enabled = property(get_rate_correction_enabled,
                                        set_rate_correction_enabled)
 
@@ -365,9 +521,8 @@ class EigerDetector(object):
         :returns: bit depth
         :rtype: int
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "bit_depth_readout", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("bit_depth_readout", timeout=timeout,
+                                return_full=return_full)
     bit_depth = property(get_bit_depth)
 
     # readout time
@@ -380,9 +535,8 @@ class EigerDetector(object):
         :returns: readout time in seconds
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "detector_readout_time", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("detector_readout_time", timeout=timeout,
+                                return_full=return_full)
     readout_time = property(get_readout_time)
 
     # description
@@ -395,9 +549,8 @@ class EigerDetector(object):
         :returns: detector description
         :rtype: string
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "description", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("description", timeout=timeout,
+                                return_full=return_full)
     description = property(get_description)
 
     # serial number
@@ -410,9 +563,8 @@ class EigerDetector(object):
         :returns: detector serial number
         :rtype: string
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "detector_number", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("detector_number", timeout=timeout,
+                                return_full=return_full)
     serial_number = property(get_serial_number)
 
     # firmware version
@@ -425,9 +577,8 @@ class EigerDetector(object):
         :returns: detector firmware version
         :rtype: string
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "software_version", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("software_version", timeout=timeout,
+                                return_full=return_full)
     firmware_version = property(get_firmware_version)
 
     # sensor material
@@ -440,9 +591,8 @@ class EigerDetector(object):
         :returns: material
         :rtype: string
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "sensor_material", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("sensor_material", timeout=timeout,
+                                return_full=return_full)
     sensor_material = property(get_sensor_material)
 
     # sensor thickness
@@ -455,9 +605,8 @@ class EigerDetector(object):
         :returns: sensor thickness in meters
         :rtype: float
         """
-        return get_value(self._host, self._port, self._api_v, "detector",
-                         "config", "sensor_thickness", timeout=timeout,
-                         return_full=return_full)
+        return self._get_config("sensor_thickness", timeout=timeout,
+                                return_full=return_full)
     sensor_thickness = property(get_sensor_thickness)
 
     # initialize
@@ -469,7 +618,9 @@ class EigerDetector(object):
         """
         set_value(self._host, self._port, self._api_v, "detector",
                   "command", "initialize", "initialize", timeout=timeout,
-                  no_data=True)
+                  no_data=True, session=self._session)
+        if self.config_cache is not None:
+            self.config_cache.clear()
 
     # arm
     def arm(self, timeout=100.0, return_full=False):
@@ -482,7 +633,8 @@ class EigerDetector(object):
         :rtype: int
         """
         data = set_value(self._host, self._port, self._api_v, "detector",
-                         "command", "arm", "arm", timeout=timeout)
+                         "command", "arm", "arm", timeout=timeout,
+                         session=self._session)
         if return_full:
             return data
         else:
@@ -497,7 +649,7 @@ class EigerDetector(object):
         """
         data = set_value(self._host, self._port, self._api_v, "detector",
                          "command", "disarm", "disarm", timeout=timeout,
-                         no_data=True)
+                         no_data=True, session=self._session)
 
     # trigger
     def trigger(self, timeout=100.0):
@@ -508,7 +660,7 @@ class EigerDetector(object):
         """
         set_value(self._host, self._port, self._api_v, "detector",
                   "command", "trigger", "trigger", timeout=timeout,
-                  no_data=True)
+                  no_data=True, session=self._session)
 
     # cancel
     def cancel(self, timeout=20.0, return_full=False):
@@ -526,7 +678,8 @@ class EigerDetector(object):
         :rtype: int
         """
         data = set_value(self._host, self._port, self._api_v, "detector",
-                         "command", "cancel", "cancel", timeout=timeout)
+                         "command", "cancel", "cancel", timeout=timeout,
+                         session=self._session)
         if return_full:
             return data
         else:
@@ -548,7 +701,8 @@ class EigerDetector(object):
         :rtype: int
         """
         data = set_value(self._host, self._port, self._api_v, "detector",
-                         "command", "abort", "abort", timeout=timeout)
+                         "command", "abort", "abort", timeout=timeout,
+                         session=self._session)
         if return_full:
             return data
         else:
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: fanout
+   :synopsis: This module contains workers that consume the Dectris Eiger's
+              stream in parallel and a coordinator that gathers their
+              results.
+
+The detector's PUSH socket distributes the messages round robin over all
+connected PULL sockets, so several :py:class:`StreamWorker` processes, on
+one host or on several, can each take a share of the frames. The global
+header and the end of series message reach only one of them; workers
+forward both to the :py:class:`StreamCoordinator`, which re-publishes the
+header to all workers and collects the per frame results by frame id until
+the series is complete.
+
+Workers on other hosts are started with::
+
+  python -m dectris_eiger.fanout 192.168.10.42 coordinator-host \\
+      --process mymodule:score_frame --workers 8
+"""
+import importlib
+import multiprocessing
+import os
+import socket
+import time
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+from .stream import (STREAM_PORT, SeriesEnd, SeriesHeader, StreamError,
+                     StreamFrame, parse_message)
+
+
+COORDINATOR_PORT = 9990
+
+
+class StreamWorker(object):
+    """
+    Worker pulling frames from the detector's stream. Every frame is decoded
+    and passed to *process*, whose (JSON serializable) return value is sent
+    to the coordinator together with the frame id. *on_header* is called
+    with the :py:class:`SeriesHeader` of every series, whichever worker
+    received it (the flatfield, pixel mask and count rate tables are only
+    available in the worker that received it from the detector).
+
+    :param str host: detector control unit host
+    :param str coordinator: coordinator host
+    :param process: callable receiving a :py:class:`StreamFrame`
+    :param on_header: callable receiving a :py:class:`SeriesHeader` or None
+    :param int port: detector stream port
+    :param int coordinator_port: coordinator port, the header broadcast
+                                 uses the next port
+    :param str name: worker name reported with the results, host:pid if
+                     None
+    :param bool decode: whether to decompress frames before *process*
+    :param context: ZeroMQ context, a new one is used if None
+    """
+
+    def __init__(self, host, coordinator, process, on_header=None,
+                 port=STREAM_PORT, coordinator_port=COORDINATOR_PORT,
+                 name=None, decode=True, context=None):
+        super(StreamWorker, self).__init__()
+        if zmq is None:
+            raise StreamError("The stream workers require pyzmq.")
+        self.process = process
+        self.on_header = on_header
+        self.decode = decode
+        self.name = name or "{0}:{1}".format(socket.gethostname(),
+                                             os.getpid())
+        self.frames = 0
+        self._context = context or zmq.Context.instance()
+        self._pull = self._context.socket(zmq.PULL)
+        self._pull.connect("tcp://{0}:{1}".format(host, port))
+        self._results = self._context.socket(zmq.PUSH)
+        self._results.connect("tcp://{0}:{1}".format(coordinator,
+                                                     coordinator_port))
+        self._control = self._context.socket(zmq.SUB)
+        self._control.setsockopt(zmq.SUBSCRIBE, b"")
+        self._control.connect("tcp://{0}:{1}".format(coordinator,
+                                                     coordinator_port + 1))
+        self._series = None
+
+    def _handle_control(self):
+        message = self._control.recv_json()
+        if message["type"] == "stop":
+            return False
+        if message["type"] == "header" and message["series"] != self._series:
+            self._series = message["series"]
+            if self.on_header is not None:
+                self.on_header(SeriesHeader(message["series"],
+                                            message["header_detail"],
+                                            message["config"]))
+        return True
+
+    def _handle_stream(self):
+        message = parse_message(self._pull.recv_multipart(copy=False))
+        if isinstance(message, StreamFrame):
+            start = time.time()
+            if self.decode:
+                message.decode()
+            result = self.process(message)
+            self.frames += 1
+            self._results.send_json({"type": "result",
+                                     "series": message.series,
+                                     "frame": message.frame,
+                                     "worker": self.name,
+                                     "seconds": time.time() - start,
+                                     "result": result})
+        elif isinstance(message, SeriesHeader):
+            self._series = message.series
+            if self.on_header is not None:
+                self.on_header(message)
+            self._results.send_json({"type": "header",
+                                     "series": message.series,
+                                     "header_detail": message.header_detail,
+                                     "config": message.config,
+                                     "worker": self.name})
+        elif isinstance(message, SeriesEnd):
+            self._results.send_json({"type": "end", "series": message.series,
+                                     "worker": self.name})
+
+    def run(self, timeout=None):
+        """
+        Process messages until the coordinator sends stop (or no message
+        arrives within *timeout* seconds).
+
+        :param float timeout: maximum seconds between two messages or None
+        :returns: number of frames processed
+        :rtype: int
+        """
+        poller = zmq.Poller()
+        poller.register(self._pull, zmq.POLLIN)
+        poller.register(self._control, zmq.POLLIN)
+        wait = None if timeout is None else int(timeout * 1000)
+        while True:
+            events = dict(poller.poll(wait))
+            if not events:
+                break
+            # handle the header broadcast first, so it precedes the frames
+            if self._control in events and not self._handle_control():
+                break
+            if self._pull in events:
+                self._handle_stream()
+        return self.frames
+
+    def close(self):
+        for s in (self._pull, self._results, self._control):
+            s.close(linger=1000)
+
+
+class SeriesResult(object):
+    """
+    Results of a series gathered by the coordinator: *results* maps the
+    frame ids to the values returned by the workers' *process*, *missing*
+    lists the frame ids without a result and *workers* the number of frames
+    each worker processed.
+    """
+
+    def __init__(self, series, expected=None):
+        super(SeriesResult, self).__init__()
+        self.series = series
+        self.expected = expected
+        self.config = None
+        self.results = {}
+        self.workers = {}
+        self.process_seconds = 0.0
+        self.duplicates = 0
+        self.start = time.time()
+        self.end = None
+        self.seconds = None
+        self.missing = []
+
+    def get_rate(self):
+        """
+        Returns the frames per second from the first message of the series
+        to its completion.
+
+        :rtype: float
+        """
+        return len(self.results) / self.seconds if self.seconds else 0.0
+    rate = property(get_rate)
+
+    def complete(self):
+        return (self.end is not None and self.expected is not None and
+                len(self.results) >= self.expected)
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+        if self.expected is not None:
+            self.missing = [i for i in range(self.expected)
+                            if i not in self.results]
+
+    def __repr__(self):
+        return "<SeriesResult series {0}: {1} frames, {2} missing>".format(
+            self.series, len(self.results), len(self.missing))
+
+
+class StreamCoordinator(object):
+    """
+    Coordinator gathering the results of :py:class:`StreamWorker` objects.
+    A series is complete when its end message arrived and all
+    ``nimages * ntrigger`` frames announced in the header have a result. If
+    the header has no configuration (``header_detail`` "none") or frames
+    are lost, the series is finished *end_timeout* seconds after its end
+    message.
+
+    :param int port: port for the worker results, the header broadcast
+                     uses the next port
+    :param str bind: interface to bind to
+    :param on_series: callable receiving every finished
+                      :py:class:`SeriesResult`
+    :param float end_timeout: seconds to wait for missing results after the
+                              end of series
+    :param context: ZeroMQ context, a new one is used if None
+    """
+
+    def __init__(self, port=COORDINATOR_PORT, bind="*", on_series=None,
+                 end_timeout=5.0, context=None):
+        super(StreamCoordinator, self).__init__()
+        if zmq is None:
+            raise StreamError("The stream coordinator requires pyzmq.")
+        self.on_series = on_series
+        self.end_timeout = end_timeout
+        self._context = context or zmq.Context.instance()
+        self._results = self._context.socket(zmq.PULL)
+        self._results.bind("tcp://{0}:{1}".format(bind, port))
+        self._control = self._context.socket(zmq.PUB)
+        self._control.bind("tcp://{0}:{1}".format(bind, port + 1))
+        self._series = {}
+        self._finished_series = set()
+
+    def _get_series(self, series):
+        result = self._series.get(series)
+        if result is None:
+            result = self._series[series] = SeriesResult(series)
+        return result
+
+    def _handle(self, message):
+        if message["series"] in self._finished_series:
+            # late result of a series already reported
+            return
+        result = self._get_series(message["series"])
+        if message["type"] == "result":
+            if message["frame"] in result.results:
+                result.duplicates += 1
+            result.results[message["frame"]] = message["result"]
+            worker = message["worker"]
+            result.workers[worker] = result.workers.get(worker, 0) + 1
+            result.process_seconds += message["seconds"]
+        elif message["type"] == "header":
+            config = message.get("config") or {}
+            result.config = config
+            if "nimages" in config:
+                result.expected = (int(config["nimages"]) *
+                                   int(config.get("ntrigger", 1) or 1))
+            self._control.send_json(message)
+        elif message["type"] == "end":
+            result.end = time.time()
+
+    def _finished(self):
+        now = time.time()
+        done = []
+        for series, result in list(self._series.items()):
+            if result.complete() or (result.end is not None and
+                                     now - result.end > self.end_timeout):
+                result.finish()
+                del self._series[series]
+                self._finished_series.add(series)
+                if self.on_series is not None:
+                    self.on_series(result)
+                done.append(result)
+        return done
+
+    def poll(self, timeout=0.1):
+        """
+        Handle the messages arriving within *timeout* seconds.
+
+        :param float timeout: seconds to wait for a message
+        :returns: the series finished meanwhile
+        :rtype: list
+        """
+        if self._results.poll(int(timeout * 1000)):
+            while True:
+                try:
+                    message = self._results.recv_json(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self._handle(message)
+        return self._finished()
+
+    def run(self, series=1, timeout=None):
+        """
+        Gather results until *series* series are finished.
+
+        :param int series: number of series
+        :param float timeout: maximum total seconds or None
+        :returns: the finished series
+        :rtype: list
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        done = []
+        while len(done) < series:
+            if deadline is not None and time.time() > deadline:
+                break
+            done.extend(self.poll())
+        return done
+
+    def stop(self):
+        """
+        Tell all workers to stop.
+        """
+        self._control.send_json({"type": "stop"})
+
+    def close(self):
+        self._results.close(linger=0)
+        self._control.close(linger=1000)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _run_worker(host, coordinator, process, kwargs):
+    worker = StreamWorker(host, coordinator, process, **kwargs)
+    try:
+        worker.run()
+    finally:
+        worker.close()
+
+
+def start_workers(n, host, coordinator, process, **kwargs):
+    """
+    Start *n* :py:class:`StreamWorker` processes. *process* must be
+    picklable, i.e. a module level function. They run until the coordinator
+    sends stop.
+
+    :param int n: number of workers
+    :param str host: detector control unit host
+    :param str coordinator: coordinator host
+    :param process: callable receiving a :py:class:`StreamFrame`
+    :returns: the worker processes
+    :rtype: list
+    """
+    workers = []
+    for i in range(n):
+        p = multiprocessing.Process(target=_run_worker,
+                                    args=(host, coordinator, process, kwargs))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+    return workers
+
+
+def _load(spec):
+    module, name = spec.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def frame_sum(frame):
+    """
+    Default worker function: the sum of the frame's counts.
+    """
+    return int(frame.data.sum())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Run Eiger stream workers for a remote coordinator.")
+    parser.add_argument("host", help="detector control unit host")
+    parser.add_argument("coordinator", help="coordinator host")
+    parser.add_argument("--port", type=int, default=STREAM_PORT)
+    parser.add_argument("--coordinator-port", type=int,
+                        default=COORDINATOR_PORT)
+    parser.add_argument("--process", default=None,
+                        help="module:function processing a frame")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    process = _load(args.process) if args.process else frame_sum
+    workers = start_workers(args.workers, args.host, args.coordinator,
+                            process, port=args.port,
+                            coordinator_port=args.coordinator_port)
+    for p in workers:
+        p.join()
@@ -7,20 +7,26 @@
 .. moduleauthor:: Sven Festersen <festersen@physik.uni-kiel.de>
 """
 #from .communication import get_value, set_value
-from communication import get_value, set_value
+from communication import EigerSession, get_value, set_value
 
 
 class EigerFileWriter(object):
     """
     Interface to the Dectris Eiger detector's file writer subsystem. This
     interface can be used to configure filename patterns and storage details.
+
+    If no :py:class:`dectris_eiger.communication.EigerSession` is given, the
+    interface opens its own pooled session.
     """
 
-    def __init__(self, host, port=80, api_version="1.0.0"):
+    def __init__(self, host, port=80, api_version="1.0.0", session=None):
         super(EigerFileWriter, self).__init__()
         self._host = host
         self._port = port
         self._api_v = api_version
+        if session is None:
+            session = EigerSession(host, port)
+        self._session = session
 
     # status
     def get_status(self, timeout=2.0, return_full=False):
@@ -35,7 +41,7 @@ class EigerFileWriter(object):
         """
         return get_value(self._host, self._port, self._api_v, "filewriter",
                          "status", "state", timeout=timeout,
-                         return_full=return_full)
+                         return_full=return_full, session=self._session)
     status = property(get_status)
 
     # available buffer space
@@ -50,12 +56,12 @@ class EigerFileWriter(object):
         """
         return float(get_value(self._host, self._port, self._api_v, "detector",
                              "status", "builder/dcu_buffer_free", timeout=timeout,
-                             return_full=return_full))
+                             return_full=return_full, session=self._session))
 
     def get_buffer_free(self, timeout=2.0, return_full=False):
         return float(get_value(self._host, self._port, self._api_v, "filewriter",
                              "status", "buffer_free", timeout=timeout,
-                             return_full=return_full))
+                             return_full=return_full, session=self._session))
 
     available_space = property(get_available_space)
 
@@ -71,7 +77,7 @@ class EigerFileWriter(object):
         """
         return get_value(self._host, self._port, self._api_v, "filewriter",
                          "status", "time", timeout=timeout,
-                         return_full=return_full)
+                         return_full=return_full, session=self._session)
     time = property(get_time)
 
     # transfer mode
@@ -86,7 +92,7 @@ class EigerFileWriter(object):
         """
         return get_value(self._host, self._port, self._api_v, "filewriter",
                          "config", "transfer_mode", timeout=timeout,
-                         return_full=return_full)
+                         return_full=return_full, session=self._session)
 
     def set_transfer_mode(self, mode, timeout=2.0):
         """
@@ -97,7 +103,8 @@ class EigerFileWriter(object):
         :param float timeout: communication timeout in seconds
         """
         set_value(self._host, self._port, self._api_v, "filewriter",
-                  "config", "transfer_mode", mode, timeout=timeout)
+                  "config", "transfer_mode", mode, timeout=timeout,
+                  session=self._session)
     transfer_mode = property(get_transfer_mode, set_transfer_mode)
 
     # number of images per file
@@ -112,7 +119,7 @@ class EigerFileWriter(object):
         """
         return int(get_value(self._host, self._port, self._api_v, "filewriter",
                              "config", "nimages_per_file", timeout=timeout,
-                             return_full=return_full))
+                             return_full=return_full, session=self._session))
 
     def set_images_per_file(self, n, timeout=2.0):
         """
@@ -123,7 +130,7 @@ class EigerFileWriter(object):
         """
         set_value(self._host, self._port, self._api_v, "filewriter",
                   "config", "nimages_per_file", n, timeout=timeout,
-                  no_data=True)
+                  no_data=True, session=self._session)
     images_per_file = property(get_images_per_file, set_images_per_file)
 
     # filename pattern
@@ -139,7 +146,7 @@ class EigerFileWriter(object):
         """
         return get_value(self._host, self._port, self._api_v, "filewriter",
                          "config", "name_pattern", timeout=timeout,
-                         return_full=return_full)
+                         return_full=return_full, session=self._session)
 
     def set_filename_pattern(self, pattern, timeout=2.0):
         """
@@ -151,7 +158,7 @@ class EigerFileWriter(object):
         """
         set_value(self._host, self._port, self._api_v, "filewriter",
                   "config", "name_pattern", pattern, timeout=timeout,
-                  no_data=True)
+                  no_data=True, session=self._session)
     filename_pattern = property(get_filename_pattern, set_filename_pattern)
 
     # compression
@@ -166,7 +173,7 @@ class EigerFileWriter(object):
         """
         return get_value(self._host, self._port, self._api_v, "filewriter",
                          "config", "compression_enabled", timeout=timeout,
-                         return_full=return_full)
+                         return_full=return_full, session=self._session)
 
     def set_compression_enabled(self, enabled, timeout=2.0):
         """
@@ -177,7 +184,7 @@ class EigerFileWriter(object):
         """
         set_value(self._host, self._port, self._api_v, "filewriter",
                   "config", "compression_enabled", enabled, timeout=timeout,
-                  no_data=True)
+                  no_data=True, session=self._session)
     compression_enabled = property(get_compression_enabled,
                                    set_compression_enabled)
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: h5chunks
+   :synopsis: This module contains a reader of the image chunks of the
+              Dectris Eiger's HDF5 data files.
+
+The detector's file writer (and :py:class:`dectris_eiger.writer.
+EigerStreamWriter`) stores every image in its own chunk, compressed with the
+bitshuffle/LZ4 filter (32008), the LZ4 filter (32004) or uncompressed. A
+:py:class:`ChunkReader` reads these chunks with HDF5 direct chunk reads,
+i.e. without the HDF5 filter pipeline, and returns them as blobs with the
+encoding string of the stream interface, so they can be sent on as they are
+(see :py:mod:`dectris_eiger.replay`) or decoded with
+:func:`dectris_eiger.compression.decompress`. Only datasets with other
+filters or chunk shapes are read through the filter pipeline, which needs
+the filter plugins, e.g. from the ``hdf5plugin`` package.
+
+``h5py`` and ``numpy`` are imported on first use.
+"""
+import os
+import struct
+
+from .compression import decompress
+
+
+BSHUF_FILTER = 32008
+LZ4_FILTER = 32004
+
+
+def data_files(master_path):
+    """
+    Returns the data files of a series as listed in its master file.
+
+    :param str master_path: path of the ``*_master.h5`` file
+    :returns: list of ``(data file path, dataset path, number of images)``
+    :rtype: list
+    """
+    import h5py
+    base = os.path.dirname(os.path.abspath(master_path))
+    files = []
+    with h5py.File(master_path, "r") as master:
+        group = master["entry/data"]
+        for name in sorted(group):
+            if not name.startswith("data_"):
+                continue
+            link = group.get(name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                path = os.path.join(base, link.filename)
+                dataset = link.path
+            else:
+                # images stored in the master file itself
+                path = os.path.abspath(master_path)
+                dataset = "entry/data/" + name
+            with h5py.File(path, "r") as f:
+                files.append((path, dataset, f[dataset].shape[0]))
+    return files
+
+
+class ChunkReader(object):
+    """
+    Reader of the images of one data file's dataset, one chunk per image.
+
+    :param dataset: the image dataset, shape (images, rows, columns)
+    :type dataset: h5py.Dataset
+    """
+
+    def __init__(self, dataset):
+        super(ChunkReader, self).__init__()
+        self.dataset = dataset
+        self.shape = dataset.shape[1:]
+        self.dtype = dataset.dtype
+        filters = dataset.id.get_create_plist()
+        ids = [filters.get_filter(i)[0]
+               for i in range(filters.get_nfilters())]
+        direct = dataset.chunks == (1,) + self.shape and len(ids) <= 1
+        order = "<" if self.dtype.byteorder in "<=|" else ">"
+        self._lz4 = False
+        if direct and not ids:
+            self.encoding = order
+        elif direct and ids[0] == BSHUF_FILTER:
+            self.encoding = "bs{0}-lz4{1}".format(self.dtype.itemsize * 8,
+                                                  order)
+        elif direct and ids[0] == LZ4_FILTER:
+            self.encoding = "lz4" + order
+            self._lz4 = True
+        else:
+            # unknown filter or chunking: read decompressed images
+            self.encoding = order
+            direct = False
+        self.direct = direct
+
+    @classmethod
+    def open(cls, path, dataset="entry/data/data"):
+        """
+        Open a data file and return the reader of its images. The file is
+        closed with :py:meth:`close`.
+
+        :param str path: path of the data file
+        :param str dataset: path of the image dataset in the file
+        :rtype: ChunkReader
+        """
+        import h5py
+        try:
+            # registers the filters for images that are not read as chunks
+            import hdf5plugin
+        except ImportError:
+            pass
+        return cls(h5py.File(path, "r")[dataset])
+
+    def __len__(self):
+        return self.dataset.shape[0]
+
+    def read(self, index):
+        """
+        Returns the encoded image *index* as stored on disk, see
+        *encoding*.
+
+        :param int index: image index within the dataset
+        :rtype: bytes or memoryview
+        """
+        if not self.direct:
+            import numpy
+            return numpy.ascontiguousarray(self.dataset[index]).data
+        offset = (index,) + (0,) * len(self.shape)
+        mask, chunk = self.dataset.id.read_direct_chunk(offset)
+        if self._lz4:
+            # total size, block size and the first block's compressed size
+            total, block = struct.unpack(">QI", chunk[:12])
+            if block < total:
+                # several LZ4 blocks can not be passed on as one
+                self.direct = False
+                self.encoding = self.encoding[-1]
+                return self.read(index)
+            chunk = chunk[16:]
+        return chunk
+
+    def read_image(self, index):
+        """
+        Returns the decoded image *index*.
+
+        :param int index: image index within the dataset
+        :rtype: numpy.ndarray
+        """
+        return decompress(self.read(index), self.encoding, self.shape,
+                          self.dtype)
+
+    def read_images(self, start, stop, out=None):
+        """
+        Returns the decoded images *start* to *stop* - 1.
+
+        :param int start: first image index
+        :param int stop: image index after the last
+        :param out: array of at least *stop* - *start* images to fill, a
+                    new one if None
+        :type out: numpy.ndarray
+        :returns: the images, shape (images, rows, columns)
+        :rtype: numpy.ndarray
+        """
+        import numpy
+        stop = min(stop, len(self))
+        if out is None:
+            out = numpy.empty((stop - start,) + self.shape, self.dtype)
+        for index in range(start, stop):
+            out[index - start] = self.read_image(index)
+        return out[:stop - start]
+
+    def close(self):
+        """
+        Close the data file.
+        """
+        self.dataset.file.close()
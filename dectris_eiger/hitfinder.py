@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: hitfinder
+   :synopsis: This module contains a vectorized hit finder for serial
+              crystallography frames from the stream or from data files.
+
+A pixel is strong if it is not masked, exceeds the local background by
+*nsigma* Poisson standard deviations and has at least *min_count* counts.
+The local background is the mean of the valid pixels of the pixel's tile of
+*tile_size* x *tile_size* pixels, estimated from every *tile_step*-th row
+and column. Connected strong pixels (8-connectivity) form a spot, and the
+number of spots with at least *min_pixels* pixels is a frame's hit score.
+Frames with a score of at least *min_spots* are hits.
+
+Strong pixels are rare, so only the candidate selection touches every
+pixel of a frame; the background works on the subsampled tiles and the spot
+labelling on the list of strong pixels.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from .h5chunks import ChunkReader, data_files
+
+
+# pixels compared per block in the candidate search
+CANDIDATE_BLOCK = 256 * 1024
+
+
+def label_pixels(index, cols):
+    """
+    Label the connected components (8-connectivity) of a sorted list of
+    flat pixel indices.
+
+    :param numpy.ndarray index: sorted flat indices of the pixels
+    :param int cols: number of columns of the image
+    :returns: number of components and the component label of every pixel
+    :rtype: tuple
+    """
+    n = len(index)
+    labels = numpy.arange(n)
+    if n < 2:
+        return n, labels
+    col = index % cols
+    sources = []
+    targets = []
+    # neighbours after the pixel in raster order: right, down left, down,
+    # down right
+    for offset, dc in ((1, 1), (cols - 1, -1), (cols, 0), (cols + 1, 1)):
+        neighbour = index + offset
+        pos = numpy.minimum(numpy.searchsorted(index, neighbour), n - 1)
+        found = ((index[pos] == neighbour) & (col + dc >= 0) &
+                 (col + dc < cols))
+        sources.append(numpy.flatnonzero(found))
+        targets.append(pos[found])
+    sources = numpy.concatenate(sources)
+    targets = numpy.concatenate(targets)
+    while True:
+        # propagate the smallest label along the edges, then jump pointers
+        previous = labels.copy()
+        numpy.minimum.at(labels, sources, labels[targets])
+        numpy.minimum.at(labels, targets, labels[sources])
+        labels = labels[labels]
+        if numpy.array_equal(labels, previous):
+            break
+    roots, labels = numpy.unique(labels, return_inverse=True)
+    return len(roots), labels
+
+
+class HitFinder(object):
+    """
+    Hit finder for frames of one detector configuration.
+
+    Example::
+
+      finder = HitFinder(mask=header.tables["pixel_mask"], min_spots=15)
+      for frame, score in finder.process(receiver.frames()):
+          if score >= finder.min_spots:
+              writer.write(frame)
+
+    :param mask: pixel mask, nonzero pixels are ignored (Eiger convention)
+    :type mask: numpy.ndarray or None
+    :param float nsigma: threshold above the local background in standard
+                         deviations
+    :param int min_count: minimum counts of a strong pixel
+    :param int tile_size: edge length of the background tiles in pixels
+    :param int tile_step: subsampling of the background estimate
+    :param int min_pixels: minimum number of pixels of a spot
+    :param int min_spots: minimum number of spots of a hit
+    :param int workers: number of threads scoring the frames of a batch
+    """
+
+    def __init__(self, mask=None, nsigma=6.0, min_count=2, tile_size=16,
+                 tile_step=4, min_pixels=2, min_spots=10, workers=4):
+        super(HitFinder, self).__init__()
+        if tile_size % tile_step:
+            raise ValueError("tile_size must be a multiple of tile_step.")
+        self.nsigma = nsigma
+        self.min_count = min_count
+        self.tile_size = tile_size
+        self.tile_step = tile_step
+        self.min_pixels = min_pixels
+        self.min_spots = min_spots
+        self.workers = workers
+        self.mask = mask
+        self._pool = None
+
+    def get_mask(self):
+        return self._mask
+
+    def set_mask(self, mask):
+        self._mask = None if mask is None else numpy.asarray(mask) != 0
+        self._tiles = {}
+    mask = property(get_mask, set_mask)
+
+    def _tile_layout(self, shape):
+        """
+        Subsampled valid pixels and valid pixel count per tile, cached per
+        image shape.
+        """
+        layout = self._tiles.get(shape)
+        if layout is None:
+            size, step = self.tile_size, self.tile_step
+            rows = max(shape[0] // size, 1) * size
+            cols = max(shape[1] // size, 1) * size
+            if self._mask is None:
+                valid = numpy.ones((rows // step, cols // step), dtype=bool)
+            else:
+                valid = ~self._mask[:rows:step, :cols:step]
+            counts = self._tile_sum(valid)
+            layout = (rows, cols, valid, counts)
+            self._tiles[shape] = layout
+        return layout
+
+    def _tile_sum(self, sub):
+        # adding strided slices is much faster than reducing short axes
+        n = self.tile_size // self.tile_step
+        wide = numpy.float64 if sub.dtype.kind == "f" else numpy.int64
+        sums = sub[:, 0::n].astype(wide)
+        for i in range(1, n):
+            sums += sub[:, i::n]
+        tiles = sums[0::n].copy()
+        for i in range(1, n):
+            tiles += sums[i::n]
+        return tiles
+
+    def background(self, image):
+        """
+        Returns the mean background per tile.
+
+        :param numpy.ndarray image: the frame
+        :returns: array of shape (rows // tile_size, columns // tile_size)
+        :rtype: numpy.ndarray
+        """
+        rows, cols, valid, counts = self._tile_layout(image.shape)
+        step = self.tile_step
+        sub = numpy.ascontiguousarray(image[:rows:step, :cols:step])
+        if image.dtype.kind in "ui":
+            # saturated and gap pixels hold the maximum value of the type
+            saturated = sub == numpy.iinfo(image.dtype).max
+            if saturated.any():
+                valid = valid & ~saturated
+                counts = self._tile_sum(valid)
+        sums = self._tile_sum(numpy.where(valid, sub, 0))
+        return sums / numpy.maximum(counts, 1)
+
+    def strong_pixels(self, image):
+        """
+        Returns the flat indices of the strong pixels of *image*.
+
+        :param numpy.ndarray image: the frame
+        :returns: sorted flat pixel indices
+        :rtype: numpy.ndarray
+        """
+        mean = self.background(image)
+        threshold = mean + self.nsigma * numpy.sqrt(numpy.maximum(mean, 1.0))
+        lowest = max(self.min_count, threshold.min())
+        if image.dtype.kind in "ui":
+            # an integer bound keeps the comparison in the image's type
+            top = numpy.iinfo(image.dtype).max
+            lowest = image.dtype.type(min(numpy.ceil(lowest), top))
+        # compare blocks of rows, so the temporary mask stays in the cache
+        cols = image.shape[1]
+        step = max(1, CANDIDATE_BLOCK // cols)
+        candidates = [numpy.flatnonzero(image[start:start + step] >= lowest)
+                      + start * cols
+                      for start in range(0, image.shape[0], step)]
+        candidates = numpy.concatenate(candidates)
+        values = image.ravel()[candidates]
+        tile_rows, tile_cols = threshold.shape
+        row = numpy.minimum(candidates // cols // self.tile_size,
+                            tile_rows - 1)
+        col = numpy.minimum(candidates % cols // self.tile_size,
+                            tile_cols - 1)
+        strong = ((values > threshold[row, col]) &
+                  (values >= self.min_count))
+        if image.dtype.kind in "ui":
+            # saturated and gap pixels hold the maximum value of the type
+            strong &= values < numpy.iinfo(image.dtype).max
+        if self._mask is not None:
+            strong &= ~self._mask.ravel()[candidates]
+        return candidates[strong]
+
+    def spots(self, image):
+        """
+        Returns the sizes in pixels of the spots of *image* with at least
+        *min_pixels* pixels.
+
+        :param numpy.ndarray image: the frame
+        :rtype: numpy.ndarray
+        """
+        n, labels = label_pixels(self.strong_pixels(image), image.shape[1])
+        sizes = numpy.bincount(labels, minlength=n)
+        return sizes[sizes >= self.min_pixels]
+
+    def score(self, image):
+        """
+        Returns the hit score of *image*, i.e. its number of spots.
+
+        :param numpy.ndarray image: the frame
+        :rtype: int
+        """
+        return len(self.spots(image))
+
+    def score_batch(self, batch):
+        """
+        Score a batch of frames.
+
+        :param batch: array of shape (frames, rows, columns) or a list of
+                      frames
+        :returns: hit scores
+        :rtype: numpy.ndarray
+        """
+        if self.workers > 1 and len(batch) > 1:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            scores = list(self._pool.map(self.score, batch))
+        else:
+            scores = [self.score(image) for image in batch]
+        return numpy.array(scores, dtype=numpy.int64)
+
+    def process(self, frames, batch_size=None):
+        """
+        Score decoded frames (objects with a *data* array, e.g. stream or
+        ring frames) in batches and yield ``(frame, score)`` in order.
+
+        :param frames: iterable of frames
+        :param int batch_size: frames per batch, *workers* if None
+        """
+        batch_size = batch_size or max(1, self.workers)
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) >= batch_size:
+                for item in self._process_batch(batch):
+                    yield item
+                batch = []
+        for item in self._process_batch(batch):
+            yield item
+
+    def _process_batch(self, batch):
+        if not batch:
+            return []
+        scores = self.score_batch([frame.data for frame in batch])
+        return list(zip(batch, scores.tolist()))
+
+    def hits(self, frames, batch_size=None):
+        """
+        Yield only the frames with a hit score of at least *min_spots*.
+
+        :param frames: iterable of frames
+        :param int batch_size: frames per batch, *workers* if None
+        """
+        for frame, score in self.process(frames, batch_size):
+            if score >= self.min_spots:
+                yield frame
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def data_file_batches(master_path, batch_size=16):
+    """
+    Read the images of a recorded series in batches, e.g. to run a
+    :py:class:`HitFinder` on downloaded data. The images are read with HDF5
+    direct chunk reads, see :py:class:`dectris_eiger.h5chunks.ChunkReader`,
+    so ``h5py`` suffices for bitshuffle/LZ4 and LZ4 compressed data.
+
+    :param str master_path: path of the ``*_master.h5`` file
+    :param int batch_size: images per batch
+    :returns: generator of ``(first image index, batch array)``
+    """
+    offset = 0
+    for path, dataset, n in data_files(master_path):
+        reader = ChunkReader.open(path, dataset)
+        try:
+            for start in range(0, n, batch_size):
+                yield offset + start, reader.read_images(start,
+                                                         start + batch_size)
+        finally:
+            reader.close()
+        offset += n
+
+
+def read_pixel_mask(master_path):
+    """
+    Returns the pixel mask stored in a master file or None.
+
+    :param str master_path: path of the ``*_master.h5`` file
+    :rtype: numpy.ndarray
+    """
+    import h5py
+    with h5py.File(master_path, "r") as master:
+        path = "entry/instrument/detector/detectorSpecific/pixel_mask"
+        return master[path][()] if path in master else None
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: metrics
+   :synopsis: This module contains counters and histograms to instrument the
+              stream pipeline.
+
+A :py:class:`StreamMetrics` object is passed to the stream components
+(receiver, decode pool, writer) as *metrics* argument. They record
+
+* ``arrival_lag_seconds``: how far a frame's arrival lags behind its
+  detector timestamp, relative to the first frame of the series. A growing
+  lag with short ``receive_wait_seconds`` means the consumer is too slow,
+  a growing lag while the receiver waits means the network (or the
+  detector's stream buffer) is the bottleneck,
+* ``receive_wait_seconds``: time the receiver blocked waiting for a message,
+* ``frames_missing``, ``frame_gaps`` and ``frames_out_of_order``: frame id
+  gaps within a series, including frames lost after the last received one
+  if the series header announced the number of frames,
+* ``queue_depth.<stage>``: backlog of a pipeline stage, e.g. messages
+  waiting in the receiver (``receive``) or frames waiting for the decode
+  pool (``decode``),
+* ``decode_seconds`` and ``write_seconds``: per frame latencies.
+
+:py:meth:`StreamMetrics.snapshot` returns the metrics accumulated since the
+last reset, the summary passed on at the end of a series only those of that
+series.
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+# histogram bucket upper bounds in seconds
+LATENCY_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                  5.0, float("inf"))
+DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, float("inf"))
+
+
+class Counter(object):
+    """
+    Monotonic counter.
+    """
+
+    def __init__(self):
+        super(Counter, self).__init__()
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def to_dict(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    Histogram with fixed bucket upper bounds, plus count, sum, minimum and
+    maximum of the observed values.
+
+    :param tuple bounds: increasing bucket upper bounds
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        super(Histogram, self).__init__()
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """
+        Add a value.
+
+        :param float value: the observed value
+        """
+        i = bisect.bisect_left(self.bounds, value)
+        self.buckets[min(i, len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_mean(self):
+        return self.sum / self.count if self.count else 0.0
+    mean = property(get_mean)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the *q* quantile.
+
+        :param float q: quantile between 0 and 1
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.mean,
+                "min": self.min, "max": self.max,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets": dict(zip(self.bounds, self.buckets))}
+
+
+class Gauge(object):
+    """
+    Current value of a level, e.g. a queue depth, with its maximum and a
+    histogram of the sampled values.
+    """
+
+    def __init__(self, bounds=DEPTH_BOUNDS):
+        super(Gauge, self).__init__()
+        self.value = 0
+        self.max = 0
+        self.samples = Histogram(bounds)
+
+    def set(self, value):
+        self.value = value
+        self.max = max(self.max, value)
+        self.samples.observe(value)
+
+    def to_dict(self):
+        return {"value": self.value, "max": self.max,
+                "mean": self.samples.mean}
+
+
+class StreamMetrics(object):
+    """
+    Registry of the counters, histograms and gauges of a stream pipeline.
+    All methods are thread-safe.
+
+    Example::
+
+      metrics = StreamMetrics(on_series_end=StreamMetrics.print_summary)
+      receiver = EigerStreamReceiver(host, metrics=metrics)
+      with DecodePool(metrics=metrics) as pool:
+          for frame in pool.decode(receiver.frames()):
+              ...
+      print(metrics.snapshot()["histograms"]["arrival_lag_seconds"])
+
+    :param on_series_end: callable receiving the summary dict (see
+                          :py:meth:`snapshot`) of every finished series
+    """
+
+    def __init__(self, on_series_end=None):
+        super(StreamMetrics, self).__init__()
+        self.on_series_end = on_series_end
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Remove all metrics.
+        """
+        with self._lock:
+            # metrics since the reset and of the current series
+            self._totals = self._registries()
+            self._current = self._registries()
+            self._series = None
+            self._next_frame = None
+            self._expected = None
+            self._origin = None
+            self._series_start = None
+
+    @staticmethod
+    def _registries():
+        return {"counters": {}, "histograms": {}, "gauges": {}}
+
+    def _metrics(self, kind, name, factory):
+        # the metric in the totals and in the current series
+        metrics = []
+        for registries in (self._totals, self._current):
+            registry = registries[kind]
+            metric = registry.get(name)
+            if metric is None:
+                metric = registry[name] = factory()
+            metrics.append(metric)
+        return metrics
+
+    def _inc(self, name, n=1):
+        for metric in self._metrics("counters", name, Counter):
+            metric.inc(n)
+
+    def _observe(self, name, value, bounds=LATENCY_BOUNDS):
+        for metric in self._metrics("histograms", name,
+                                    lambda: Histogram(bounds)):
+            metric.observe(value)
+
+    def inc(self, name, n=1):
+        """
+        Increment counter *name* by *n*.
+        """
+        with self._lock:
+            self._inc(name, n)
+
+    def observe(self, name, value, bounds=LATENCY_BOUNDS):
+        """
+        Add *value* to histogram *name*.
+        """
+        with self._lock:
+            self._observe(name, value, bounds)
+
+    def set_depth(self, stage, depth):
+        """
+        Record the queue depth of pipeline *stage*.
+        """
+        with self._lock:
+            for metric in self._metrics("gauges", "queue_depth." + stage,
+                                        Gauge):
+                metric.set(depth)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Context manager observing the duration of its block in histogram
+        *name*.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def _start_series(self, series, next_frame, nframes, start):
+        self._series = series
+        self._next_frame = next_frame
+        self._expected = nframes
+        self._origin = None
+        self._series_start = start
+        self._current = self._registries()
+        self._inc("series")
+
+    def series_started(self, series, nframes=None):
+        """
+        Reset the per series state (expected frame id, time origin) and
+        metrics.
+
+        :param int series: the series id
+        :param int nframes: number of frames of the series, if known
+        """
+        with self._lock:
+            self._start_series(series, 0, nframes, time.time())
+
+    def frame_received(self, frame, arrival=None):
+        """
+        Record a received frame: frame id gaps and the arrival lag against
+        the frame's detector timestamp.
+
+        :param frame: the :py:class:`StreamFrame`
+        :param float arrival: arrival time in seconds since the epoch, now
+                              if None
+        """
+        arrival = time.time() if arrival is None else arrival
+        with self._lock:
+            if frame.series != self._series:
+                # no header seen for this series, e.g. header_detail "none"
+                self._start_series(frame.series, frame.frame, None, arrival)
+            self._inc("frames")
+            expected = self._next_frame
+            if frame.frame > expected:
+                self._inc("frame_gaps")
+                self._inc("frames_missing", frame.frame - expected)
+            elif frame.frame < expected:
+                self._inc("frames_out_of_order")
+            self._next_frame = max(expected, frame.frame + 1)
+            stamp = frame.stop_time or frame.start_time
+            if stamp is not None:
+                stamp = stamp * 1e-9
+                if self._origin is None:
+                    self._origin = (arrival, stamp)
+                lag = ((arrival - self._origin[0]) -
+                       (stamp - self._origin[1]))
+                self._observe("arrival_lag_seconds", max(lag, 0.0))
+
+    def series_ended(self, series):
+        """
+        Finish a series and pass its summary, the metrics recorded since
+        the series started (see :py:meth:`snapshot`), to *on_series_end*.
+        Frames missing after the last received one are counted if the
+        number of frames was passed to :py:meth:`series_started`.
+
+        :param int series: the series id
+        :returns: the summary
+        :rtype: dict
+        """
+        with self._lock:
+            if self._expected is not None and self._next_frame is not None:
+                missing = self._expected - self._next_frame
+                if missing > 0:
+                    self._inc("frame_gaps")
+                    self._inc("frames_missing", missing)
+            summary = self._export(self._current)
+            summary["series"] = series
+            if self._series_start is not None:
+                summary["series_seconds"] = time.time() - self._series_start
+            self._series = None
+            self._expected = None
+        if self.on_series_end is not None:
+            self.on_series_end(summary)
+        return summary
+
+    def snapshot(self):
+        """
+        Returns all metrics since the last reset as a dict with the keys
+        "counters", "histograms" and "gauges".
+
+        :rtype: dict
+        """
+        with self._lock:
+            return self._export(self._totals)
+
+    @staticmethod
+    def _export(registries):
+        summary = {"time": time.time()}
+        for kind, registry in registries.items():
+            summary[kind] = dict((name, m.to_dict())
+                                 for name, m in registry.items())
+        return summary
+
+    @staticmethod
+    def print_summary(summary):
+        """
+        Print a series summary as JSON, usable as *on_series_end*.
+        """
+        print(json.dumps(summary, indent=1, sort_keys=True,
+                         default=str))
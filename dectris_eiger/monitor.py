@@ -0,0 +1,585 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: monitor
+   :synopsis: This module contains an interface to the Dectris Eiger's
+              monitor subsystem.
+
+The monitor serves single frames as uncompressed TIFF files. The frames are
+read from the HTTP response into one preallocated buffer (the HTTP library
+copies every received chunk into it once) and decoded in memory: the
+returned ``numpy`` array is a view of the pixel data in that buffer, no
+temporary file is written and the decoder does not copy the pixels. The
+optional package ``numpy`` is imported on first use.
+
+A :py:class:`MonitorPrefetcher` drains the monitor buffer in a background
+thread, so a viewer's loop does not wait for the HTTP transfer and decoding.
+"""
+import collections
+import json
+import struct
+import threading
+import time
+
+import requests
+
+from .communication import EigerSession, get_value, set_value
+
+
+# response size read per call while receiving a frame
+READ_CHUNK_SIZE = 1024 * 1024
+
+# TIFF tags used by the decoder
+TIFF_WIDTH = 256
+TIFF_HEIGHT = 257
+TIFF_BITS = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_COUNTS = 279
+TIFF_SAMPLE_FORMAT = 339
+
+# TIFF field types: SHORT and LONG
+TIFF_TYPES = {3: "H", 4: "I"}
+TIFF_SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+
+# prefetch queue policies
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+# seconds the prefetcher waits after its first failed request, doubled per
+# further failure
+RETRY_INTERVAL = 0.1
+
+
+class MonitorError(Exception):
+    pass
+
+
+def _tiff_tags(data, order):
+    offset = struct.unpack_from(order + "I", data, 4)[0]
+    count = struct.unpack_from(order + "H", data, offset)[0]
+    tags = {}
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        tag, field_type, n = struct.unpack_from(order + "HHI", data, entry)
+        fmt = TIFF_TYPES.get(field_type)
+        if fmt is None:
+            continue
+        # values longer than 4 bytes are stored at an offset
+        pos = entry + 8
+        if struct.calcsize(fmt) * n > 4:
+            pos = struct.unpack_from(order + "I", data, pos)[0]
+        tags[tag] = struct.unpack_from(order + fmt * n, data, pos)
+    return tags
+
+
+def decode_tiff(data):
+    """
+    Decode an uncompressed single image TIFF file, as served by the monitor,
+    into a ``numpy`` array. If the image is stored in one contiguous strip
+    (or several adjacent ones) the array is a view of *data*.
+
+    :param data: the TIFF file's content
+    :type data: bytes, bytearray, memoryview or numpy.ndarray
+    :returns: the image with shape (rows, columns)
+    :rtype: numpy.ndarray
+    :raises MonitorError: if *data* is not an uncompressed TIFF image
+    """
+    import numpy
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    order = {b"II": "<", b"MM": ">"}.get(raw[:2].tobytes())
+    if order is None:
+        raise MonitorError("Not a TIFF file.")
+    tags = _tiff_tags(raw, order)
+    try:
+        width = tags[TIFF_WIDTH][0]
+        height = tags[TIFF_HEIGHT][0]
+        offsets = tags[TIFF_STRIP_OFFSETS]
+        counts = tags[TIFF_STRIP_COUNTS]
+    except KeyError as e:
+        raise MonitorError("TIFF tag {0} missing.".format(e))
+    if tags.get(TIFF_COMPRESSION, (1,))[0] != 1:
+        raise MonitorError("Compressed TIFF files are not supported.")
+    bits = tags.get(TIFF_BITS, (32,))[0]
+    kind = TIFF_SAMPLE_KINDS[tags.get(TIFF_SAMPLE_FORMAT, (1,))[0]]
+    dtype = numpy.dtype(order + kind + str(bits // 8))
+    size = width * height * dtype.itemsize
+    adjacent = all(offsets[i] + counts[i] == offsets[i + 1]
+                   for i in range(len(offsets) - 1))
+    if adjacent:
+        pixels = raw[offsets[0]:offsets[0] + size]
+    else:
+        pixels = numpy.concatenate([raw[o:o + c]
+                                    for o, c in zip(offsets, counts)])
+    if len(pixels) < size:
+        raise MonitorError("Truncated TIFF file: {0} of {1} bytes.".format(
+            len(pixels), size))
+    return pixels.view(dtype).reshape(height, width)
+
+
+class EigerMonitor(object):
+    """
+    Interface to the Dectris Eiger detector's monitor subsystem. The monitor
+    keeps a buffer of frames of the running series, which can be read in
+    order (``"next"``), as the most recent frame (``"monitor"``) or by
+    ``(series id, image id)``. Frames are returned as ``numpy`` arrays.
+
+    If no :py:class:`dectris_eiger.communication.EigerSession` is given, the
+    interface opens its own pooled session.
+
+    Example::
+
+      det.monitor.enabled = True
+      image = det.monitor.get_image("monitor")
+    """
+
+    def __init__(self, host, port=80, api_version="1.0.0", session=None):
+        super(EigerMonitor, self).__init__()
+        self._host = host
+        self._port = port
+        self._api_v = api_version
+        if session is None:
+            session = EigerSession(host, port)
+        self._session = session
+
+    # configuration
+    def get_config(self, key, timeout=2.0, return_full=False):
+        """
+        Returns a monitor configuration parameter.
+
+        :param str key: parameter name, e.g. "buffer_size"
+        :param float timeout: communication timeout in seconds
+        :param bool return_full: whether to return the full response dict
+        :returns: the value
+        """
+        return get_value(self._host, self._port, self._api_v, "monitor",
+                         "config", key, timeout=timeout,
+                         return_full=return_full, session=self._session)
+
+    def set_config(self, key, value, timeout=2.0):
+        """
+        Set a monitor configuration parameter.
+
+        :param str key: parameter name
+        :param value: the new value
+        :param float timeout: communication timeout in seconds
+        """
+        set_value(self._host, self._port, self._api_v, "monitor", "config",
+                  key, value, timeout=timeout, no_data=True,
+                  session=self._session)
+
+    def get_enabled(self, timeout=2.0):
+        """
+        Returns True if the monitor is enabled.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: bool
+        """
+        return self.get_config("mode", timeout) == "enabled"
+
+    def set_enabled(self, enabled, timeout=2.0):
+        """
+        Enable or disable the monitor.
+
+        :param bool enabled: the new state
+        :param float timeout: communication timeout in seconds
+        """
+        self.set_config("mode", "enabled" if enabled else "disabled",
+                        timeout)
+    enabled = property(get_enabled, set_enabled)
+
+    def get_buffer_size(self, timeout=2.0):
+        """
+        Returns the number of frames the monitor buffer holds.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: int
+        """
+        return int(self.get_config("buffer_size", timeout))
+
+    def set_buffer_size(self, size, timeout=2.0):
+        """
+        Set the number of frames the monitor buffer holds.
+
+        :param int size: number of frames
+        :param float timeout: communication timeout in seconds
+        """
+        self.set_config("buffer_size", size, timeout)
+    buffer_size = property(get_buffer_size, set_buffer_size)
+
+    def get_discard_new(self, timeout=2.0):
+        """
+        Returns True if new frames are discarded when the buffer is full,
+        False if the oldest frames are.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: bool
+        """
+        return self.get_config("discard_new", timeout)
+
+    def set_discard_new(self, discard, timeout=2.0):
+        """
+        Set whether new (True) or old (False) frames are discarded when the
+        buffer is full.
+
+        :param bool discard: the new policy
+        :param float timeout: communication timeout in seconds
+        """
+        self.set_config("discard_new", discard, timeout)
+    discard_new = property(get_discard_new, set_discard_new)
+
+    # status
+    def get_status(self, key="state", timeout=2.0, return_full=False):
+        """
+        Returns a monitor status parameter, by default the state.
+
+        :param str key: parameter name, e.g. "buffer_fill_level" or
+                        "dropped"
+        :param float timeout: communication timeout in seconds
+        :param bool return_full: whether to return the full response dict
+        :returns: the value
+        """
+        return get_value(self._host, self._port, self._api_v, "monitor",
+                         "status", key, timeout=timeout,
+                         return_full=return_full, session=self._session)
+    status = property(get_status)
+
+    def get_buffer_fill_level(self, timeout=2.0):
+        """
+        Returns the number of frames in the monitor buffer and its
+        capacity.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: tuple
+        """
+        level = self.get_status("buffer_fill_level", timeout)
+        return tuple(level) if isinstance(level, list) else level
+    buffer_fill_level = property(get_buffer_fill_level)
+
+    def get_dropped(self, timeout=2.0):
+        """
+        Returns the number of frames dropped because the buffer was full.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: int
+        """
+        return int(self.get_status("dropped", timeout))
+    dropped = property(get_dropped)
+
+    def clear(self, timeout=2.0):
+        """
+        Remove all frames from the monitor buffer.
+
+        :param float timeout: communication timeout in seconds
+        """
+        url = self._session.url("monitor", self._api_v, "command", "clear")
+        self._session.put(url, timeout=timeout)
+
+    # images
+    def list_images(self, timeout=2.0):
+        """
+        Returns the ``(series id, image id)`` pairs of the frames in the
+        monitor buffer.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: list of tuple
+        """
+        url = self._session.url("monitor", self._api_v, "images")
+        response = self._session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return [tuple(image) for image in json.loads(response.text)]
+    images = property(list_images)
+
+    def _image_url(self, image):
+        if image in ("monitor", "next"):
+            key = image
+        else:
+            series, frame = image
+            key = "{0}/{1}".format(series, frame)
+        return self._session.url("monitor", self._api_v, "images", key)
+
+    def get_tiff(self, image="monitor", timeout=2.0):
+        """
+        Returns the TIFF file of a frame, read into a single buffer.
+
+        :param image: "monitor" (latest frame), "next" (oldest frame in the
+                      buffer, which is removed from it) or
+                      ``(series id, image id)``
+        :param float timeout: communication timeout in seconds
+        :returns: the file content or None if no frame is available
+        :rtype: numpy.ndarray of uint8
+        :raises MonitorError: if the request fails
+        """
+        import numpy
+        headers = {"Accept": "application/tiff"}
+        try:
+            response = self._session.get(self._image_url(image),
+                                         headers=headers, timeout=timeout,
+                                         stream=True)
+        except requests.RequestException as e:
+            raise MonitorError("Monitor request failed: {0}".format(e))
+        try:
+            # no frame available (yet)
+            if response.status_code in (404, 408):
+                return None
+            if response.status_code != 200:
+                raise MonitorError("Monitor request for {0} failed with "
+                                   "status {1}".format(
+                                       image, response.status_code))
+            length = response.headers.get("Content-Length")
+            if length is None:
+                return numpy.frombuffer(response.content, dtype=numpy.uint8)
+            buf = numpy.empty(int(length), dtype=numpy.uint8)
+            view = memoryview(buf)
+            pos = 0
+            while pos < len(buf):
+                n = response.raw.readinto(view[pos:pos + READ_CHUNK_SIZE])
+                if not n:
+                    raise MonitorError("Incomplete frame: {0} of {1} "
+                                       "bytes".format(pos, len(buf)))
+                pos += n
+            return buf
+        finally:
+            response.close()
+
+    def get_image(self, image="monitor", timeout=2.0):
+        """
+        Returns a frame as ``numpy`` array.
+
+        :param image: "monitor" (latest frame), "next" (oldest frame in the
+                      buffer, which is removed from it) or
+                      ``(series id, image id)``
+        :param float timeout: communication timeout in seconds
+        :returns: the frame or None if no frame is available
+        :rtype: numpy.ndarray
+        :raises MonitorError: if the request fails
+        """
+        data = self.get_tiff(image, timeout)
+        if data is None:
+            return None
+        return decode_tiff(data)
+
+    def get_latest_image(self, timeout=2.0):
+        """
+        Returns the most recent frame or None.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: numpy.ndarray
+        """
+        return self.get_image("monitor", timeout)
+    latest_image = property(get_latest_image)
+
+    def next_image(self, timeout=2.0):
+        """
+        Returns the oldest frame of the buffer, which is removed from it, or
+        None.
+
+        :param float timeout: communication timeout in seconds
+        :rtype: numpy.ndarray
+        """
+        return self.get_image("next", timeout)
+
+    def prefetcher(self, **kwargs):
+        """
+        Returns a started :py:class:`MonitorPrefetcher` reading this
+        monitor's frames, see there for the arguments.
+
+        :rtype: MonitorPrefetcher
+        """
+        prefetcher = MonitorPrefetcher(self, **kwargs)
+        prefetcher.start()
+        return prefetcher
+
+
+class MonitorPrefetcher(object):
+    """
+    Background thread reading the ``"next"`` frames of a monitor into a
+    bounded queue of decoded frames. If the queue is full, the policy
+    "drop_oldest" removes its oldest frame (the reader always gets the most
+    recent frames, the monitor buffer is drained as fast as the control unit
+    serves it), the policy "block" waits until the reader took a frame (no
+    frame is dropped here, but the monitor buffer may fill up and drop
+    frames itself).
+
+    Failed requests (errors, timeouts) do not stop the thread: it retries
+    after a pause that doubles per failure up to *max_backoff* seconds.
+    While the monitor fails, *error* holds the last error and
+    :py:meth:`get` raises it instead of waiting; *errors* counts the failed
+    requests.
+
+    Example::
+
+      with det.monitor.prefetcher(maxsize=4) as prefetcher:
+          while viewer.running:
+              image = prefetcher.latest
+              if image is not None:
+                  viewer.show(image)
+
+    :param EigerMonitor monitor: the monitor
+    :param int maxsize: maximum number of queued frames
+    :param str policy: "drop_oldest" or "block"
+    :param float poll_interval: seconds to wait before asking again if the
+                                monitor buffer is empty
+    :param float timeout: communication timeout in seconds
+    :param float max_backoff: maximum seconds between retries after
+                              failed requests
+    """
+
+    def __init__(self, monitor, maxsize=8, policy=DROP_OLDEST,
+                 poll_interval=0.05, timeout=2.0, max_backoff=5.0):
+        super(MonitorPrefetcher, self).__init__()
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown prefetch policy {0!r}".format(policy))
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1.")
+        self.monitor = monitor
+        self.maxsize = maxsize
+        self.policy = policy
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.fetched = 0
+        self.dropped = 0
+        self.errors = 0
+        self.error = None
+        self._queue = collections.deque()
+        self._latest = None
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start the prefetch thread.
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="MonitorPrefetcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the prefetch thread. Queued frames can still be read.
+
+        :param float timeout: seconds to wait for the thread
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _put(self, image):
+        with self._condition:
+            if self.policy == BLOCK:
+                while self._running and len(self._queue) >= self.maxsize:
+                    self._condition.wait()
+                if not self._running:
+                    return
+            elif len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(image)
+            self._latest = image
+            self.fetched += 1
+            self._condition.notify_all()
+
+    def _wait(self, seconds):
+        with self._condition:
+            if self._running:
+                self._condition.wait(seconds)
+
+    def _run(self):
+        backoff = RETRY_INTERVAL
+        try:
+            while self._running:
+                try:
+                    image = self.monitor.get_image("next", self.timeout)
+                except Exception as e:
+                    with self._condition:
+                        self.error = e
+                        self.errors += 1
+                        self._condition.notify_all()
+                    self._wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                backoff = RETRY_INTERVAL
+                if self.error is not None:
+                    with self._condition:
+                        self.error = None
+                if image is None:
+                    self._wait(self.poll_interval)
+                    continue
+                self._put(image)
+        finally:
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest queued frame.
+
+        :param float timeout: seconds to wait for a frame, forever if None
+        :returns: the frame or None if none arrived within *timeout* or the
+                  prefetcher stopped
+        :rtype: numpy.ndarray
+        :raises MonitorError: if no frame is queued and the last request of
+                              the prefetch thread failed
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._queue:
+                if self.error is not None:
+                    raise MonitorError("Monitor prefetch failing ({0} failed "
+                                       "requests): {1}".format(self.errors,
+                                                               self.error))
+                if not self._running:
+                    return None
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    return None
+                self._condition.wait(wait)
+            image = self._queue.popleft()
+            self._condition.notify_all()
+            return image
+
+    def get_latest(self):
+        """
+        Returns the most recently fetched frame, whether or not it was taken
+        from the queue, or None. The queue is not changed.
+
+        :rtype: numpy.ndarray
+        """
+        return self._latest
+    latest = property(get_latest)
+
+    def get_queued(self):
+        """
+        Returns the number of queued frames.
+
+        :rtype: int
+        """
+        return len(self._queue)
+    queued = property(get_queued)
+
+    def get_running(self):
+        return self._running
+    running = property(get_running)
+
+    def __iter__(self):
+        while True:
+            image = self.get()
+            if image is None:
+                return
+            yield image
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
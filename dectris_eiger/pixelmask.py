@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: pixelmask
+   :synopsis: This module contains the statistics of dark series used to
+              extend the Dectris Eiger's pixel mask.
+
+Pixels that count without X-rays are over-responding.
+:func:`count_hot_pixels` counts per pixel how many frames of one or more dark
+series are at or above a threshold. The data files are read chunk by chunk,
+without resolving the master file per frame, and decoded and counted in
+worker processes. Every worker adds into its own shared memory counter per
+series, so only the number of frames goes back to the caller; the counters
+are summed once at the end.
+
+:py:class:`DarkStatistics` keeps per pixel the number of valid frames, the
+mean, the sum of squared deviations (Welford/Chan updates) and the maximum
+in constant memory, so darks of any length can be accumulated from data
+files (:func:`dark_statistics`) or from the stream. It tells hot, noisy and
+intermittent pixels apart and flags them with separate pixel mask bits.
+
+Gap and invalid pixels hold the maximum value of the data type and are never
+counted.
+"""
+import multiprocessing
+import os
+
+from .h5chunks import ChunkReader, data_files
+
+
+# pixel mask bits of over-responding, noisy and intermittent pixels
+HOT_FLAG_BIT = 3
+NOISY_FLAG_BIT = 4
+INTERMITTENT_FLAG_BIT = 5
+FLAG_BITS = {"hot": HOT_FLAG_BIT, "noisy": NOISY_FLAG_BIT,
+             "intermittent": INTERMITTENT_FLAG_BIT}
+
+# pixels updated at once by the running statistics
+STATS_BLOCK = 16 * 1024
+
+# per pixel fields of the running statistics
+STATS_FIELDS = (("count", "I", "uint32"), ("mean", "f", "float32"),
+                ("m2", "f", "float32"), ("max", "i", "int32"),
+                ("hot", "I", "uint32"))
+
+# frames counted per worker task
+FRAMES_PER_TASK = 8
+
+
+class PixelMaskError(Exception):
+    pass
+
+
+def read_series_info(master_path):
+    """
+    Returns the pixel mask and the image shape and type of a series.
+
+    :param str master_path: path of the ``*_master.h5`` file
+    :returns: pixel mask (or None), image shape, image dtype
+    :rtype: tuple
+    """
+    import h5py
+    path = "entry/instrument/detector/detectorSpecific/pixel_mask"
+    with h5py.File(master_path, "r") as master:
+        mask = master[path][()] if path in master else None
+    files = data_files(master_path)
+    if not files:
+        raise PixelMaskError("No data files in {0}".format(master_path))
+    with h5py.File(files[0][0], "r") as f:
+        dataset = f[files[0][1]]
+        return mask, dataset.shape[1:], dataset.dtype
+
+
+_counters = None
+_index = None
+_sources = {}
+
+
+def _init_worker(counters, indices):
+    global _counters, _index
+    _counters = counters
+    _index = indices.get()
+
+
+def _source(path, dataset):
+    # every worker keeps its data files open
+    source = _sources.get((path, dataset))
+    if source is None:
+        source = _sources[(path, dataset)] = ChunkReader.open(path, dataset)
+    return source
+
+
+def _invalid(x):
+    # gap and invalid pixels hold the maximum value of the data type
+    import numpy
+    if x.dtype.kind in "ui":
+        return x == numpy.iinfo(x.dtype).max
+    return ~numpy.isfinite(x)
+
+
+def _count(series, path, dataset, start, stop, threshold):
+    import numpy
+    source = _source(path, dataset)
+    counts = numpy.frombuffer(_counters[_index][series], dtype=numpy.uint16)
+    for index in range(start, stop):
+        image = source.read_image(index).ravel()
+        counts += (image >= threshold) & ~_invalid(image)
+    return series, stop - start
+
+
+def _count_rows(flags):
+    # number of true values per column; summing the rows of a uint8 view is
+    # much faster than summing booleans
+    import numpy
+    dtype = numpy.uint8 if flags.shape[0] < 256 else numpy.uint32
+    return flags.view(numpy.uint8).sum(axis=0, dtype=dtype)
+
+
+def _accumulate(series, path, dataset, start, stop, threshold, batch):
+    import numpy
+    source = _source(path, dataset)
+    stats = DarkStatistics(source.shape, threshold,
+                           buffers=_counters[_index][series])
+    images = numpy.empty((batch,) + source.shape, source.dtype)
+    for first in range(start, stop, batch):
+        stats.add_batch(source.read_images(first, min(first + batch, stop),
+                                           images))
+    return series, stop - start
+
+
+def _task(args):
+    return _count(*args)
+
+
+def _stats_task(args):
+    return _accumulate(*args)
+
+
+class DarkSeries(object):
+    """
+    Hot pixel counts of one dark series: *counts* holds per pixel the
+    number of the *frames* images at or above *threshold*.
+    """
+
+    def __init__(self, master_path, shape, threshold, pixel_mask=None):
+        super(DarkSeries, self).__init__()
+        self.master_path = master_path
+        self.shape = shape
+        self.threshold = threshold
+        self.pixel_mask = pixel_mask
+        self.frames = 0
+        self.counts = None
+
+    def hot(self, fraction=0.5):
+        """
+        Returns the pixels at or above the threshold in more than
+        *fraction* of the frames.
+
+        :param float fraction: fraction of the frames
+        :rtype: numpy.ndarray of bool
+        """
+        return self.counts > int(self.frames * fraction)
+
+    def histogram(self):
+        """
+        Returns the number of pixels per hot count, without the pixels that
+        never counted.
+
+        :returns: list of ``(count, pixels)``
+        :rtype: list
+        """
+        import numpy
+        pixels = numpy.bincount(self.counts.ravel())
+        return [(int(n), int(pixels[n]))
+                for n in numpy.flatnonzero(pixels) if n > 0]
+
+    def __repr__(self):
+        return "<DarkSeries {0}: {1} frames>".format(
+            os.path.basename(self.master_path), self.frames)
+
+
+def _series_tasks(master_paths, max_frames, frames_per_task, extra=()):
+    # split the frames of every series into worker tasks
+    # (series, path, dataset, start, stop) + extra
+    if isinstance(master_paths, str):
+        master_paths = [master_paths]
+    infos = []
+    tasks = []
+    for i, master_path in enumerate(master_paths):
+        mask, shape, dtype = read_series_info(master_path)
+        if infos and shape != infos[0][2]:
+            raise PixelMaskError("{0} has images of shape {1}, not "
+                                 "{2}".format(master_path, shape,
+                                              infos[0][2]))
+        infos.append((master_path, mask, shape))
+        remaining = max_frames
+        for path, dataset, n in data_files(master_path):
+            if remaining is not None:
+                n = min(n, remaining)
+                remaining -= n
+            for start in range(0, n, frames_per_task):
+                tasks.append((i, path, dataset, start,
+                              min(start + frames_per_task, n)) + extra)
+    return infos, tasks
+
+
+def count_hot_pixels(master_paths, threshold=1, max_frames=100,
+                     workers=None, frames_per_task=FRAMES_PER_TASK):
+    """
+    Count per pixel how many frames of each dark series are at or above
+    *threshold*. All series must have the same image shape.
+
+    Example::
+
+      darks = count_hot_pixels(["dark_10hz_master.h5",
+                                "dark_50hz_master.h5"])
+      mask = hot_pixel_mask(darks)
+
+    :param list master_paths: paths of the series' ``*_master.h5`` files
+    :param int threshold: minimum counts of a hot pixel
+    :param int max_frames: maximum number of frames used per series, all
+                           (up to 65535) if None
+    :param int workers: number of worker processes, the number of CPUs if
+                        None
+    :param int frames_per_task: frames counted per worker task
+    :returns: the counts of every series
+    :rtype: list of DarkSeries
+    """
+    import numpy
+    if max_frames is None:
+        max_frames = 65535
+    elif max_frames > 65535:
+        raise PixelMaskError("At most 65535 frames per series are counted.")
+    infos, tasks = _series_tasks(master_paths, max_frames, frames_per_task,
+                                 (threshold,))
+    series = [DarkSeries(master_path, shape, threshold, mask)
+              for master_path, mask, shape in infos]
+    shape = series[0].shape
+    pixels = int(numpy.prod(shape))
+    workers = max(1, min(workers or multiprocessing.cpu_count(),
+                         len(tasks)))
+    # one uint16 counter per series and worker
+    counters = [[multiprocessing.RawArray("H", pixels) for s in series]
+                for w in range(workers)]
+    indices = multiprocessing.Queue()
+    for w in range(workers):
+        indices.put(w)
+    pool = multiprocessing.Pool(workers, _init_worker, (counters, indices))
+    try:
+        for i, n in pool.imap_unordered(_task, tasks):
+            series[i].frames += n
+    finally:
+        pool.close()
+        pool.join()
+    for i, dark in enumerate(series):
+        counts = numpy.zeros(pixels, dtype=numpy.uint32)
+        for w in range(workers):
+            counts += numpy.frombuffer(counters[w][i], dtype=numpy.uint16)
+        dark.counts = counts.reshape(shape)
+    return series
+
+
+def hot_pixel_mask(series, fraction=0.5, flag_bit=HOT_FLAG_BIT,
+                   dtype="uint32"):
+    """
+    Returns a pixel mask with *flag_bit* set for the pixels that are hot in
+    more than *fraction* of the frames of any of the dark series.
+
+    :param list series: :py:class:`DarkSeries` objects
+    :param float fraction: fraction of the frames
+    :param int flag_bit: pixel mask bit
+    :param dtype: type of the mask
+    :rtype: numpy.ndarray
+    """
+    import numpy
+    hot = numpy.zeros(series[0].shape, dtype=bool)
+    for dark in series:
+        hot |= dark.hot(fraction)
+    mask = numpy.zeros(hot.shape, dtype=dtype)
+    mask[hot] = 2 ** flag_bit
+    return mask
+
+
+class DarkStatistics(object):
+    """
+    Running per pixel statistics of dark frames: the number of valid frames
+    *count*, the *mean*, the sum of squared deviations *m2*, the maximum
+    *max* (-1 if never valid) and the number of frames at or above
+    *threshold* *hot*. Frames are added in batches with Chan's parallel
+    form of Welford's update, so the memory use does not depend on the
+    number of frames (20 bytes per pixel).
+
+    Example::
+
+      stats = DarkStatistics(header.config["shape"])
+      for frame in receiver.frames():
+          stats.add(frame.data)
+      mask = stats.flag_mask()
+
+    :param tuple shape: image shape
+    :param int threshold: minimum counts of a hot frame
+    :param dict buffers: writable buffers of the fields, e.g. shared
+                         memory, or None to allocate arrays
+    :param str master_path: master file of the series
+    :param pixel_mask: pixel mask of the series
+    """
+
+    def __init__(self, shape, threshold=1, buffers=None, master_path=None,
+                 pixel_mask=None):
+        super(DarkStatistics, self).__init__()
+        import numpy
+        self.shape = tuple(shape)
+        self.pixels = int(numpy.prod(self.shape))
+        self.threshold = threshold
+        self.master_path = master_path
+        self.pixel_mask = pixel_mask
+        self.frames = 0
+        for name, code, dtype in STATS_FIELDS:
+            if buffers is None:
+                array = numpy.zeros(self.pixels, dtype=dtype)
+                if name == "max":
+                    array[:] = -1
+            else:
+                array = numpy.frombuffer(buffers[name], dtype=dtype)
+            setattr(self, "_" + name, array)
+
+    @staticmethod
+    def buffers(pixels):
+        """
+        Returns shared memory buffers for the fields of *pixels* pixels,
+        initialized for an empty :py:class:`DarkStatistics`.
+
+        :rtype: dict
+        """
+        import numpy
+        buffers = dict((name, multiprocessing.RawArray(code, pixels))
+                       for name, code, dtype in STATS_FIELDS)
+        numpy.frombuffer(buffers["max"], dtype="int32")[:] = -1
+        return buffers
+
+    def _field(self, name):
+        return getattr(self, "_" + name).reshape(self.shape)
+
+    def get_count(self):
+        return self._field("count")
+    count = property(get_count)
+
+    def get_mean(self):
+        return self._field("mean")
+    mean = property(get_mean)
+
+    def get_m2(self):
+        return self._field("m2")
+    m2 = property(get_m2)
+
+    def get_max(self):
+        return self._field("max")
+    max = property(get_max)
+
+    def get_hot(self):
+        return self._field("hot")
+    hot = property(get_hot)
+
+    def get_variance(self):
+        """
+        Returns the sample variance per pixel.
+
+        :rtype: numpy.ndarray
+        """
+        import numpy
+        return self.m2 / numpy.maximum(self.count.astype(numpy.float32) - 1,
+                                       1)
+    variance = property(get_variance)
+
+    def get_hot_fraction(self):
+        """
+        Returns per pixel the fraction of the valid frames at or above the
+        threshold.
+
+        :rtype: numpy.ndarray
+        """
+        import numpy
+        return self.hot / numpy.maximum(self.count, 1).astype(numpy.float32)
+    hot_fraction = property(get_hot_fraction)
+
+    def add(self, image):
+        """
+        Add a frame.
+
+        :param numpy.ndarray image: the frame
+        """
+        self.add_batch(image[None])
+
+    def add_batch(self, batch):
+        """
+        Add a batch of frames.
+
+        :param numpy.ndarray batch: array of shape (frames, rows, columns)
+        """
+        import numpy
+        batch = numpy.asarray(batch)
+        raw = batch.reshape(batch.shape[0], -1)
+        for start in range(0, self.pixels, STATS_BLOCK):
+            self._update(raw[:, start:start + STATS_BLOCK],
+                         slice(start, start + STATS_BLOCK))
+        self.frames += batch.shape[0]
+
+    def _update(self, x, block):
+        import numpy
+        # statistics of the batch from the sums of the values and of their
+        # squares, invalid values count as zero
+        invalid = _invalid(x)
+        values = x.astype(numpy.float32)
+        values[invalid] = 0
+        n_b = (x.shape[0] - _count_rows(invalid)).astype(numpy.float32)
+        s1 = values.sum(axis=0)
+        values *= values
+        mean_b = s1 / numpy.maximum(n_b, 1)
+        m2_b = values.sum(axis=0)
+        m2_b -= s1 * mean_b
+        numpy.maximum(m2_b, 0, out=m2_b)
+        self._combine(block, n_b, mean_b, m2_b)
+        top = numpy.where(invalid, 0, x).max(axis=0).astype(numpy.int64)
+        # the maximum is kept as int32, -1 for pixels without valid frames
+        numpy.minimum(top, 2 ** 31 - 1, out=top)
+        top[n_b == 0] = -1
+        numpy.maximum(self._max[block], top.astype(numpy.int32),
+                      out=self._max[block])
+        self._hot[block] += _count_rows((x >= self.threshold) & ~invalid)
+
+    def _combine(self, block, n_b, mean_b, m2_b):
+        # Chan et al.: combine the statistics of two sets of frames
+        import numpy
+        n_a = self._count[block].astype(numpy.float32)
+        weight = n_b / numpy.maximum(n_a + n_b, 1)
+        delta = mean_b - self._mean[block]
+        self._mean[block] += delta * weight
+        delta *= delta
+        delta *= n_a
+        delta *= weight
+        delta += m2_b
+        self._m2[block] += delta
+        self._count[block] += n_b.astype(numpy.uint32)
+
+    def merge(self, other):
+        """
+        Add the frames of another :py:class:`DarkStatistics` of the same
+        shape.
+
+        :param DarkStatistics other: the statistics to add
+        """
+        import numpy
+        whole = slice(None)
+        self._combine(whole, other._count.astype(numpy.float32),
+                      other._mean, other._m2)
+        numpy.maximum(self._max, other._max, out=self._max)
+        self._hot += other._hot
+        self.frames += other.frames
+
+    def classify(self, hot_fraction=0.5, noisy_variance=0.5,
+                 noisy_dispersion=3.0, intermittent_fraction=0.01,
+                 intermittent_max=100, min_frames=3):
+        """
+        Returns the hot, noisy and intermittent pixels. Each pixel is in at
+        most one class, pixels without valid frames are in none.
+
+        * hot: at or above the threshold in more than *hot_fraction* of
+          the frames,
+        * noisy: a variance of at least *noisy_variance* and at least
+          *noisy_dispersion* times the mean (Poisson noise has a variance
+          equal to the mean),
+        * intermittent: at or above the threshold in more than
+          *intermittent_fraction* of the frames, or a maximum of at least
+          *intermittent_max* counts.
+
+        Noisy and intermittent pixels are at or above the threshold in at
+        least *min_frames* frames, single events such as cosmic rays are not
+        flagged.
+
+        :returns: dict of boolean arrays with the keys "hot", "noisy" and
+                  "intermittent"
+        :rtype: dict
+        """
+        valid = self.count > 0
+        fraction = self.hot_fraction
+        variance = self.variance
+        hot = valid & (fraction > hot_fraction)
+        repeated = valid & ~hot & (self.hot >= min_frames)
+        noisy = (repeated & (variance >= noisy_variance) &
+                 (variance >= noisy_dispersion * self.mean))
+        intermittent = (repeated & ~noisy &
+                        ((fraction > intermittent_fraction) |
+                         (self.max >= intermittent_max)))
+        return {"hot": hot, "noisy": noisy, "intermittent": intermittent}
+
+    def flag_mask(self, bits=None, dtype="uint32", **criteria):
+        """
+        Returns a pixel mask with a bit per class of :py:meth:`classify`.
+
+        :param dict bits: pixel mask bit per class, :py:data:`FLAG_BITS` if
+                          None; classes without a bit are not flagged
+        :param dtype: type of the mask
+        :param criteria: keyword arguments of :py:meth:`classify`
+        :rtype: numpy.ndarray
+        """
+        import numpy
+        bits = FLAG_BITS if bits is None else bits
+        mask = numpy.zeros(self.shape, dtype=dtype)
+        for name, pixels in self.classify(**criteria).items():
+            if name in bits:
+                mask[pixels] |= 2 ** bits[name]
+        return mask
+
+    def __repr__(self):
+        name = os.path.basename(self.master_path or "")
+        return "<DarkStatistics {0}: {1} frames>".format(name, self.frames)
+
+
+def dark_statistics(master_paths, threshold=1, max_frames=None,
+                    workers=None, frames_per_task=FRAMES_PER_TASK, batch=4):
+    """
+    Accumulate the :py:class:`DarkStatistics` of one or more dark series
+    in worker processes. Every worker adds into its own shared statistics
+    per series, which are merged at the end.
+
+    Example::
+
+      for stats in dark_statistics(["dark_10hz_master.h5",
+                                    "dark_50hz_master.h5"]):
+          mask = stats.pixel_mask | stats.flag_mask()
+
+    :param list master_paths: paths of the series' ``*_master.h5`` files
+    :param int threshold: minimum counts of a hot frame
+    :param int max_frames: maximum number of frames used per series, all if
+                           None
+    :param int workers: number of worker processes, the number of CPUs if
+                        None
+    :param int frames_per_task: frames per worker task
+    :param int batch: frames decoded and added at once
+    :returns: the statistics of every series
+    :rtype: list of DarkStatistics
+    """
+    import numpy
+    infos, tasks = _series_tasks(master_paths, max_frames, frames_per_task,
+                                 (threshold, batch))
+    shape = infos[0][2]
+    pixels = int(numpy.prod(shape))
+    workers = max(1, min(workers or multiprocessing.cpu_count(),
+                         len(tasks)))
+    buffers = [[DarkStatistics.buffers(pixels) for info in infos]
+               for w in range(workers)]
+    indices = multiprocessing.Queue()
+    for w in range(workers):
+        indices.put(w)
+    frames = [0] * len(infos)
+    pool = multiprocessing.Pool(workers, _init_worker, (buffers, indices))
+    try:
+        for i, n in pool.imap_unordered(_stats_task, tasks):
+            frames[i] += n
+    finally:
+        pool.close()
+        pool.join()
+    result = []
+    for i, (master_path, mask, shape) in enumerate(infos):
+        stats = DarkStatistics(shape, threshold, master_path=master_path,
+                               pixel_mask=mask)
+        for w in range(workers):
+            stats.merge(DarkStatistics(shape, threshold,
+                                       buffers=buffers[w][i]))
+        stats.frames = frames[i]
+        result.append(stats)
+    return result
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: preview
+   :synopsis: This module contains a generator of binned preview images of
+              detector frames.
+
+A :py:class:`PreviewGenerator` bins a frame *binning* x *binning* by sum,
+mean or maximum, ignores masked pixels, clips the result to a range of
+counts and scales it to a small ``uint8`` or ``uint16`` image. Frames from
+the monitor, the stream or the data files are all plain arrays (or objects
+with a *data* array).
+
+The frame is read only once: for a band of bin rows, the rows of each bin
+are reduced with strided adds, then the columns of the *binning* times
+smaller row sums while they are still in the cache. The bands can be
+spread over several threads. The pixel mask is analyzed once per frame
+shape. Fully masked rows and columns, i.e.
+the gaps between the modules, are handled on the row reduced array, and
+only the few bins holding other masked pixels are recomputed from their
+pixels.
+
+The benchmark is run with::
+
+  python -m dectris_eiger.preview --binning 4 --mode sum
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+
+SUM = "sum"
+MEAN = "mean"
+MAX = "max"
+_MODES = (SUM, MEAN, MAX)
+
+# Eiger 16M geometry: 4 x 8 modules with 10 and 37 pixel wide gaps
+MODULE_SHAPE = (514, 1030)
+MODULE_GAPS = (37, 10)
+MODULES_16M = (8, 4)
+
+# bytes of row sums reduced at once
+BAND_SIZE = 1024 * 1024
+
+
+def _frame_array(frame):
+    # stream, ring and replayed frames carry the image as *data*
+    if isinstance(frame, numpy.ndarray):
+        return frame
+    return frame.data
+
+
+class _Layout(object):
+    """
+    Mask analysis of one frame shape.
+    """
+
+    def __init__(self, shape, mask, binning):
+        super(_Layout, self).__init__()
+        b = binning
+        self.rows = shape[0] // b * b
+        self.cols = shape[1] // b * b
+        self.shape = (self.rows // b, self.cols // b)
+        self.row_fixes = {}
+        self.masked_cols = None
+        self.bin_index = None
+        self.pixel_index = None
+        self.keep = None
+        self.counts = None
+        self.empty = None
+        if mask is None:
+            return
+        m = mask[:self.rows, :self.cols]
+        full_rows = m.all(axis=1)
+        full_cols = m.all(axis=0)
+        # bin rows holding fully masked rows are reduced from the others
+        for k in numpy.unique(numpy.flatnonzero(full_rows) // b):
+            rows = numpy.arange(k * b, k * b + b)
+            self.row_fixes[k] = rows[~full_rows[rows]]
+        if full_cols.any():
+            self.masked_cols = numpy.flatnonzero(full_cols)
+        # bins holding other masked pixels are recomputed from their pixels
+        scattered = m & ~full_rows[:, None] & ~full_cols[None, :]
+        r, c = numpy.nonzero(scattered)
+        bins = numpy.unique((r // b) * self.shape[1] + c // b)
+        if len(bins):
+            offsets = (numpy.arange(b)[:, None] * shape[1] +
+                       numpy.arange(b)[None, :]).ravel()
+            corner = ((bins // self.shape[1]) * b * shape[1] +
+                      (bins % self.shape[1]) * b)
+            self.bin_index = bins
+            self.pixel_index = corner[:, None] + offsets[None, :]
+            self.keep = ~mask.ravel()[self.pixel_index]
+        counts = b * b - m.reshape(self.shape[0], b, self.shape[1],
+                                   b).sum(axis=(1, 3))
+        self.counts = counts.astype(numpy.float32)
+        self.empty = numpy.flatnonzero(counts == 0)
+
+
+class PreviewGenerator(object):
+    """
+    Generator of binned preview images.
+
+    Example::
+
+      preview = PreviewGenerator(mask=header.tables["pixel_mask"],
+                                 binning=4, clip=(0, 50))
+      for frame in receiver.frames():
+          viewer.show(preview.render(frame.data))
+
+    :param mask: pixel mask, nonzero pixels are ignored (Eiger convention)
+    :type mask: numpy.ndarray or None
+    :param int binning: edge length of a bin in pixels
+    :param str mode: "sum", "mean" (sum per valid pixel) or "max"
+    :param tuple clip: counts (low, high) mapped to the lowest and highest
+                       output value, or None to map 0 to the *percentile* of
+                       the binned frame
+    :param float percentile: upper percentile of the automatic clip range
+    :param dtype: output type, ``numpy.uint8`` or ``numpy.uint16``
+    :param int fill: output value of bins without valid pixels
+    :param int workers: number of threads binning bands of a frame
+    """
+
+    def __init__(self, mask=None, binning=4, mode=SUM, clip=None,
+                 percentile=99.9, dtype=numpy.uint8, fill=0, workers=1):
+        super(PreviewGenerator, self).__init__()
+        if mode not in _MODES:
+            raise ValueError("Unknown preview mode {0!r}".format(mode))
+        self.binning = binning
+        self.mode = mode
+        self.clip = clip
+        self.percentile = percentile
+        self.dtype = numpy.dtype(dtype)
+        self.fill = fill
+        self.range = None
+        self.workers = workers
+        self.mask = mask
+        self._pool = None
+
+    def get_mask(self):
+        return self._mask
+
+    def set_mask(self, mask):
+        self._mask = None if mask is None else numpy.asarray(mask) != 0
+        self._layouts = {}
+    mask = property(get_mask, set_mask)
+
+    def _layout(self, shape):
+        layout = self._layouts.get(shape)
+        if layout is None:
+            layout = _Layout(shape, self._mask, self.binning)
+            self._layouts[shape] = layout
+        return layout
+
+    def _accumulator(self, dtype):
+        if self.mode == MAX:
+            return dtype
+        if dtype.kind == "f":
+            return numpy.dtype(numpy.float32)
+        # uint32 sums wrap around modulo 2**32 like the counts themselves
+        if dtype.kind == "i" or dtype.itemsize > 4:
+            return numpy.dtype(numpy.int64)
+        return numpy.dtype(numpy.uint32)
+
+    def _reduce(self, array, axis, out):
+        # strided adds of the rows (axis 0) or columns (axis 1) of the bins,
+        # much faster than reducing a short axis
+        b = self.binning
+
+        def part(i):
+            return array[i::b] if axis == 0 else array[:, i::b]
+
+        if b == 1:
+            numpy.copyto(out, array)
+            return
+        ufunc = numpy.maximum if self.mode == MAX else numpy.add
+        ufunc(part(0), part(1), out=out, dtype=out.dtype)
+        for i in range(2, b):
+            ufunc(out, part(i), out=out)
+
+    def _bin_rows(self, image, layout, binned, first, last):
+        # reduce bands of bin rows, so the row sums stay in the cache for
+        # the column reduction
+        b = self.binning
+        dtype = binned.dtype
+        step = max(1, BAND_SIZE // (layout.cols * dtype.itemsize))
+        acc = numpy.empty((min(step, last - first), layout.cols), dtype)
+        for start in range(first, last, step):
+            stop = min(start + step, last)
+            band = acc[:stop - start]
+            self._reduce(image[start * b:stop * b, :layout.cols], 0, band)
+            for k in range(start, stop):
+                rows = layout.row_fixes.get(k)
+                if rows is None:
+                    continue
+                if not len(rows):
+                    band[k - start] = 0
+                elif self.mode == MAX:
+                    band[k - start] = image[rows, :layout.cols].max(axis=0)
+                else:
+                    band[k - start] = image[rows, :layout.cols].sum(
+                        axis=0, dtype=dtype)
+            if layout.masked_cols is not None:
+                band[:, layout.masked_cols] = 0
+            self._reduce(band, 1, binned[start:stop])
+
+    def bin(self, image):
+        """
+        Returns the binned frame without scaling. Masked pixels are
+        ignored, trailing rows and columns that do not fill a bin are
+        dropped.
+
+        :param image: the frame or an object with a *data* array
+        :returns: array of shape (rows // binning, columns // binning)
+        :rtype: numpy.ndarray
+        """
+        image = _frame_array(image)
+        layout = self._layout(image.shape)
+        b = self.binning
+        binned = numpy.empty(layout.shape, self._accumulator(image.dtype))
+        nrows = layout.shape[0]
+        if self.workers > 1 and nrows >= self.workers:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            step = -(-nrows // self.workers)
+            jobs = [self._pool.submit(self._bin_rows, image, layout, binned,
+                                      start, min(start + step, nrows))
+                    for start in range(0, nrows, step)]
+            for job in jobs:
+                job.result()
+        else:
+            self._bin_rows(image, layout, binned, 0, nrows)
+        if layout.bin_index is not None:
+            values = numpy.where(layout.keep,
+                                 image.ravel()[layout.pixel_index], 0)
+            if self.mode == MAX:
+                values = values.max(axis=1)
+            else:
+                values = values.sum(axis=1)
+            binned.ravel()[layout.bin_index] = values
+        if self.mode == MEAN:
+            if layout.counts is None:
+                binned = binned / numpy.float32(b * b)
+            else:
+                binned = binned / numpy.maximum(layout.counts, 1)
+        return binned
+
+    def scale(self, binned, empty=None):
+        """
+        Clip a binned frame and scale it to the output type.
+
+        :param numpy.ndarray binned: the binned frame
+        :param empty: flat indices of the bins to set to *fill*
+        :returns: the preview image
+        :rtype: numpy.ndarray
+        """
+        if self.clip is None:
+            sample = binned.ravel()[::7]
+            low = 0.0
+            high = float(numpy.percentile(sample, self.percentile))
+        else:
+            low, high = self.clip
+        if high <= low:
+            high = low + 1
+        self.range = (low, high)
+        top = numpy.iinfo(self.dtype).max
+        factor = top / float(high - low)
+        values = numpy.multiply(binned, factor, dtype=numpy.float32)
+        if low:
+            values -= low * factor
+        numpy.clip(values, 0, top, out=values)
+        preview = values.astype(self.dtype)
+        if empty is not None and len(empty):
+            preview.ravel()[empty] = self.fill
+        return preview
+
+    def render(self, image):
+        """
+        Returns the preview image of a frame.
+
+        :param image: the frame or an object with a *data* array, e.g. a
+                      :py:class:`dectris_eiger.stream.StreamFrame`
+        :returns: array of shape (rows // binning, columns // binning)
+        :rtype: numpy.ndarray
+        """
+        image = _frame_array(image)
+        return self.scale(self.bin(image),
+                          self._layout(image.shape).empty)
+
+    def render_batch(self, batch):
+        """
+        Returns the preview images of a batch of frames, e.g. a slice of a
+        data file.
+
+        :param batch: array of shape (frames, rows, columns) or a list of
+                      frames
+        :rtype: list
+        """
+        return [self.render(image) for image in batch]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def eiger16m_mask():
+    """
+    Returns a pixel mask of the Eiger 16M's module gaps.
+
+    :rtype: numpy.ndarray
+    """
+    (rows, cols), (gap_rows, gap_cols) = MODULE_SHAPE, MODULE_GAPS
+    shape = (MODULES_16M[0] * (rows + gap_rows) - gap_rows,
+             MODULES_16M[1] * (cols + gap_cols) - gap_cols)
+    mask = numpy.zeros(shape, dtype=numpy.uint32)
+    for i in range(1, MODULES_16M[0]):
+        start = i * (rows + gap_rows) - gap_rows
+        mask[start:start + gap_rows] = 1
+    for i in range(1, MODULES_16M[1]):
+        start = i * (cols + gap_cols) - gap_cols
+        mask[:, start:start + gap_cols] = 1
+    return mask
+
+
+def benchmark(binning=4, mode=SUM, dtype=numpy.uint32, repeat=20,
+              defects=2000, workers=1):
+    """
+    Time the preview of a synthetic Eiger 16M frame with module gaps and
+    *defects* scattered masked pixels.
+
+    :param int binning: edge length of a bin in pixels
+    :param str mode: "sum", "mean" or "max"
+    :param dtype: frame type
+    :param int repeat: number of previews
+    :param int defects: number of masked pixels outside the gaps
+    :param int workers: number of threads binning a frame
+    :returns: milliseconds per frame (mean, minimum), the mask analysis time
+              and the preview shape
+    :rtype: dict
+    """
+    mask = eiger16m_mask()
+    rng = numpy.random.default_rng(0)
+    mask.ravel()[rng.integers(0, mask.size, defects)] |= 2
+    image = rng.poisson(1.0, mask.shape).astype(dtype)
+    image[mask == 1] = numpy.iinfo(dtype).max
+    preview = PreviewGenerator(mask, binning, mode, workers=workers)
+    start = time.time()
+    shape = preview.render(image).shape
+    setup = time.time() - start
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        preview.render(image)
+        times.append(time.time() - start)
+    preview.close()
+    return {"mean_ms": 1e3 * sum(times) / len(times),
+            "min_ms": 1e3 * min(times), "setup_ms": 1e3 * setup,
+            "frame_shape": mask.shape, "preview_shape": shape}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark the preview of an Eiger 16M frame.")
+    parser.add_argument("--binning", type=int, default=4)
+    parser.add_argument("--mode", choices=_MODES, default=SUM)
+    parser.add_argument("--dtype", default="uint32")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    result = benchmark(args.binning, args.mode, numpy.dtype(args.dtype),
+                       args.repeat, workers=args.workers)
+    print("{frame_shape} -> {preview_shape}: {mean_ms:.2f} ms per frame "
+          "(min {min_ms:.2f} ms, mask setup {setup_ms:.0f} ms)".format(
+              **result))
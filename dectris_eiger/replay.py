@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: replay
+   :synopsis: This module contains a simulator that replays recorded series
+              as the Dectris Eiger's ZeroMQ stream.
+
+:py:class:`EigerStreamReplay` reads a ``*_master.h5`` file and its data
+files and publishes them on a PUSH socket with the messages of the stream
+interface (API 1.x), so that stream consumers can be benchmarked offline.
+Compressed chunks are read with HDF5 direct chunk reads (see
+:py:class:`dectris_eiger.h5chunks.ChunkReader`) and sent as they are stored
+on disk.
+
+Usage::
+
+  python -m dectris_eiger.replay noxray100_10hz_master.h5 --rate 100 \\
+      --loops 10
+"""
+import json
+import time
+
+try:
+    import h5py
+    import numpy
+except ImportError:
+    h5py = None
+
+try:
+    # registers the compression filters for images that are not sent as
+    # stored chunks
+    import hdf5plugin
+except ImportError:
+    pass
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+from .h5chunks import ChunkReader
+from .stream import STREAM_PORT, TABLE_HTYPES
+from .writer import TABLE_NAMES, GONIOMETER_AXES
+
+
+class ReplayError(Exception):
+    pass
+
+
+def _config_value(dataset):
+    value = dataset[()]
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, numpy.ndarray):
+        return None
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def read_master_config(master):
+    """
+    Rebuild the detector configuration of a series from its master file:
+    the scalar values of ``/entry/instrument/detector`` and its
+    ``detectorSpecific`` group, the wavelength and the goniometer starts and
+    increments.
+
+    :param h5py.File master: the open master file
+    :returns: configuration dict
+    :rtype: dict
+    """
+    config = {}
+    detector = master.get("entry/instrument/detector")
+    if detector is not None:
+        for group in (detector, detector.get("detectorSpecific")):
+            if group is None:
+                continue
+            for key, item in group.items():
+                if isinstance(item, h5py.Dataset) and item.ndim == 0:
+                    value = _config_value(item)
+                    if value is not None:
+                        config[key] = value
+    wavelength = master.get("entry/instrument/beam/incident_wavelength")
+    if wavelength is not None:
+        config["wavelength"] = _config_value(wavelength)
+    goniometer = master.get("entry/sample/goniometer")
+    if goniometer is not None:
+        for axis in GONIOMETER_AXES:
+            if axis in goniometer and goniometer[axis].size:
+                config[axis + "_start"] = float(goniometer[axis][0])
+                average = goniometer.get(axis + "_range_average")
+                if average is not None:
+                    config[axis + "_increment"] = float(average[()])
+    return config
+
+
+class EigerStreamReplay(object):
+    """
+    Replays a recorded series as a ZeroMQ stream. Every loop sends a global
+    header, all images of the data files linked in the master file and an
+    end of series message, with the series id counting up from *series*.
+
+    With *rate* set, images are sent at that average rate in frames per
+    second, otherwise as fast as the consumer takes them. With *burst* set,
+    images are sent in groups of *burst* frames back to back, followed by a
+    pause that keeps the average rate.
+
+    :param str master_path: path of the ``*_master.h5`` file
+    :param int port: port to bind the PUSH socket to
+    :param str bind: interface to bind to
+    :param float rate: frames per second or None
+    :param int burst: frames per burst or None
+    :param int loops: number of times the series is sent
+    :param str header_detail: "all", "basic" or "none"
+    :param int series: series id of the first loop
+    :param int sndhwm: send high water mark in messages
+    :param context: ZeroMQ context, a new one is used if None
+    """
+
+    def __init__(self, master_path, port=STREAM_PORT, bind="*", rate=None,
+                 burst=None, loops=1, header_detail="basic", series=1,
+                 sndhwm=1000, context=None):
+        super(EigerStreamReplay, self).__init__()
+        if h5py is None or zmq is None:
+            raise ReplayError("The replay requires h5py and pyzmq.")
+        self.master_path = master_path
+        self.rate = rate
+        self.burst = burst
+        self.loops = loops
+        self.header_detail = header_detail
+        self.series = series
+        self.frames = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._master = h5py.File(master_path, "r")
+        self._sources = [ChunkReader(self._master["entry/data"][name])
+                         for name in sorted(self._master["entry/data"])
+                         if name.startswith("data_")]
+        if not self._sources:
+            raise ReplayError("No data files linked in {0}."
+                              .format(master_path))
+        self.config = read_master_config(self._master)
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.SNDHWM, sndhwm)
+        self._socket.bind("tcp://{0}:{1}".format(bind, port))
+
+    def get_nimages(self):
+        """
+        Returns the number of images per loop.
+
+        :rtype: int
+        """
+        return sum(len(source) for source in self._sources)
+    nimages = property(get_nimages)
+
+    def _send_json(self, message, more=True):
+        flags = zmq.SNDMORE if more else 0
+        self._socket.send(json.dumps(message).encode("utf-8"), flags)
+
+    def _send_header(self, series):
+        self._send_json({"htype": "dheader-1.0", "series": series,
+                         "header_detail": self.header_detail},
+                        more=self.header_detail != "none")
+        if self.header_detail == "none":
+            return
+        tables = []
+        if self.header_detail == "all":
+            specific = self._master.get(
+                "entry/instrument/detector/detectorSpecific", {})
+            # the tables are sent in this order, missing ones are left out
+            for name in ("flatfield", "pixel_mask", "countrate"):
+                if TABLE_NAMES[name] in specific:
+                    table = specific[TABLE_NAMES[name]][()]
+                    tables.append((name, numpy.ascontiguousarray(table)))
+        self._send_json(self.config, more=bool(tables))
+        htypes = dict((name, htype) for htype, name in TABLE_HTYPES.items())
+        for i, (name, table) in enumerate(tables):
+            self._send_json({"htype": "{0}-1.0".format(htypes[name]),
+                             "shape": list(reversed(table.shape)),
+                             "type": table.dtype.name})
+            more = zmq.SNDMORE if i < len(tables) - 1 else 0
+            self._socket.send(table, more, copy=False)
+
+    def _send_frame(self, series, frame, source, index):
+        blob = source.read(index)
+        count_time = self.config.get("count_time", 0.0)
+        frame_time = self.config.get("frame_time", count_time)
+        start = int(frame * frame_time * 1e9)
+        real = int(count_time * 1e9)
+        self._send_json({"htype": "dimage-1.0", "series": series,
+                         "frame": frame, "hash": ""})
+        self._send_json({"htype": "dimage_d-1.0",
+                         "shape": list(reversed(source.shape)),
+                         "type": source.dtype.name,
+                         "encoding": source.encoding,
+                         "size": len(blob)})
+        self._socket.send(blob, zmq.SNDMORE, copy=False)
+        self._send_json({"htype": "dconfig-1.0", "start_time": start,
+                         "stop_time": start + real, "real_time": real},
+                        more=False)
+        self.frames += 1
+        self.bytes += len(blob)
+
+    def _wait(self, start, sent):
+        if not self.rate:
+            return
+        if self.burst and sent % self.burst:
+            return
+        delay = start + sent / float(self.rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self):
+        """
+        Send all loops.
+
+        :returns: frames sent, bytes sent, seconds and the achieved rate in
+                  frames per second
+        :rtype: dict
+        """
+        start = time.time()
+        sent = 0
+        for loop in range(self.loops):
+            series = self.series + loop
+            self._send_header(series)
+            frame = 0
+            for source in self._sources:
+                for index in range(len(source)):
+                    self._wait(start, sent)
+                    self._send_frame(series, frame, source, index)
+                    frame += 1
+                    sent += 1
+            self._send_json({"htype": "dseries_end-1.0", "series": series},
+                            more=False)
+        self.seconds = time.time() - start
+        return {"frames": self.frames, "bytes": self.bytes,
+                "seconds": self.seconds,
+                "rate": self.frames / self.seconds if self.seconds else 0.0}
+
+    def close(self):
+        self._socket.close()
+        self._master.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded series as an Eiger ZeroMQ stream.")
+    parser.add_argument("master", help="path of the *_master.h5 file")
+    parser.add_argument("--port", type=int, default=STREAM_PORT)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="frames per second (default: unlimited)")
+    parser.add_argument("--burst", type=int, default=None,
+                        help="frames sent back to back per burst")
+    parser.add_argument("--loops", type=int, default=1)
+    parser.add_argument("--header-detail", default="basic",
+                        choices=["all", "basic", "none"])
+    args = parser.parse_args()
+    with EigerStreamReplay(args.master, port=args.port, rate=args.rate,
+                           burst=args.burst, loops=args.loops,
+                           header_detail=args.header_detail) as replay:
+        print(replay.run())
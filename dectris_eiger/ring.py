@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: ring
+   :synopsis: This module contains a shared memory ring buffer that hands
+              decoded stream frames to several local consumer processes.
+
+One process receives and decodes the stream and puts the frames into a
+:py:class:`FrameRing`. Other processes attach to the ring by its name and
+read the frames without copying them, each with its own cursor, so adding a
+consumer does not add network traffic or decoding work.
+
+The ring has a single producer. Producer and consumers synchronize through
+sequence numbers in the shared memory, waiting consumers (and a blocked
+producer) poll.
+"""
+import os
+import time
+
+import numpy
+from multiprocessing import shared_memory
+
+
+MAGIC = 0x45494752  # "EIGR"
+POLL_INTERVAL = 0.0002
+# seconds between checks of the consumer processes a blocked producer waits
+# for
+LIVENESS_INTERVAL = 0.05
+OVERWRITE = "overwrite"
+BLOCK = "block"
+_POLICIES = [OVERWRITE, BLOCK]
+
+_HEADER = numpy.dtype([("magic", "u4"), ("slots", "u4"),
+                       ("slot_size", "u8"), ("max_consumers", "u4"),
+                       ("policy", "u4"), ("write_seq", "i8"),
+                       ("dropped", "u8"), ("waits", "u8")], align=True)
+_CONSUMER = numpy.dtype([("active", "u4"), ("pid", "u4"), ("cursor", "i8"),
+                         ("frames", "u8"), ("overruns", "u8")], align=True)
+_SLOT = numpy.dtype([("seq", "i8"), ("series", "i8"), ("frame", "i8"),
+                     ("nbytes", "u8"), ("rows", "u4"), ("cols", "u4"),
+                     ("dtype", "S8"), ("start_time", "i8"),
+                     ("stop_time", "i8"), ("real_time", "i8")], align=True)
+# shared memory names of the rings created by this process
+_created = set()
+
+
+class RingError(Exception):
+    pass
+
+
+def _aligned(n, alignment=64):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _own_tracker(tracker):
+    """
+    Returns True if *tracker* runs in a child of this process. Forked and
+    spawned children share the resource tracker of their parent.
+    """
+    pid = tracker._pid
+    if pid is None:
+        return False
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        # a forked child inherits the pid of its parent's tracker
+        return False
+    return True
+
+
+def _open_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    # before Python 3.13 every attached segment is registered with the
+    # resource tracker, which unlinks it when the tracker's processes exit.
+    # A tracker shared with the ring's owner already holds the segment, and
+    # unregistering it there would remove the owner's registration.
+    from multiprocessing import resource_tracker
+    shm = shared_memory.SharedMemory(name)
+    if (shm._name not in _created and
+            _own_tracker(resource_tracker._resource_tracker)):
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _alive(pid):
+    """
+    Returns False if no process *pid* exists or it has exited.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open("/proc/{0}/stat".format(pid)) as f:
+            # exited, but not waited for by its parent
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+class RingFrame(object):
+    """
+    A frame read from the ring. *data* is a view into the ring's shared
+    memory: it stays valid until the consumer reads the next frame if the
+    ring blocks, and until the producer wraps around if it overwrites, see
+    :py:meth:`valid`.
+    """
+
+    def __init__(self, ring, seq, meta):
+        super(RingFrame, self).__init__()
+        self._ring = ring
+        self.seq = seq
+        self.series = int(meta["series"])
+        self.frame = int(meta["frame"])
+        self.start_time = int(meta["start_time"])
+        self.stop_time = int(meta["stop_time"])
+        self.real_time = int(meta["real_time"])
+        shape = (int(meta["rows"]), int(meta["cols"]))
+        dtype = numpy.dtype(meta["dtype"].decode("ascii"))
+        self.data = numpy.ndarray(shape, dtype, buffer=ring._shm.buf,
+                                  offset=ring._data_offset(seq))
+
+    def valid(self):
+        """
+        Returns True if the frame's slot has not been overwritten yet.
+
+        :rtype: bool
+        """
+        return self._ring._meta(self.seq)["seq"] == self.seq
+
+    def __repr__(self):
+        return "<RingFrame series {0} frame {1}>".format(self.series,
+                                                         self.frame)
+
+
+class RingConsumer(object):
+    """
+    Read cursor of one consumer, see :py:meth:`FrameRing.consumer`.
+    """
+
+    def __init__(self, ring, index, start="latest"):
+        super(RingConsumer, self).__init__()
+        self._ring = ring
+        self.index = index
+        self._record = ring._consumers[index:index + 1]
+        head = int(ring._header["write_seq"][0])
+        if start == "oldest":
+            head = max(0, head - ring.slots + 1)
+        self._record["cursor"] = head
+        self._record["frames"] = 0
+        self._record["overruns"] = 0
+
+    def get_overruns(self):
+        """
+        Returns the number of frames this consumer missed because the ring
+        overwrote them before they were read.
+
+        :rtype: int
+        """
+        return int(self._record["overruns"][0])
+    overruns = property(get_overruns)
+
+    def get_frames(self):
+        """
+        Returns the number of frames read.
+
+        :rtype: int
+        """
+        return int(self._record["frames"][0])
+    frames = property(get_frames)
+
+    def get_lag(self):
+        """
+        Returns the number of frames written but not read yet.
+
+        :rtype: int
+        """
+        return (int(self._ring._header["write_seq"][0]) -
+                int(self._record["cursor"][0]))
+    lag = property(get_lag)
+
+    def get(self, timeout=None):
+        """
+        Read the next frame. If the consumer fell behind by more than the
+        ring holds, the missed frames are counted as overruns and reading
+        continues with the oldest frame still available.
+
+        :param float timeout: seconds to wait for a frame, forever if None
+        :returns: the frame or None on timeout
+        :rtype: RingFrame
+        """
+        ring = self._ring
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head = int(ring._header["write_seq"][0])
+            cursor = int(self._record["cursor"][0])
+            if cursor >= head:
+                if deadline is not None and time.time() >= deadline:
+                    return None
+                time.sleep(POLL_INTERVAL)
+                continue
+            oldest = head - ring.slots + 1
+            if cursor < oldest:
+                self._record["overruns"] += oldest - cursor
+                self._record["cursor"] = oldest
+                continue
+            meta = ring._meta(cursor)
+            if meta["seq"] != cursor:
+                continue
+            frame = RingFrame(ring, cursor, meta)
+            if not frame.valid():
+                continue
+            self._record["cursor"] = cursor + 1
+            self._record["frames"] += 1
+            return frame
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def close(self):
+        """
+        Release the consumer's cursor.
+        """
+        self._record["active"] = 0
+        self._record["pid"] = 0
+
+
+class FrameRing(object):
+    """
+    Ring of *slots* frame slots of *slot_size* bytes in a named shared
+    memory segment. Create the ring in the producer with
+    :py:meth:`create` and attach to it by name in the consumers with
+    :py:meth:`attach`::
+
+      # producer
+      ring = FrameRing.create(4150 * 4371 * 4, slots=64, name="eiger")
+      ring.feed(receiver.frames())
+
+      # consumer process
+      ring = FrameRing.attach("eiger")
+      reader = ring.consumer()
+      for frame in reader:
+          print(frame.frame, frame.data.max())
+
+    If the policy is "overwrite", the producer never waits and consumers that
+    fall behind lose frames (counted as overruns). If it is "block", the
+    producer waits until every attached consumer has read the frame it would
+    overwrite.
+    """
+
+    def __init__(self, shm, owner=False):
+        super(FrameRing, self).__init__()
+        self._shm = shm
+        self._owner = owner
+        self._header = numpy.ndarray(1, _HEADER, buffer=shm.buf)
+        if self._header["magic"][0] != MAGIC:
+            raise RingError("{0} is not a frame ring.".format(shm.name))
+        self.slots = int(self._header["slots"][0])
+        self.slot_size = int(self._header["slot_size"][0])
+        self.max_consumers = int(self._header["max_consumers"][0])
+        offset = _aligned(_HEADER.itemsize)
+        self._consumers = numpy.ndarray(self.max_consumers, _CONSUMER,
+                                        buffer=shm.buf, offset=offset)
+        offset = _aligned(offset + _CONSUMER.itemsize * self.max_consumers)
+        self._slots_meta = numpy.ndarray(self.slots, _SLOT, buffer=shm.buf,
+                                         offset=offset)
+        self._data_start = _aligned(offset + _SLOT.itemsize * self.slots)
+
+    @classmethod
+    def create(cls, slot_size, slots=32, max_consumers=8, policy=OVERWRITE,
+               name=None):
+        """
+        Create a ring.
+
+        :param int slot_size: maximum frame size in bytes
+        :param int slots: number of frames the ring holds
+        :param int max_consumers: maximum number of attached consumers
+        :param str policy: "overwrite" or "block"
+        :param str name: shared memory name, a random one if None
+        :returns: the ring
+        :rtype: FrameRing
+        """
+        if policy not in _POLICIES:
+            raise ValueError("Unknown ring policy {0!r}".format(policy))
+        if slots < 2:
+            raise ValueError("A frame ring needs at least 2 slots.")
+        slot_size = _aligned(slot_size)
+        size = _aligned(_HEADER.itemsize)
+        size = _aligned(size + _CONSUMER.itemsize * max_consumers)
+        size = _aligned(size + _SLOT.itemsize * slots)
+        size += slot_size * slots
+        shm = shared_memory.SharedMemory(name, create=True, size=size)
+        header = numpy.ndarray(1, _HEADER, buffer=shm.buf)
+        header[0] = (MAGIC, slots, slot_size, max_consumers,
+                     _POLICIES.index(policy), 0, 0, 0)
+        _created.add(shm._name)
+        ring = cls(shm, owner=True)
+        ring._consumers[:] = numpy.zeros(max_consumers, _CONSUMER)
+        ring._slots_meta["seq"] = -1
+        del header
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to an existing ring.
+
+        :param str name: the ring's shared memory name
+        :returns: the ring
+        :rtype: FrameRing
+        """
+        return cls(_open_shared_memory(name))
+
+    def get_name(self):
+        return self._shm.name
+    name = property(get_name)
+
+    def get_policy(self):
+        return _POLICIES[int(self._header["policy"][0])]
+    policy = property(get_policy)
+
+    def _meta(self, seq):
+        return self._slots_meta[seq % self.slots]
+
+    def _data_offset(self, seq):
+        return self._data_start + (seq % self.slots) * self.slot_size
+
+    def consumer(self, index=None, start="latest"):
+        """
+        Register a consumer. A new consumer starts with the next frame
+        written ("latest") or the oldest frame in the ring ("oldest").
+
+        The free consumer index is picked without a lock, so processes that
+        attach at the same time should pass distinct *index* values. The
+        index of a consumer whose process exited without closing it is free
+        again.
+
+        :param int index: consumer index or None for the first free one
+        :param str start: "latest" or "oldest"
+        :returns: the consumer
+        :rtype: RingConsumer
+        """
+        if index is None:
+            self._expire_consumers(numpy.flatnonzero(
+                self._consumers["active"]))
+            free = [i for i in range(self.max_consumers)
+                    if not self._consumers["active"][i]]
+            if not free:
+                raise RingError("All {0} consumers of the ring are in use."
+                                .format(self.max_consumers))
+            index = free[0]
+        consumer = RingConsumer(self, index, start)
+        self._consumers["pid"][index] = os.getpid()
+        self._consumers["active"][index] = 1
+        return consumer
+
+    def _expire_consumers(self, indices):
+        """
+        Release the cursors of the consumers *indices* whose process exited
+        without closing them.
+        """
+        for i in indices:
+            pid = int(self._consumers["pid"][i])
+            if pid and not _alive(pid):
+                self._consumers["active"][i] = 0
+                self._consumers["pid"][i] = 0
+
+    def _wait_for_consumers(self, head, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        waited = False
+        checked = 0.0
+        while True:
+            active = self._consumers["active"] != 0
+            behind = head - self._consumers["cursor"] >= self.slots - 1
+            if not (active & behind).any():
+                return True
+            now = time.time()
+            if now - checked >= LIVENESS_INTERVAL:
+                # a consumer that died can not hold back the producer
+                checked = now
+                self._expire_consumers(numpy.flatnonzero(active & behind))
+                continue
+            if deadline is not None and now >= deadline:
+                return False
+            if not waited:
+                self._header["waits"] += 1
+                waited = True
+            time.sleep(POLL_INTERVAL)
+
+    def put(self, frame, timeout=None):
+        """
+        Write a decoded frame (a :py:class:`StreamFrame` with *data* set) to
+        the ring. If the ring blocks, wait up to *timeout* seconds for the
+        slowest consumer.
+
+        :param frame: the frame
+        :param float timeout: seconds to wait, forever if None
+        :returns: True if the frame was written, False if it was dropped
+        :rtype: bool
+        """
+        data = numpy.ascontiguousarray(frame.data)
+        if data.nbytes > self.slot_size:
+            raise RingError("Frame of {0} bytes exceeds the slot size of {1}"
+                            " bytes.".format(data.nbytes, self.slot_size))
+        head = int(self._header["write_seq"][0])
+        if self.policy == BLOCK and not self._wait_for_consumers(head,
+                                                                 timeout):
+            self._header["dropped"] += 1
+            return False
+        meta = self._meta(head)
+        meta["seq"] = -1
+        target = numpy.ndarray(data.shape, data.dtype, buffer=self._shm.buf,
+                               offset=self._data_offset(head))
+        target[...] = data
+        rows, cols = data.shape if data.ndim == 2 else (1, data.size)
+        meta["series"] = frame.series
+        meta["frame"] = frame.frame
+        meta["nbytes"] = data.nbytes
+        meta["rows"] = rows
+        meta["cols"] = cols
+        meta["dtype"] = data.dtype.str.encode("ascii")
+        meta["start_time"] = getattr(frame, "start_time", None) or 0
+        meta["stop_time"] = getattr(frame, "stop_time", None) or 0
+        meta["real_time"] = getattr(frame, "real_time", None) or 0
+        meta["seq"] = head
+        self._header["write_seq"] = head + 1
+        return True
+
+    def feed(self, frames, timeout=None):
+        """
+        Put all *frames* into the ring.
+
+        :param frames: iterable of decoded frames
+        :param float timeout: seconds to wait per frame if the ring blocks
+        :returns: number of frames written
+        :rtype: int
+        """
+        written = 0
+        for frame in frames:
+            written += self.put(frame, timeout)
+        return written
+
+    def get_stats(self):
+        """
+        Returns the producer's counters (frames written, frames dropped on a
+        blocking timeout, number of times the producer had to wait) and the
+        counters of the active consumers.
+
+        :rtype: dict
+        """
+        consumers = {}
+        for i in range(self.max_consumers):
+            record = self._consumers[i]
+            if record["active"]:
+                consumers[i] = {"pid": int(record["pid"]),
+                                "frames": int(record["frames"]),
+                                "overruns": int(record["overruns"]),
+                                "lag": int(self._header["write_seq"][0] -
+                                           record["cursor"])}
+        return {"written": int(self._header["write_seq"][0]),
+                "dropped": int(self._header["dropped"][0]),
+                "waits": int(self._header["waits"][0]),
+                "consumers": consumers}
+    stats = property(get_stats)
+
+    def close(self):
+        """
+        Detach from the ring. The ring that created the shared memory also
+        removes it. Frames still referenced keep the memory mapped until
+        they are released.
+        """
+        self._header = self._consumers = self._slots_meta = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        if self._owner:
+            self._shm.unlink()
+            _created.discard(self._shm._name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
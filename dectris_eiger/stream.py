@@ -1,25 +1,373 @@
-from .communication import get_value, set_value
+import collections
+import json
+import time
+
+from .communication import EigerSession, get_value, set_value
+from .compression import decompress
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+STREAM_PORT = 9999
+
+# htypes of the tables sent with header_detail "all"
+TABLE_HTYPES = {"dflatfield": "flatfield", "dpixelmask": "pixel_mask",
+                "dcountrate_table": "countrate"}
 
 
 class EigerStreamInterface(object):
     
-    def __init__(self, host, port=80, api_version="1.5.0"):
+    def __init__(self, host, port=80, api_version="1.5.0", session=None):
         super(EigerStreamInterface, self).__init__()
         self._host = host
         self._port = port
         self._api_v = api_version
+        if session is None:
+            session = EigerSession(host, port)
+        self._session = session
         
     def get_enabled(self, timeout=2.0):
         en = get_value(self._host, self._port, self._api_v, "stream",
                        "config", "mode", timeout=timeout,
-                       return_full=False)
+                       return_full=False, session=self._session)
         return en == "enabled"
         
     def set_enabled(self, enabled, timeout=2.0):
         en = "enabled" if enabled else "disabled"
         set_value(self._host, self._port, self._api_v, "stream",
                   "config", "mode", en, timeout=timeout,
-                  no_data=True)
+                  no_data=True, session=self._session)
                   
     enabled = property(get_enabled, set_enabled)
-   
+
+    def receiver(self, port=STREAM_PORT, **kwargs):
+        """
+        Returns a :py:class:`EigerStreamReceiver` connected to this
+        detector's stream socket.
+
+        :param int port: the stream's ZeroMQ port
+        :returns: the receiver
+        :rtype: EigerStreamReceiver
+        """
+        return EigerStreamReceiver(self._host, port, **kwargs)
+
+
+class StreamError(Exception):
+    pass
+
+
+def _part_bytes(part):
+    return part.bytes if hasattr(part, "bytes") else bytes(part)
+
+
+def _part_buffer(part):
+    return part.buffer if hasattr(part, "buffer") else part
+
+
+def _load_json(part):
+    return json.loads(_part_bytes(part).decode("utf-8"))
+
+
+class SeriesHeader(object):
+    """
+    Global header message sent by the detector when a series is armed.
+    Depending on the stream's ``header_detail`` setting it holds the
+    detector configuration (*config*) and the flatfield, pixel mask and
+    count rate tables as ``(header, data)`` tuples in *tables*.
+    """
+
+    def __init__(self, series, header_detail="none", config=None,
+                 tables=None, appendix=None):
+        super(SeriesHeader, self).__init__()
+        self.series = series
+        self.header_detail = header_detail
+        self.config = config
+        self.tables = tables or {}
+        self.appendix = appendix
+
+    def get_nframes(self):
+        """
+        Returns the number of frames of the series (nimages x ntrigger) or
+        None if the header holds no configuration.
+
+        :rtype: int
+        """
+        if not self.config or "nimages" not in self.config:
+            return None
+        return self.config["nimages"] * self.config.get("ntrigger", 1)
+    nframes = property(get_nframes)
+
+    def __repr__(self):
+        return "<SeriesHeader series {0} ({1})>".format(self.series,
+                                                         self.header_detail)
+
+
+class StreamFrame(object):
+    """
+    Image message of the stream: the series and frame ids, the data header
+    (shape, type, encoding), the raw data blob as received and the detector
+    timestamps in nanoseconds.
+
+    Only the small JSON headers are parsed on receipt. The blob is kept in
+    *raw* (a zero-copy buffer of the received message, e.g. to pass it on
+    compressed) and decompressed when *data* is first accessed.
+    """
+
+    def __init__(self, series, frame, shape, dtype, encoding, raw,
+                 hash=None, start_time=None, stop_time=None, real_time=None,
+                 appendix=None):
+        super(StreamFrame, self).__init__()
+        self.series = series
+        self.frame = frame
+        self.shape = shape
+        self.dtype = dtype
+        self.encoding = encoding
+        self.raw = raw
+        self.hash = hash
+        self.start_time = start_time
+        self.stop_time = stop_time
+        self.real_time = real_time
+        self.appendix = appendix
+        self._data = None
+
+    def decode(self):
+        """
+        Decompress the raw data blob into a numpy array, stored as *data*.
+
+        :returns: the image
+        :rtype: numpy.ndarray
+        """
+        self._data = decompress(self.raw, self.encoding, self.shape,
+                                self.dtype)
+        return self._data
+
+    def get_data(self):
+        """
+        Returns the image, decompressing the raw blob on first access.
+
+        :rtype: numpy.ndarray
+        """
+        if self._data is None and self.raw is not None:
+            self.decode()
+        return self._data
+
+    def set_data(self, data):
+        self._data = data
+    data = property(get_data, set_data)
+
+    def get_decoded(self):
+        """
+        Returns True if the image has been decompressed.
+
+        :rtype: bool
+        """
+        return self._data is not None
+    decoded = property(get_decoded)
+
+    def __repr__(self):
+        return "<StreamFrame series {0} frame {1}>".format(self.series,
+                                                           self.frame)
+
+
+class SeriesEnd(object):
+    """
+    End of series message.
+    """
+
+    def __init__(self, series):
+        super(SeriesEnd, self).__init__()
+        self.series = series
+
+    def __repr__(self):
+        return "<SeriesEnd series {0}>".format(self.series)
+
+
+def parse_message(parts):
+    """
+    Parse a multipart message of the stream interface (API 1.x, htypes
+    "dheader-1.0", "dimage-1.0" and "dseries_end-1.0").
+
+    :param list parts: the message parts as bytes or ``zmq.Frame``
+    :returns: the parsed message
+    :rtype: SeriesHeader, StreamFrame or SeriesEnd
+    :raises StreamError: if the message type is unknown
+    """
+    header = _load_json(parts[0])
+    htype = header.get("htype", "")
+    if htype.startswith("dimage-"):
+        data_header = _load_json(parts[1])
+        times = _load_json(parts[3]) if len(parts) > 3 else {}
+        appendix = _part_bytes(parts[4]) if len(parts) > 4 else None
+        # the header's shape is (x, y), numpy's (rows, columns)
+        shape = tuple(reversed(data_header["shape"]))
+        return StreamFrame(header["series"], header["frame"], shape,
+                           data_header["type"], data_header["encoding"],
+                           _part_buffer(parts[2]), hash=header.get("hash"),
+                           start_time=times.get("start_time"),
+                           stop_time=times.get("stop_time"),
+                           real_time=times.get("real_time"),
+                           appendix=appendix)
+    if htype.startswith("dheader-"):
+        detail = header.get("header_detail", "none")
+        config = None
+        tables = {}
+        rest = parts[1:]
+        if detail in ("basic", "all") and rest:
+            config = _load_json(rest[0])
+            rest = rest[1:]
+        if detail == "all":
+            while len(rest) >= 2:
+                table_header = _load_json(rest[0])
+                htype = table_header.get("htype", "").split("-")[0]
+                if htype not in TABLE_HTYPES:
+                    break
+                tables[TABLE_HTYPES[htype]] = (table_header,
+                                               _part_buffer(rest[1]))
+                rest = rest[2:]
+        appendix = _part_bytes(rest[0]) if rest else None
+        return SeriesHeader(header["series"], detail, config, tables,
+                            appendix)
+    if htype.startswith("dseries_end-"):
+        return SeriesEnd(header["series"])
+    raise StreamError("Unknown message type {0!r}".format(htype))
+
+
+class EigerStreamReceiver(object):
+    """
+    Receiver for the detector's ZeroMQ stream. The detector pushes every
+    message to one connected PULL socket; :py:meth:`receive` returns them
+    parsed as :py:class:`SeriesHeader`, :py:class:`StreamFrame` or
+    :py:class:`SeriesEnd`. Frames are decompressed when their *data* is
+    first accessed, or right away if *decode* is True. Requires the
+    ``pyzmq`` package.
+
+    With *metrics*, the messages already waiting are moved from the socket
+    into the receiver's own queue (up to *rcvhwm* of them) whenever it runs
+    empty, and its length is recorded as ``queue_depth.receive``.
+
+    Example::
+
+      receiver = EigerStreamReceiver("192.168.10.42")
+      for frame in receiver.frames():
+          print(frame.series, frame.frame, frame.data.sum())
+
+    :param str host: detector control unit host
+    :param int port: stream port
+    :param bool decode: whether to decompress frames on receipt
+    :param int rcvhwm: receive high water mark in messages
+    :param context: ZeroMQ context, a new one is used if None
+    :param metrics: records receive waits, arrival lags, frame id gaps and
+                    decode latencies
+    :type metrics: dectris_eiger.metrics.StreamMetrics
+    """
+
+    def __init__(self, host, port=STREAM_PORT, decode=False, rcvhwm=1000,
+                 context=None, metrics=None):
+        super(EigerStreamReceiver, self).__init__()
+        if zmq is None:
+            raise StreamError("The stream receiver requires pyzmq.")
+        self._host = host
+        self._port = port
+        self.decode = decode
+        self.metrics = metrics
+        self._rcvhwm = rcvhwm
+        self._pending = collections.deque()
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.PULL)
+        self._socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self._socket.connect(self.get_address())
+
+    def get_address(self):
+        """
+        Returns the ZeroMQ address the receiver connects to.
+
+        :rtype: str
+        """
+        return "tcp://{0}:{1}".format(self._host, self._port)
+    address = property(get_address)
+
+    def receive(self, timeout=None):
+        """
+        Receive and parse the next message.
+
+        :param float timeout: seconds to wait, forever if None
+        :returns: the next message or None on timeout
+        :rtype: SeriesHeader, StreamFrame or SeriesEnd
+        """
+        metrics = self.metrics
+        if self._pending:
+            parts, arrival = self._pending.popleft()
+            wait = 0.0
+        else:
+            start = time.time()
+            if timeout is not None:
+                if not self._socket.poll(int(timeout * 1000)):
+                    return None
+            parts = self._socket.recv_multipart(copy=False)
+            arrival = time.time()
+            wait = arrival - start
+            if metrics is not None:
+                self._drain()
+        message = parse_message(parts)
+        if metrics is not None:
+            metrics.observe("receive_wait_seconds", wait)
+            if isinstance(message, SeriesHeader):
+                metrics.series_started(message.series, message.nframes)
+            metrics.set_depth("receive", len(self._pending))
+            metrics.inc("bytes", sum(len(part) for part in parts))
+            if isinstance(message, StreamFrame):
+                metrics.frame_received(message, arrival)
+        if self.decode and isinstance(message, StreamFrame):
+            if metrics is not None:
+                with metrics.timer("decode_seconds"):
+                    message.decode()
+            else:
+                message.decode()
+        if metrics is not None and isinstance(message, SeriesEnd):
+            metrics.series_ended(message.series)
+        return message
+
+    def _drain(self):
+        # the backlog of the socket is not visible, the messages waiting in
+        # it are counted by moving them into the receiver's queue
+        while len(self._pending) < self._rcvhwm:
+            try:
+                parts = self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            self._pending.append((parts, time.time()))
+
+    def __iter__(self):
+        while True:
+            yield self.receive()
+
+    def frames(self, timeout=None):
+        """
+        Iterate over the frames of the next series. The iteration stops at
+        the end of series message (or if no message arrives within
+        *timeout* seconds).
+
+        :param float timeout: maximum seconds between two messages
+        """
+        while True:
+            message = self.receive(timeout)
+            if message is None or isinstance(message, SeriesEnd):
+                return
+            if isinstance(message, StreamFrame):
+                yield message
+
+    def close(self):
+        """
+        Close the socket.
+        """
+        self._pending.clear()
+        self._socket.close(linger=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
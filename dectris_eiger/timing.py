@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: timing
+   :synopsis: This module contains an analysis of the per frame timestamps of
+              the Dectris Eiger's stream.
+
+Every image message carries the detector's ``start_time``, ``stop_time`` and
+``real_time`` of the frame in nanoseconds. :py:class:`TimingAnalyzer`
+collects them per series into arrays and summarizes
+
+* the exposure (``real_time``) and its jitter against ``count_time``,
+* the frame period (start to start) and its jitter against ``frame_time``,
+  i.e. the frame rate actually achieved,
+* the dead time between the end of a frame and the start of the next one,
+* gaps between frames longer than *gap_factor* median periods,
+* the trigger to first frame latency (the first frame's ``start_time``) and
+  the delay from the header's to the first frame's arrival at the host,
+* the rate at which the frames arrived at the host.
+"""
+import json
+import time
+
+import numpy
+
+from .stream import SeriesEnd, SeriesHeader, StreamFrame
+
+
+def _stats(values):
+    if not len(values):
+        return None
+    return {"mean": float(values.mean()), "std": float(values.std()),
+            "min": float(values.min()), "max": float(values.max())}
+
+
+class SeriesTiming(object):
+    """
+    Timestamps of the frames of one series. The arrays *frames*,
+    *start_time*, *stop_time*, *real_time* (nanoseconds) and *arrival*
+    (seconds since the epoch) are ordered by arrival; use
+    :py:meth:`ordered` for frame order.
+
+    :param int series: the series id
+    :param dict config: the series configuration from the global header
+    :param float header_arrival: arrival time of the header or None
+    """
+
+    def __init__(self, series, config=None, header_arrival=None,
+                 capacity=1024):
+        super(SeriesTiming, self).__init__()
+        self.series = series
+        self.config = config or {}
+        self.header_arrival = header_arrival
+        self.count = 0
+        self._columns = {"frames": numpy.empty(capacity, numpy.int64),
+                         "start_time": numpy.empty(capacity, numpy.int64),
+                         "stop_time": numpy.empty(capacity, numpy.int64),
+                         "real_time": numpy.empty(capacity, numpy.int64),
+                         "arrival": numpy.empty(capacity, numpy.float64)}
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("_columns")
+        if columns is not None and name in columns:
+            return columns[name][:self.count]
+        raise AttributeError(name)
+
+    def add(self, frame, arrival=None):
+        """
+        Add the timestamps of a :py:class:`StreamFrame`.
+
+        :param frame: the frame
+        :param float arrival: arrival time in seconds since the epoch, now
+                              if None
+        """
+        if self.count == len(self._columns["frames"]):
+            for name, column in self._columns.items():
+                grown = numpy.empty(2 * len(column), column.dtype)
+                grown[:self.count] = column
+                self._columns[name] = grown
+        i = self.count
+        columns = self._columns
+        columns["frames"][i] = frame.frame
+        columns["start_time"][i] = frame.start_time or 0
+        columns["stop_time"][i] = frame.stop_time or 0
+        columns["real_time"][i] = frame.real_time or 0
+        columns["arrival"][i] = time.time() if arrival is None else arrival
+        self.count += 1
+
+    def ordered(self):
+        """
+        Returns the timestamps sorted by frame id.
+
+        :returns: dict of arrays
+        :rtype: dict
+        """
+        order = numpy.argsort(self.frames, kind="stable")
+        return dict((name, column[:self.count][order])
+                    for name, column in self._columns.items())
+
+    def summary(self, gap_factor=1.5):
+        """
+        Returns the timing summary of the series. Times are in seconds.
+
+        :param float gap_factor: periods longer than this multiple of the
+                                 median period count as gaps
+        :rtype: dict
+        """
+        columns = self.ordered()
+        start = columns["start_time"] * 1e-9
+        stop = columns["stop_time"] * 1e-9
+        exposure = columns["real_time"] * 1e-9
+        period = numpy.diff(start)
+        dead = start[1:] - stop[:-1]
+        frames = columns["frames"]
+        result = {"series": self.series, "frames": self.count,
+                  "missing": int(frames[-1] - frames[0] + 1 - self.count)
+                  if self.count else 0,
+                  "exposure": _stats(exposure),
+                  "period": _stats(period),
+                  "dead_time": _stats(dead)}
+        count_time = self.config.get("count_time")
+        frame_time = self.config.get("frame_time")
+        if count_time is not None and len(exposure):
+            result["count_time"] = count_time
+            result["exposure_error"] = _stats(exposure - count_time)
+        if len(period):
+            median = float(numpy.median(period))
+            gaps = period > gap_factor * median
+            result["rate"] = 1.0 / period.mean() if period.mean() > 0 else None
+            result["gaps"] = int(gaps.sum())
+            result["gap_frames"] = frames[1:][gaps].tolist()[:100]
+            if frame_time is not None:
+                result["frame_time"] = frame_time
+                result["period_error"] = _stats(period - frame_time)
+        if self.count:
+            result["trigger_latency"] = float(start[0])
+            if self.header_arrival is not None:
+                result["first_frame_delay"] = float(
+                    self.arrival.min() - self.header_arrival)
+            span = float(self.arrival.max() - self.arrival.min())
+            result["arrival_span"] = span
+            result["arrival_rate"] = (self.count - 1) / span if span else None
+        return result
+
+    def write_summary(self, path, gap_factor=1.5):
+        """
+        Write the summary as JSON.
+
+        :param str path: target file
+        :param float gap_factor: see :py:meth:`summary`
+        """
+        with open(path, "w") as f:
+            json.dump(self.summary(gap_factor), f, indent=1, sort_keys=True)
+
+    def save(self, path):
+        """
+        Save the timestamp arrays (frame order) as ``.npz`` file.
+
+        :param str path: target file
+        """
+        numpy.savez_compressed(path, **self.ordered())
+
+
+class TimingAnalyzer(object):
+    """
+    Collects the timestamps of the messages passed to :py:meth:`observe`
+    and finishes a :py:class:`SeriesTiming` per series::
+
+      analyzer = TimingAnalyzer(on_series_end=lambda t: t.write_summary(
+          "series_{0}_timing.json".format(t.series)))
+      for message in receiver:
+          analyzer.observe(message)
+
+    :param on_series_end: callable receiving every finished
+                          :py:class:`SeriesTiming`
+    """
+
+    def __init__(self, on_series_end=None):
+        super(TimingAnalyzer, self).__init__()
+        self.on_series_end = on_series_end
+        self.current = None
+
+    def observe(self, message, arrival=None):
+        """
+        Handle a stream message.
+
+        :param message: :py:class:`SeriesHeader`, :py:class:`StreamFrame`
+                        or :py:class:`SeriesEnd`
+        :param float arrival: arrival time in seconds since the epoch, now
+                              if None
+        :returns: the finished series timing on a series end, else None
+        """
+        arrival = time.time() if arrival is None else arrival
+        if isinstance(message, SeriesHeader):
+            self.current = SeriesTiming(message.series, message.config,
+                                        arrival)
+        elif isinstance(message, StreamFrame):
+            if self.current is None or self.current.series != message.series:
+                self.current = SeriesTiming(message.series)
+            self.current.add(message, arrival)
+        elif isinstance(message, SeriesEnd):
+            timing = self.current
+            self.current = None
+            if timing is not None and self.on_series_end is not None:
+                self.on_series_end(timing)
+            return timing
+        return None
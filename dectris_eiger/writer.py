@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: writer
+   :synopsis: This module contains a writer that stores the Dectris Eiger's
+              stream in NeXus/HDF5 files like the detector's file writer.
+
+Frames are written with HDF5 direct chunk writes, i.e. the compressed blobs
+received from the stream go to disk unchanged, without a decompress and
+recompress cycle. bitshuffle/LZ4 frames are stored with the bitshuffle
+filter (32008), LZ4 frames with the LZ4 filter (32004) and uncompressed
+frames without a filter. Reading the files needs the filter plugins, e.g.
+from the ``hdf5plugin`` package; writing only needs ``h5py``.
+"""
+import os
+import struct
+import time
+
+from .compression import parse_encoding
+from .h5chunks import BSHUF_FILTER, LZ4_FILTER
+from .stream import SeriesEnd, SeriesHeader, StreamFrame
+
+try:
+    import h5py
+    import numpy
+except ImportError:
+    h5py = None
+
+
+# detector config keys stored in /entry/instrument/detector and their units,
+# all others go to /entry/instrument/detector/detectorSpecific
+DETECTOR_KEYS = {
+    "beam_center_x": "pixel",
+    "beam_center_y": "pixel",
+    "bit_depth_image": None,
+    "bit_depth_readout": None,
+    "count_time": "s",
+    "countrate_correction_applied": None,
+    "description": None,
+    "detector_distance": "m",
+    "detector_number": None,
+    "detector_readout_time": "s",
+    "efficiency_correction_applied": None,
+    "flatfield_correction_applied": None,
+    "frame_time": "s",
+    "pixel_mask_applied": None,
+    "sensor_material": None,
+    "sensor_thickness": "m",
+    "threshold_energy": "eV",
+    "virtual_pixel_correction_applied": None,
+    "x_pixel_size": "m",
+    "y_pixel_size": "m",
+}
+SPECIFIC_UNITS = {"photon_energy": "eV", "frame_count_time": "s",
+                  "frame_period": "s"}
+GONIOMETER_AXES = ("chi", "kappa", "omega", "phi", "two_theta")
+TABLE_NAMES = {"flatfield": "flatfield", "pixel_mask": "pixel_mask",
+               "countrate": "countrate_correction_table"}
+
+
+class StreamWriterError(Exception):
+    pass
+
+
+def _nx_group(parent, name, nx_class):
+    group = parent.require_group(name)
+    group.attrs["NX_class"] = nx_class
+    return group
+
+
+def _is_goniometer_key(key):
+    return any(key.startswith(axis + "_") for axis in GONIOMETER_AXES)
+
+
+def _write_value(group, name, value, units=None):
+    if value is None or "/" in name:
+        return
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    elif isinstance(value, list):
+        if not value or isinstance(value[0], (dict, list, str)):
+            return
+    elif isinstance(value, dict):
+        return
+    group[name] = value
+    if units is not None:
+        group[name].attrs["units"] = units
+
+
+class EigerStreamWriter(object):
+    """
+    Writer for the messages of a :py:class:`EigerStreamReceiver`. For every
+    series it creates the master file ``<pattern>_master.h5`` and data files
+    ``<pattern>_data_000001.h5`` etc. with *images_per_file* images each,
+    where ``$id`` in the pattern is replaced by the series id, like the
+    detector's file writer does. The master file holds the configuration of
+    the series' global header (stream ``header_detail`` "basic" or "all")
+    and external links to the data files in ``/entry/data``.
+
+    Frames are written from their raw blobs, so they are never
+    decompressed::
+
+      receiver = EigerStreamReceiver("192.168.10.42")
+      writer = EigerStreamWriter.from_filewriter(detector.filewriter,
+                                                 "/data/run1")
+      writer.write_series(receiver)
+
+    :param str target_dir: directory for the files
+    :param str filename_pattern: file naming pattern
+    :param int images_per_file: number of images per data file
+    :param metrics: records the write latency per frame
+    :type metrics: dectris_eiger.metrics.StreamMetrics
+    """
+
+    def __init__(self, target_dir, filename_pattern="series_$id",
+                 images_per_file=1000, metrics=None):
+        super(EigerStreamWriter, self).__init__()
+        if h5py is None:
+            raise StreamWriterError("The stream writer requires h5py.")
+        self.target_dir = target_dir
+        self.filename_pattern = filename_pattern
+        self.images_per_file = images_per_file
+        self.metrics = metrics
+        self.files = []
+        self.frames = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._series = None
+        self._nimages = None
+        self._master = None
+        self._data = {}
+        self._written = {}
+
+    @classmethod
+    def from_filewriter(cls, filewriter, target_dir, timeout=2.0, **kwargs):
+        """
+        Create a writer with the file naming pattern and number of images per
+        file configured in the detector's file writer.
+
+        :param filewriter: the detector's file writer interface
+        :type filewriter: dectris_eiger.filewriter.EigerFileWriter
+        :param str target_dir: directory for the files
+        :param float timeout: communication timeout in seconds
+        :returns: the writer
+        :rtype: EigerStreamWriter
+        """
+        return cls(target_dir,
+                   filewriter.get_filename_pattern(timeout=timeout),
+                   filewriter.get_images_per_file(timeout=timeout), **kwargs)
+
+    def get_throughput(self):
+        """
+        Returns the average write throughput in bytes per second.
+
+        :rtype: float
+        """
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+    throughput = property(get_throughput)
+
+    def _name(self, series):
+        return self.filename_pattern.replace("$id", str(series))
+
+    def _path(self, series, suffix):
+        return os.path.join(self.target_dir,
+                            "{0}_{1}.h5".format(self._name(series), suffix))
+
+    def _start(self, series):
+        if self._series is not None:
+            self.end_series()
+        self._series = series
+        self._nimages = None
+        path = self._path(series, "master")
+        self._master = h5py.File(path, "w")
+        self.files.append(path)
+        entry = _nx_group(self._master, "entry", "NXentry")
+        _nx_group(entry, "data", "NXdata")
+
+    def _write_header(self, header):
+        self._start(header.series)
+        config = header.config or {}
+        if "nimages" in config:
+            self._nimages = (int(config["nimages"]) *
+                             int(config.get("ntrigger", 1) or 1))
+        entry = self._master["entry"]
+        instrument = _nx_group(entry, "instrument", "NXinstrument")
+        detector = _nx_group(instrument, "detector", "NXdetector")
+        specific = detector.require_group("detectorSpecific")
+        for key, value in sorted(config.items()):
+            if key in DETECTOR_KEYS:
+                _write_value(detector, key, value, DETECTOR_KEYS[key])
+            elif not _is_goniometer_key(key):
+                _write_value(specific, key, value, SPECIFIC_UNITS.get(key))
+        if config.get("wavelength") is not None:
+            beam = _nx_group(instrument, "beam", "NXbeam")
+            _write_value(beam, "incident_wavelength", config["wavelength"],
+                         "angstrom")
+        self._write_goniometer(entry, config)
+        for name, (table_header, blob) in header.tables.items():
+            shape = tuple(reversed(table_header["shape"]))
+            table = numpy.frombuffer(blob, dtype=table_header["type"])
+            specific[TABLE_NAMES.get(name, name)] = table.reshape(shape)
+
+    def _write_goniometer(self, entry, config):
+        axes = [axis for axis in GONIOMETER_AXES
+                if config.get(axis + "_start") is not None]
+        if not axes:
+            return
+        sample = _nx_group(entry, "sample", "NXsample")
+        goniometer = _nx_group(sample, "goniometer", "NXtransformations")
+        n = self._nimages or 1
+        for axis in axes:
+            start = config[axis + "_start"]
+            increment = config.get(axis + "_increment") or 0.0
+            angles = start + increment * numpy.arange(n)
+            goniometer[axis] = angles
+            goniometer[axis].attrs["units"] = "degree"
+            goniometer[axis + "_end"] = angles + increment
+            goniometer[axis + "_range_average"] = increment
+            goniometer[axis + "_range_total"] = increment * n
+
+    def _data_file(self, number, frame):
+        dataset = self._data.get(number)
+        if dataset is not None:
+            return dataset
+        name = "data_{0:06d}".format(number)
+        path = self._path(self._series, name)
+        mode = "a" if path in self.files else "w"
+        f = h5py.File(path, mode)
+        if mode == "w":
+            self.files.append(path)
+            entry = _nx_group(f, "entry", "NXentry")
+            data = _nx_group(entry, "data", "NXdata")
+            compression, order = parse_encoding(frame.encoding)
+            kwargs = {}
+            if compression == "bslz4":
+                kwargs = dict(compression=BSHUF_FILTER,
+                              compression_opts=(0, 2))
+            elif compression == "lz4":
+                kwargs = dict(compression=LZ4_FILTER)
+            size = self.images_per_file
+            if self._nimages is not None:
+                first = (number - 1) * self.images_per_file
+                size = max(1, min(size, self._nimages - first))
+            dtype = numpy.dtype(frame.dtype).newbyteorder(order)
+            dataset = data.create_dataset(
+                "data", shape=(size,) + frame.shape,
+                maxshape=(self.images_per_file,) + frame.shape,
+                chunks=(1,) + frame.shape, dtype=dtype,
+                allow_unknown_filter=True, **kwargs)
+            dataset.attrs["image_nr_low"] = numpy.int32(
+                (number - 1) * self.images_per_file + 1)
+            self._master["entry/data/" + name] = h5py.ExternalLink(
+                os.path.basename(path), "/entry/data/data")
+            self._written[number] = set()
+        else:
+            dataset = f["entry/data/data"]
+            self._written[number] = set(range(dataset.shape[0]))
+        self._data[number] = dataset
+        return dataset
+
+    def _close_data_file(self, number):
+        dataset = self._data.pop(number)
+        written = self._written.pop(number)
+        if written:
+            size = max(written) + 1
+            if dataset.shape[0] != size:
+                dataset.resize(size, axis=0)
+            low = dataset.attrs["image_nr_low"]
+            dataset.attrs["image_nr_high"] = low + size - 1
+        dataset.file.close()
+
+    def _write_frame(self, frame):
+        if frame.series != self._series:
+            self._start(frame.series)
+        number, index = divmod(frame.frame, self.images_per_file)
+        number += 1
+        dataset = self._data_file(number, frame)
+        if index >= dataset.shape[0]:
+            dataset.resize(index + 1, axis=0)
+        blob = frame.raw
+        compression = parse_encoding(frame.encoding)[0]
+        if compression == "lz4":
+            # the HDF5 LZ4 filter expects a size header and block sizes
+            blob = bytes(blob)
+            nbytes = dataset.dtype.itemsize
+            for n in frame.shape:
+                nbytes *= n
+            blob = (struct.pack(">QI", nbytes, nbytes) +
+                    struct.pack(">I", len(blob)) + blob)
+        dataset.id.write_direct_chunk((index,) + (0,) * len(frame.shape),
+                                      blob)
+        written = self._written[number]
+        written.add(index)
+        self.frames += 1
+        self.bytes += len(blob)
+        if len(written) == dataset.shape[0]:
+            self._close_data_file(number)
+
+    def write(self, message):
+        """
+        Write a message of the stream: a :py:class:`SeriesHeader` starts a
+        series, a :py:class:`StreamFrame` goes to its data file and a
+        :py:class:`SeriesEnd` closes all files of the series.
+
+        :param message: the parsed message
+        """
+        start = time.time()
+        if isinstance(message, StreamFrame):
+            if message.raw is None:
+                raise StreamWriterError("Frame {0} has no raw data."
+                                        .format(message.frame))
+            self._write_frame(message)
+            if self.metrics is not None:
+                self.metrics.observe("write_seconds", time.time() - start)
+        elif isinstance(message, SeriesHeader):
+            self._write_header(message)
+        elif isinstance(message, SeriesEnd):
+            self.end_series()
+        self.seconds += time.time() - start
+
+    def write_series(self, messages):
+        """
+        Write messages until the end of series message and close the files.
+
+        :param messages: iterable of messages, e.g. a receiver
+        :returns: the paths of the files written for the series
+        :rtype: list
+        """
+        first = len(self.files)
+        for message in messages:
+            self.write(message)
+            if isinstance(message, SeriesEnd):
+                break
+        self.end_series()
+        return self.files[first:]
+
+    def end_series(self):
+        """
+        Close all files of the current series.
+        """
+        for number in list(self._data.keys()):
+            self._close_data_file(number)
+        if self._master is not None:
+            self._master.close()
+            self._master = None
+        self._series = None
+
+    def close(self):
+        self.end_series()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,44 +1,75 @@
-from yamtbx.dataproc import eiger
-import h5py
+from dectris_eiger.pixelmask import count_hot_pixels, dark_statistics, hot_pixel_mask
 import numpy
-import cPickle as pickle
+import pickle
 
 flag_bit = 3 # over responding
+noisy_bit = 4
+intermittent_bit = 5
 hot_threshold = 1
+max_frames = 100
 
-def run(h5in):
-  h = h5py.File(h5in, "r")
-  current_pm = h["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
-
-  hot_count = numpy.zeros(shape=current_pm.shape, dtype=numpy.uint32)
-  n_tested = 0
-  for i in xrange(100):
-    data = eiger.extract_data(h5in, i+1)
-    if data is None: break
-    hot_count[numpy.where(data >= hot_threshold)] += 1
-    n_tested += 1
-
-  for n in numpy.unique(hot_count):
-    if n == 0: continue
-    print "  %6d times (%3d pixels)" % (n, numpy.sum(hot_count==n))
-
-  rhs = numpy.zeros(shape=data.shape, dtype=current_pm.dtype)
-  rhs[hot_count>n_tested//2] = 2**flag_bit
-  print "Detected %d over-responding pixels" % numpy.sum(rhs>0)
+def run(h5ins, nproc=None):
+  # all dark series (e.g. 10 Hz and 50 Hz) are read and counted at once
+  darks = count_hot_pixels(h5ins, threshold=hot_threshold,
+                           max_frames=max_frames, workers=nproc)
+  current_pm = darks[0].pixel_mask
+
+  for dark in darks:
+    print("%s: %d frames" % (dark.master_path, dark.frames))
+    for n, pixels in dark.histogram():
+      print("  %6d times (%3d pixels)" % (n, pixels))
+
+  # hot in more than half of the frames of any series
+  rhs = hot_pixel_mask(darks, 0.5, flag_bit, current_pm.dtype)
+  print("Detected %d over-responding pixels" % numpy.sum(rhs>0))
   wh = numpy.where(rhs>0)
   for x, y in zip(wh[0], wh[1]):
-    print " %5d %4d" % (y, x)
+    print(" %5d %4d" % (y, x))
+
+  save_mask(current_pm | rhs)
+
+def run_statistics(h5ins, nproc=None):
+  # per pixel mean/variance/max of all frames, flags hot, noisy and intermittent pixels
+  stats = dark_statistics(h5ins, threshold=hot_threshold, workers=nproc)
+  current_pm = stats[0].pixel_mask
+  bits = dict(hot=flag_bit, noisy=noisy_bit, intermittent=intermittent_bit)
+
+  rhs = numpy.zeros(shape=current_pm.shape, dtype=current_pm.dtype)
+  for st in stats:
+    print("%s: %d frames" % (st.master_path, st.frames))
+    flags = st.flag_mask(bits, current_pm.dtype)
+    for name in ("hot", "noisy", "intermittent"):
+      print("  %-12s %6d pixels (bit %d)" % (name, numpy.sum(flags & 2**bits[name] > 0), bits[name]))
+    rhs |= flags
+  print("Detected %d bad pixels" % numpy.sum(rhs>0))
 
-  new_pm = current_pm | rhs
+  save_mask(current_pm | rhs)
 
-  pickle.dump(new_pm, open("pixel_mask.pkl", "w"), -1)
+def save_mask(new_pm):
+  with open("pixel_mask.pkl", "wb") as f:
+    pickle.dump(new_pm, f, -1)
+  # numpy 2 pickles can not be read by set_pixel_mask.py (python2), .npy files can
+  numpy.save("pixel_mask.npy", new_pm)
 
-  from yamtbx.dataproc import cbf
+  try:
+    from yamtbx.dataproc import cbf
+  except ImportError:
+    print("yamtbx not found, test_pixel_mask.cbf not written")
+    return
   cbf.save_numpy_data_as_cbf(new_pm.flatten(),
                                    size1=new_pm.shape[1], size2=new_pm.shape[0], title="pixel_mask",
                                    cbfout="test_pixel_mask.cbf")
 
 
 if __name__ == "__main__":
-  import sys
-  run(sys.argv[1])
+  import argparse
+  parser = argparse.ArgumentParser(description="Extend the pixel mask from dark series.")
+  parser.add_argument("h5ins", nargs="+", help="*_master.h5 files of the dark series")
+  parser.add_argument("--stats", action="store_true",
+                      help="classify by per pixel mean, variance and maximum of all frames")
+  parser.add_argument("--nproc", type=int, default=None, help="number of worker processes")
+  args = parser.parse_args()
+  if args.stats:
+    run_statistics(args.h5ins, args.nproc)
+  else:
+    run(args.h5ins, args.nproc)
@@ -10,7 +10,11 @@ eiger_host = "10.178.231.43"
 import DEigerClient
 e = DEigerClient.DEigerClient(host=eiger_host)
 
-pm = pickle.load(open("pixel_mask.pkl"))
+import os
+if os.path.exists("pixel_mask.npy"):
+  pm = numpy.load("pixel_mask.npy")
+else:
+  pm = pickle.load(open("pixel_mask.pkl"))
 
 new_conf = {
 '__darray__': (1,0,0),
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the process pool decoding stream frames into shared memory slots.
+"""
+import threading
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from dectris_eiger.decode import DecodePool
+from dectris_eiger.metrics import StreamMetrics
+from dectris_eiger.stream import StreamFrame
+
+from test_stream import SERIES, _encode
+
+
+NFRAMES = 30
+
+
+def _image(frame, shape, dtype):
+    image = numpy.arange(shape[0] * shape[1], dtype=numpy.uint64)
+    image = (image * (frame + 3)) % numpy.iinfo(dtype).max
+    return image.astype(dtype).reshape(shape)
+
+
+def _frames(count, shape=(32, 48), dtype="uint32", encoding="bs32-lz4<",
+            first=0):
+    for frame in range(first, first + count):
+        blob = _encode(_image(frame, shape, dtype), encoding)
+        yield StreamFrame(SERIES, frame, shape, dtype, encoding, blob)
+
+
+def _decode_all(pool, frames, timeout=30):
+    # a result lost with the old worker processes would block forever
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(
+        pool.decode(frames)))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "decoding did not finish"
+    return result
+
+
+@pytest.mark.parametrize("dtype,encoding", [("uint16", "bs16-lz4<"),
+                                            ("uint32", "bs32-lz4<"),
+                                            ("uint32", "lz4<"),
+                                            ("uint16", "<")])
+def test_order_and_data(dtype, encoding):
+    with DecodePool(workers=3) as pool:
+        seen = []
+        for frame in pool.decode(_frames(NFRAMES, dtype=dtype,
+                                         encoding=encoding)):
+            # without copy the data is valid until the next frame is read
+            assert frame.data.dtype == numpy.dtype(dtype)
+            numpy.testing.assert_array_equal(
+                frame.data, _image(frame.frame, (32, 48), dtype))
+            seen.append(frame.frame)
+        stats = pool.stats
+    assert seen == list(range(NFRAMES))
+    assert sum(s.frames for s in stats.values()) == NFRAMES
+    assert len(stats) <= 3
+
+
+def test_slots_reused():
+    # more frames than slots, the consumer holds one frame at a time
+    with DecodePool(workers=2, slots=2) as pool:
+        frames = pool.decode(_frames(NFRAMES))
+        for expected, frame in enumerate(frames):
+            assert frame.frame == expected
+            numpy.testing.assert_array_equal(
+                frame.data, _image(expected, (32, 48), "uint32"))
+
+
+def test_copy():
+    with DecodePool(workers=2, slots=3, copy=True) as pool:
+        frames = list(pool.decode(_frames(NFRAMES)))
+    # copied images stay valid after their slots were reused
+    for expected, frame in enumerate(frames):
+        assert frame.frame == expected
+        numpy.testing.assert_array_equal(
+            frame.data, _image(expected, (32, 48), "uint32"))
+
+
+def test_slot_resize():
+    small = ((16, 24), "uint16", "bs16-lz4<")
+    large = ((64, 96), "uint32", "bs32-lz4<")
+
+    def frames():
+        for n, (shape, dtype, encoding) in enumerate([small, large, small,
+                                                      large]):
+            for frame in _frames(5, shape, dtype, encoding, first=5 * n):
+                yield frame
+
+    kinds = [small] * 5 + [large] * 5 + [small] * 5 + [large] * 5
+    with DecodePool(workers=2, slots=3, copy=True) as pool:
+        result = _decode_all(pool, frames())
+        # the slots grow once, to the large frames
+        assert pool._slot_size == 64 * 96 * 4
+    assert [f.frame for f in result] == list(range(20))
+    for frame, (shape, dtype, encoding) in zip(result, kinds):
+        assert frame.data.shape == shape
+        numpy.testing.assert_array_equal(frame.data,
+                                         _image(frame.frame, shape, dtype))
+
+
+def test_metrics():
+    metrics = StreamMetrics()
+    with DecodePool(workers=2, slots=3, metrics=metrics) as pool:
+        assert len(list(pool.decode(_frames(10)))) == 10
+    snapshot = metrics.snapshot()
+    assert snapshot["histograms"]["decode_seconds"]["count"] == 10
+    assert 1 <= snapshot["gauges"]["queue_depth.decode"]["max"] <= 3
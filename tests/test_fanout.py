@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the stream fan-out: worker processes pull a series from a local
+replay publisher and the coordinator gathers their results.
+"""
+import socket
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pytest.importorskip("h5py")
+pytest.importorskip("zmq")
+
+from dectris_eiger.fanout import StreamCoordinator, frame_sum, start_workers
+from dectris_eiger.replay import EigerStreamReplay
+from dectris_eiger.stream import SeriesHeader, parse_message
+from dectris_eiger.writer import EigerStreamWriter
+
+from test_stream import SERIES, _image, frame_parts
+
+
+NFRAMES = 24
+WORKERS = 3
+
+
+def _free_port(pair=False):
+    # a free port, with pair=True one whose successor is free as well
+    while True:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        if not pair:
+            return port
+        with socket.socket() as s:
+            try:
+                s.bind(("127.0.0.1", port + 1))
+            except OSError:
+                continue
+        return port
+
+
+class DroppingReplay(EigerStreamReplay):
+    """
+    Replay losing some frames of every series.
+    """
+
+    def __init__(self, master_path, drop, **kwargs):
+        super(DroppingReplay, self).__init__(master_path, **kwargs)
+        self.drop = drop
+
+    def _send_frame(self, series, frame, source, index):
+        if frame not in self.drop:
+            super(DroppingReplay, self)._send_frame(series, frame, source,
+                                                    index)
+
+
+@pytest.fixture(scope="module")
+def master_path(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("series")
+    config = {"nimages": NFRAMES, "ntrigger": 1, "count_time": 0.001,
+              "frame_time": 0.001}
+    with EigerStreamWriter(str(directory), images_per_file=10) as writer:
+        writer.write(SeriesHeader(SERIES, "basic", config))
+        for frame in range(NFRAMES):
+            writer.write(parse_message(frame_parts(frame, "<")))
+    return str(directory / "series_{0}_master.h5".format(SERIES))
+
+
+def _fan_out(master_path, drop=()):
+    stream_port = _free_port()
+    coordinator_port = _free_port(pair=True)
+    workers = start_workers(WORKERS, "127.0.0.1", "127.0.0.1", frame_sum,
+                            port=stream_port,
+                            coordinator_port=coordinator_port)
+    coordinator = StreamCoordinator(coordinator_port, bind="127.0.0.1",
+                                    end_timeout=1.0)
+    try:
+        replay = DroppingReplay(master_path, drop, port=stream_port,
+                                bind="127.0.0.1", series=1)
+        with replay:
+            replay.run()
+            done = coordinator.run(series=1, timeout=30)
+    finally:
+        coordinator.stop()
+        for p in workers:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+        coordinator.close()
+    assert len(done) == 1
+    return done[0]
+
+
+def test_every_frame_once(master_path):
+    result = _fan_out(master_path)
+    assert result.series == 1
+    assert result.complete()
+    assert result.expected == NFRAMES
+    assert sorted(result.results) == list(range(NFRAMES))
+    assert result.duplicates == 0
+    assert result.missing == []
+    assert sum(result.workers.values()) == NFRAMES
+    for frame, value in result.results.items():
+        assert value == int(_image(frame).sum())
+
+
+def test_dropped_frames(master_path):
+    result = _fan_out(master_path, drop=(5, NFRAMES - 1))
+    assert not result.complete()
+    assert result.missing == [5, NFRAMES - 1]
+    assert sorted(result.results) == [i for i in range(NFRAMES)
+                                      if i not in (5, NFRAMES - 1)]
+    assert result.duplicates == 0
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the direct chunk reader of data files written by the stream
+writer.
+"""
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pytest.importorskip("h5py")
+
+from dectris_eiger.h5chunks import ChunkReader, data_files
+from dectris_eiger.hitfinder import data_file_batches
+from dectris_eiger.stream import SeriesHeader, parse_message
+from dectris_eiger.writer import EigerStreamWriter
+
+from test_stream import SERIES, _image, frame_parts
+
+
+NFRAMES = 7
+PER_FILE = 3
+
+
+@pytest.fixture(params=["<", "lz4<", "bs32-lz4<"])
+def master_path(request, tmp_path):
+    encoding = request.param
+    config = {"nimages": NFRAMES, "ntrigger": 1}
+    with EigerStreamWriter(str(tmp_path), images_per_file=PER_FILE) as writer:
+        writer.write(SeriesHeader(SERIES, "basic", config))
+        for frame in range(NFRAMES):
+            writer.write(parse_message(frame_parts(frame, encoding)))
+    return str(tmp_path / "series_{0}_master.h5".format(SERIES)), encoding
+
+
+def test_data_files(master_path):
+    path, encoding = master_path
+    files = data_files(path)
+    assert [n for _, _, n in files] == [3, 3, 1]
+    assert all(dataset == "/entry/data/data" for _, dataset, _ in files)
+
+
+def test_read_chunks(master_path):
+    path, encoding = master_path
+    frame = 0
+    for data_path, dataset, n in data_files(path):
+        reader = ChunkReader.open(data_path, dataset)
+        try:
+            # every encoding is read as stored, without the filter plugins
+            assert reader.direct
+            assert reader.encoding == encoding
+            assert len(reader) == n
+            images = reader.read_images(0, n)
+            for i in range(n):
+                numpy.testing.assert_array_equal(reader.read_image(i),
+                                                 _image(frame + i))
+                numpy.testing.assert_array_equal(images[i], _image(frame + i))
+        finally:
+            reader.close()
+        frame += n
+
+
+def test_data_file_batches(master_path):
+    path, encoding = master_path
+    batches = list(data_file_batches(path, batch_size=2))
+    assert [first for first, _ in batches] == [0, 2, 3, 5, 6]
+    images = numpy.concatenate([batch for _, batch in batches])
+    numpy.testing.assert_array_equal(
+        images, numpy.array([_image(i) for i in range(NFRAMES)]))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the hit finder on synthetic frames with known spots.
+"""
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from dectris_eiger.hitfinder import HitFinder, label_pixels
+
+
+SHAPE = (128, 160)
+NSPOTS = 20
+
+
+def _frame(dtype, value, nspots=NSPOTS):
+    rng = numpy.random.RandomState(0)
+    image = rng.poisson(1.0, SHAPE).astype(dtype)
+    # spots of 2 x 2 pixels, one per 16 x 16 tile
+    tiles = [(r, c) for r in range(SHAPE[0] // 16)
+             for c in range(SHAPE[1] // 16)]
+    for r, c in tiles[:nspots]:
+        image[16 * r + 6:16 * r + 8, 16 * c + 6:16 * c + 8] = value
+    # saturated and gap pixels are not spots
+    top = numpy.iinfo(dtype).max
+    image[-3:-1, -3:-1] = top
+    image[:, 81] = top
+    return image
+
+
+@pytest.mark.parametrize("dtype,value", [("uint8", 200),
+                                         ("uint16", 40000),
+                                         ("uint16", 200),
+                                         ("uint32", 200),
+                                         ("uint32", 3000000000),
+                                         ("int32", 200)])
+def test_score(dtype, value):
+    finder = HitFinder(workers=1)
+    assert finder.score(_frame(dtype, value)) == NSPOTS
+
+
+def test_mask():
+    image = _frame("uint16", 40000)
+    mask = numpy.zeros(SHAPE, dtype=numpy.uint32)
+    mask[:16] = 1
+    finder = HitFinder(mask=mask, workers=1)
+    # the first row of tiles holds 10 spots
+    assert finder.score(image) == NSPOTS - SHAPE[1] // 16
+
+
+def test_score_batch():
+    batch = numpy.stack([_frame("uint16", 40000, n) for n in (0, 5, 20)])
+    finder = HitFinder(workers=2)
+    try:
+        assert finder.score_batch(batch).tolist() == [0, 5, 20]
+    finally:
+        finder.close()
+
+
+def test_label_pixels():
+    cols = 10
+    # a diagonal pair, a pixel at the row's end and one at the next row's
+    # start, which are not neighbours
+    index = numpy.array([0, 11, 29, 30, 55])
+    n, labels = label_pixels(index, cols)
+    assert n == 4
+    assert labels[0] == labels[1]
+    assert len(set(labels[2:].tolist())) == 3
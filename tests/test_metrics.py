@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the per series stream metrics.
+"""
+import time
+
+import pytest
+
+from dectris_eiger.metrics import StreamMetrics
+from dectris_eiger.stream import StreamFrame
+
+
+def _frame(series, frame):
+    stamp = frame * 10 ** 7
+    return StreamFrame(series, frame, (1, 1), "uint32", "<", b"\0" * 4,
+                       start_time=stamp, stop_time=stamp)
+
+
+def _run_series(metrics, series, frames, nframes):
+    metrics.series_started(series, nframes)
+    for i, frame in enumerate(frames):
+        metrics.frame_received(_frame(series, frame), 100.0 + 0.01 * i)
+    return metrics.series_ended(series)
+
+
+def test_series_summary_is_per_series():
+    summaries = []
+    metrics = StreamMetrics(on_series_end=summaries.append)
+    first = _run_series(metrics, 1, [0, 1, 2, 3], 4)
+    second = _run_series(metrics, 2, [0, 1], 2)
+
+    assert summaries == [first, second]
+    assert first["counters"]["frames"] == 4
+    assert second["counters"]["frames"] == 2
+    assert second["histograms"]["arrival_lag_seconds"]["count"] == 2
+    assert "frames_missing" not in second["counters"]
+    # the snapshot holds the totals
+    totals = metrics.snapshot()
+    assert totals["counters"]["frames"] == 6
+    assert totals["counters"]["series"] == 2
+
+
+def test_missing_frames():
+    metrics = StreamMetrics()
+    # frame 2 dropped within the series, frames 5 to 7 at its end
+    summary = _run_series(metrics, 1, [0, 1, 3, 4], 8)
+    assert summary["counters"]["frames_missing"] == 4
+    assert summary["counters"]["frame_gaps"] == 2
+
+    # without the number of frames only the gaps can be counted
+    summary = _run_series(metrics, 2, [0, 2], None)
+    assert summary["counters"]["frames_missing"] == 1
+
+
+def test_receive_queue_depth():
+    zmq = pytest.importorskip("zmq")
+    pytest.importorskip("numpy")
+    from dectris_eiger.stream import EigerStreamReceiver
+    from test_stream import end_parts, frame_parts, header_parts
+
+    socket = zmq.Context.instance().socket(zmq.PUSH)
+    port = socket.bind_to_random_port("tcp://127.0.0.1")
+    metrics = StreamMetrics()
+    receiver = EigerStreamReceiver("127.0.0.1", port, metrics=metrics)
+    try:
+        socket.send_multipart(header_parts())
+        for frame in range(3):
+            socket.send_multipart(frame_parts(frame, "<"))
+        socket.send_multipart(end_parts())
+        # all messages are waiting before the first one is received
+        time.sleep(0.2)
+        assert receiver.receive(timeout=5) is not None
+        frames = list(receiver.frames(timeout=5))
+    finally:
+        receiver.close()
+        socket.close(linger=0)
+
+    assert len(frames) == 3
+    depth = metrics.snapshot()["gauges"]["queue_depth.receive"]
+    assert depth["max"] == 4
+    assert depth["value"] == 0
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the monitor prefetcher's recovery from failed requests.
+"""
+import socket
+import threading
+import time
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pytest.importorskip("requests")
+
+from dectris_eiger.monitor import (BLOCK, EigerMonitor, MonitorError,
+                                   MonitorPrefetcher)
+
+
+class FlakyMonitor(object):
+    """
+    Monitor whose requests fail while *failing* is set and which serves the
+    frames 0, 1, ... otherwise.
+    """
+
+    def __init__(self, failing=True, nframes=3):
+        self.failing = failing
+        self.nframes = nframes
+        self.requests = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def get_image(self, image, timeout):
+        with self._lock:
+            self.requests += 1
+            if self.failing:
+                raise MonitorError("Monitor request failed: timed out")
+            if self._next >= self.nframes:
+                return None
+            self._next += 1
+            return numpy.full((2, 3), self._next - 1, dtype=numpy.uint32)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_recovers_after_errors():
+    monitor = FlakyMonitor()
+    with MonitorPrefetcher(monitor, max_backoff=0.05) as prefetcher:
+        _wait_for(lambda: prefetcher.errors >= 3)
+        # the thread keeps retrying and get says why no frame arrives
+        assert prefetcher.running
+        assert isinstance(prefetcher.error, MonitorError)
+        with pytest.raises(MonitorError):
+            prefetcher.get(timeout=1)
+        assert prefetcher.latest is None
+
+        monitor.failing = False
+        _wait_for(lambda: prefetcher.error is None)
+        frames = [prefetcher.get(timeout=5) for _ in range(3)]
+        assert [int(f[0, 0]) for f in frames] == [0, 1, 2]
+        assert prefetcher.error is None
+        assert prefetcher.fetched == 3
+    assert not prefetcher.running
+
+
+def test_backoff():
+    monitor = FlakyMonitor()
+    with MonitorPrefetcher(monitor, max_backoff=0.2) as prefetcher:
+        time.sleep(1.0)
+        # pauses of 0.1 and 0.2 seconds, not a request per poll interval
+        assert 3 <= monitor.requests <= 8
+        assert prefetcher.errors == monitor.requests
+
+
+def test_stop_while_failing():
+    prefetcher = MonitorPrefetcher(FlakyMonitor(), max_backoff=60)
+    prefetcher.start()
+    _wait_for(lambda: prefetcher.errors >= 2)
+    start = time.time()
+    prefetcher.stop(5)
+    assert time.time() - start < 1
+    assert not prefetcher.running
+
+
+def test_block_policy():
+    monitor = FlakyMonitor(failing=False, nframes=5)
+    with MonitorPrefetcher(monitor, maxsize=2, policy=BLOCK) as prefetcher:
+        _wait_for(lambda: prefetcher.queued == 2)
+        time.sleep(0.1)
+        assert prefetcher.fetched == 2
+        assert [int(prefetcher.get(timeout=5)[0, 0])
+                for _ in range(5)] == [0, 1, 2, 3, 4]
+        assert prefetcher.dropped == 0
+
+
+def test_unreachable_monitor():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    # nothing listens on the port, every request is refused
+    monitor = EigerMonitor("127.0.0.1", port)
+    with monitor.prefetcher(max_backoff=0.05, timeout=0.5) as prefetcher:
+        _wait_for(lambda: prefetcher.errors >= 2)
+        assert prefetcher.running
+        with pytest.raises(MonitorError):
+            prefetcher.get(timeout=1)
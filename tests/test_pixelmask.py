@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the dark series statistics read from data files in worker
+processes.
+"""
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pytest.importorskip("h5py")
+
+from dectris_eiger.pixelmask import (HOT_FLAG_BIT, INTERMITTENT_FLAG_BIT,
+                                     NOISY_FLAG_BIT, count_hot_pixels,
+                                     dark_statistics, hot_pixel_mask)
+from dectris_eiger.stream import SeriesHeader, StreamFrame
+from dectris_eiger.writer import EigerStreamWriter
+
+from test_stream import SIZE, _encode
+
+
+NFRAMES = 20
+SHAPE = (SIZE[1], SIZE[0])
+GAP = 0xffffffff
+
+
+def _darks(seed):
+    rng = numpy.random.default_rng(seed)
+    images = (rng.random((NFRAMES,) + SHAPE) < 0.005).astype(numpy.uint32)
+    # always hot, noisy (high counts in a few frames), intermittent (one
+    # count in a few frames), gap pixels
+    images[:, 3, 4] = 7
+    images[::5, 5, 6] = 20
+    images[:, 7, 8] = 0
+    images[1:4, 7, 8] = 1
+    images[:, :, 20] = GAP
+    return images
+
+
+def _write_series(directory, name, number, images, mask):
+    table = ({"htype": "dpixelmask-1.0", "shape": list(SIZE),
+              "type": "uint32"}, mask.tobytes())
+    config = {"nimages": len(images), "ntrigger": 1}
+    dtype = images.dtype.name
+    encoding = "bs{0}-lz4<".format(images.dtype.itemsize * 8)
+    with EigerStreamWriter(str(directory), filename_pattern=name,
+                           images_per_file=8) as writer:
+        writer.write(SeriesHeader(number, "all", config,
+                                  {"pixel_mask": table}))
+        for i, image in enumerate(images):
+            writer.write(StreamFrame(number, i, SHAPE, dtype, encoding,
+                                     _encode(image, encoding)))
+    return str(directory / (name + "_master.h5"))
+
+
+@pytest.fixture(scope="module")
+def darks(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("darks")
+    mask = numpy.zeros(SHAPE, dtype=numpy.uint32)
+    mask[:, 20] = 1
+    series = []
+    for number, name in ((1, "dark10"), (2, "dark50")):
+        images = _darks(number)
+        series.append((_write_series(directory, name, number, images, mask),
+                       images))
+    return mask, series
+
+
+def test_count_hot_pixels(darks):
+    mask, series = darks
+    paths = [path for path, _ in series]
+    result = count_hot_pixels(paths, threshold=1, max_frames=None,
+                              workers=2, frames_per_task=3)
+    assert [dark.master_path for dark in result] == paths
+    for dark, (path, images) in zip(result, series):
+        assert dark.frames == NFRAMES
+        numpy.testing.assert_array_equal(dark.pixel_mask, mask)
+        # gap pixels are never counted
+        reference = ((images >= 1) & (images != GAP)).sum(axis=0)
+        numpy.testing.assert_array_equal(dark.counts, reference)
+
+    flags = hot_pixel_mask(result, 0.5)
+    assert list(zip(*numpy.nonzero(flags))) == [(3, 4)]
+    assert flags[3, 4] == 2 ** HOT_FLAG_BIT
+
+
+def test_dark_statistics(darks):
+    mask, series = darks
+    paths = [path for path, _ in series]
+    result = dark_statistics(paths, threshold=1, workers=2,
+                             frames_per_task=3, batch=2)
+    for stats, (path, images) in zip(result, series):
+        assert stats.master_path == path
+        assert stats.frames == NFRAMES
+        numpy.testing.assert_array_equal(stats.pixel_mask, mask)
+        valid = images != GAP
+        counts = numpy.ma.masked_array(images.astype(numpy.float64), ~valid)
+        numpy.testing.assert_array_equal(stats.count, valid.sum(axis=0))
+        numpy.testing.assert_allclose(stats.mean[valid[0]],
+                                      counts.mean(axis=0)[valid[0]],
+                                      rtol=1e-5, atol=1e-6)
+        numpy.testing.assert_allclose(stats.variance[valid[0]],
+                                      counts.var(axis=0, ddof=1)[valid[0]],
+                                      rtol=1e-4, atol=1e-5)
+
+        classes = stats.classify()
+        assert classes["hot"][3, 4] and classes["noisy"][5, 6]
+        assert classes["intermittent"][7, 8]
+        assert not classes["hot"][:, 20].any()
+        flags = stats.flag_mask()
+        assert flags[3, 4] == 2 ** HOT_FLAG_BIT
+        assert flags[5, 6] == 2 ** NOISY_FLAG_BIT
+        assert flags[7, 8] == 2 ** INTERMITTENT_FLAG_BIT
+
+
+@pytest.mark.parametrize("stats", [False, True])
+def test_prep_pixel_mask(darks, tmp_path, stats):
+    mask, series = darks
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    args = [sys.executable, os.path.join(root, "prep_pixel_mask.py")]
+    args += [path for path, _ in series] + ["--nproc", "2"]
+    if stats:
+        args.append("--stats")
+    env = dict(os.environ, PYTHONPATH=root)
+    subprocess.check_call(args, cwd=str(tmp_path), env=env,
+                          stdout=subprocess.DEVNULL)
+    with open(str(tmp_path / "pixel_mask.pkl"), "rb") as f:
+        new_mask = pickle.load(f)
+    assert new_mask.shape == SHAPE
+    numpy.testing.assert_array_equal(
+        numpy.load(str(tmp_path / "pixel_mask.npy")), new_mask)
+    # the current mask is kept, the bad pixels are added
+    numpy.testing.assert_array_equal(new_mask & mask, mask)
+    assert new_mask[3, 4] & 2 ** HOT_FLAG_BIT
+    if stats:
+        assert new_mask[5, 6] & 2 ** NOISY_FLAG_BIT
+        assert new_mask[7, 8] & 2 ** INTERMITTENT_FLAG_BIT
+
+
+def test_max_frames(darks):
+    mask, series = darks
+    dark, = count_hot_pixels(series[0][0], max_frames=10, workers=1)
+    assert dark.frames == 10
+    reference = ((series[0][1][:10] >= 1) &
+                 (series[0][1][:10] != GAP)).sum(axis=0)
+    numpy.testing.assert_array_equal(dark.counts, reference)
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16"])
+def test_high_counts(tmp_path, dtype):
+    # counts in the upper half of the type's range are valid, only its
+    # maximum marks gap pixels
+    top = numpy.iinfo(dtype).max
+    images = numpy.zeros((NFRAMES,) + SHAPE, dtype=dtype)
+    images[:, 3, 4] = top - 1
+    images[::5, 5, 6] = top // 2 + 10
+    images[:, :, 20] = top
+    path = _write_series(tmp_path, "dark", 1, images,
+                         numpy.zeros(SHAPE, dtype=numpy.uint32))
+
+    dark, = count_hot_pixels(path, max_frames=None, workers=1)
+    assert dark.counts[3, 4] == NFRAMES
+    assert dark.counts[5, 6] == NFRAMES // 5
+    assert not dark.counts[:, 20].any()
+    assert list(zip(*numpy.nonzero(hot_pixel_mask([dark])))) == [(3, 4)]
+
+    stats, = dark_statistics(path, workers=1, batch=3)
+    assert stats.count[3, 4] == NFRAMES
+    assert stats.mean[3, 4] == top - 1
+    assert stats.max[3, 4] == top - 1
+    assert stats.max[5, 6] == top // 2 + 10
+    assert stats.max[0, 0] == 0
+    assert (stats.count[:, 20] == 0).all() and (stats.max[:, 20] == -1).all()
+    classes = stats.classify()
+    assert classes["hot"][3, 4]
+    assert classes["noisy"][5, 6]
+    assert not classes["hot"][:, 20].any()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the shared memory frame ring with consumers in this and in other
+processes.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+import textwrap
+import time
+from types import SimpleNamespace
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from dectris_eiger.ring import BLOCK, FrameRing, RingError
+
+
+SHAPE = (16, 24)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _frame(frame, dtype="uint16"):
+    data = numpy.full(SHAPE, frame, dtype=dtype)
+    return SimpleNamespace(series=1, frame=frame, data=data, start_time=frame,
+                           stop_time=frame + 1, real_time=1)
+
+
+def _ring(**kwargs):
+    return FrameRing.create(SHAPE[0] * SHAPE[1] * 4, **kwargs)
+
+
+def test_put_get():
+    with _ring(slots=4) as ring:
+        reader = ring.consumer(start="oldest")
+        for frame in range(3):
+            assert ring.put(_frame(frame))
+        frames = [reader.get(timeout=1) for _ in range(3)]
+        assert [f.frame for f in frames] == [0, 1, 2]
+        for f in frames:
+            assert f.valid()
+            assert f.data.dtype == numpy.uint16
+            numpy.testing.assert_array_equal(f.data, f.frame)
+        assert reader.get(timeout=0.01) is None
+        del frames, f
+
+
+def test_overruns():
+    with _ring(slots=4) as ring:
+        reader = ring.consumer()
+        for frame in range(10):
+            ring.put(_frame(frame))
+        first = reader.get(timeout=1)
+        assert first.frame == 7
+        assert reader.overruns == 7
+        del first
+
+
+def test_block_timeout():
+    with _ring(slots=4, policy=BLOCK) as ring:
+        reader = ring.consumer()
+        written = [ring.put(_frame(frame), timeout=0.05) for frame in range(5)]
+        assert written == [True, True, True, False, False]
+        assert ring.stats["dropped"] == 2
+        assert reader.get(timeout=1).frame == 0
+        assert ring.put(_frame(5), timeout=0.05)
+
+
+def test_consumers_in_use():
+    with _ring(max_consumers=2) as ring:
+        readers = [ring.consumer(), ring.consumer()]
+        with pytest.raises(RingError):
+            ring.consumer()
+        readers[0].close()
+        assert ring.consumer().index == 0
+
+
+def _attach_and_exit(name):
+    FrameRing.attach(name).consumer()
+    # exits without closing the consumer
+    os._exit(0)
+
+
+@pytest.mark.parametrize("join", [True, False])
+def test_dead_consumer(join):
+    context = multiprocessing.get_context("fork")
+    with _ring(slots=4, policy=BLOCK, max_consumers=1) as ring:
+        process = context.Process(target=_attach_and_exit, args=(ring.name,))
+        process.start()
+        # without join the exited consumer process is a zombie
+        if join:
+            process.join()
+        else:
+            while not ring.stats["consumers"]:
+                time.sleep(0.01)
+            time.sleep(0.1)
+        start = time.time()
+        written = [ring.put(_frame(frame), timeout=5) for frame in range(8)]
+        assert all(written)
+        assert time.time() - start < 2
+        assert ring.stats["consumers"] == {}
+        # the dead consumer's index is free again
+        assert ring.consumer().index == 0
+        process.join()
+
+
+SCRIPT = textwrap.dedent("""
+    import multiprocessing
+    import sys
+    from types import SimpleNamespace
+
+    import numpy
+
+    from dectris_eiger.ring import BLOCK, FrameRing
+
+    NFRAMES = 20
+
+
+    def consume(name, index, queue):
+        ring = FrameRing.attach(name)
+        reader = ring.consumer(index, start="oldest")
+        queue.put(index)
+        frames = []
+        for _ in range(NFRAMES):
+            frame = reader.get(timeout=10)
+            frames.append((frame.frame, int(frame.data.sum())))
+            del frame
+        reader.close()
+        ring.close()
+        queue.put(frames)
+
+
+    if __name__ == "__main__":
+        ring = FrameRing.create(16 * 24 * 2, slots=4, policy=BLOCK)
+        processes = []
+        queue = multiprocessing.get_context("spawn").Queue()
+        for index, method in enumerate(sys.argv[1:]):
+            context = multiprocessing.get_context(method)
+            process = context.Process(target=consume,
+                                      args=(ring.name, index, queue))
+            process.start()
+            processes.append(process)
+        for _ in processes:
+            queue.get(timeout=30)
+        for n in range(NFRAMES):
+            data = numpy.full((16, 24), n, dtype=numpy.uint16)
+            assert ring.put(SimpleNamespace(series=1, frame=n, data=data),
+                            timeout=10)
+        results = [queue.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+        ring.close()
+        expected = [(n, n * 16 * 24) for n in range(NFRAMES)]
+        assert results == [expected] * len(processes), results
+        print("ok")
+""")
+
+
+@pytest.mark.parametrize("methods", [["fork", "fork"], ["spawn", "fork"]])
+def test_consumer_processes(tmp_path, methods):
+    script = tmp_path / "ring_consumers.py"
+    script.write_text(SCRIPT)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    # the resource tracker of the script's processes reports to its stderr
+    result = subprocess.run([sys.executable, str(script)] + methods,
+                            capture_output=True, text=True, timeout=60,
+                            env=env)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "ok"
+    assert "Traceback" not in result.stderr, result.stderr
+    assert "leaked" not in result.stderr, result.stderr
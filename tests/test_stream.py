@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the stream message parser and receiver against a local ZeroMQ
+PUSH socket standing in for the detector.
+"""
+import json
+import struct
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+zmq = pytest.importorskip("zmq")
+
+from dectris_eiger.stream import (EigerStreamReceiver, SeriesEnd,
+                                  SeriesHeader, StreamError, StreamFrame,
+                                  parse_message)
+
+
+SERIES = 7
+# detector shape (x, y), i.e. numpy shape (y, x)
+SIZE = (48, 32)
+BLOCK_BYTES = 8192
+
+
+def _json(message):
+    return json.dumps(message).encode("utf-8")
+
+
+def _image(frame, dtype="uint32"):
+    image = numpy.arange(SIZE[0] * SIZE[1], dtype=dtype).reshape(SIZE[1],
+                                                                  SIZE[0])
+    return (image * (frame + 1)) % 1000
+
+
+def _encode(image, encoding, block_bytes=BLOCK_BYTES):
+    if encoding == "<":
+        return image.tobytes()
+    if encoding == "lz4<":
+        lz4_block = pytest.importorskip("lz4.block")
+        return lz4_block.compress(image.tobytes(), store_size=False)
+    bitshuffle = pytest.importorskip("bitshuffle")
+    block = block_bytes // image.dtype.itemsize
+    body = bitshuffle.compress_lz4(image, block)
+    # uncompressed size (uint64) and block size in bytes (uint32), big endian
+    return struct.pack(">QI", image.nbytes, block_bytes) + body.tobytes()
+
+
+def header_parts(detail="basic"):
+    parts = [_json({"htype": "dheader-1.0", "series": SERIES,
+                    "header_detail": detail})]
+    if detail in ("basic", "all"):
+        parts.append(_json({"count_time": 0.1, "nimages": 3}))
+    if detail == "all":
+        mask = numpy.zeros((SIZE[1], SIZE[0]), dtype=numpy.uint32)
+        parts.append(_json({"htype": "dpixelmask-1.0", "shape": list(SIZE),
+                            "type": "uint32"}))
+        parts.append(mask.tobytes())
+    return parts
+
+
+def frame_parts(frame, encoding, dtype="uint32"):
+    image = _image(frame, dtype)
+    blob = _encode(image, encoding)
+    return [_json({"htype": "dimage-1.0", "series": SERIES, "frame": frame,
+                   "hash": ""}),
+            _json({"htype": "dimage_d-1.0", "shape": list(SIZE),
+                   "type": dtype, "encoding": encoding, "size": len(blob)}),
+            blob,
+            _json({"htype": "dconfig-1.0", "start_time": 100 * frame,
+                   "stop_time": 100 * frame + 50, "real_time": 50})]
+
+
+def end_parts():
+    return [_json({"htype": "dseries_end-1.0", "series": SERIES})]
+
+
+@pytest.fixture
+def publisher():
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.PUSH)
+    port = socket.bind_to_random_port("tcp://127.0.0.1")
+    yield socket, port
+    socket.close(linger=0)
+
+
+def test_parse_header():
+    message = parse_message(header_parts("all"))
+    assert isinstance(message, SeriesHeader)
+    assert message.series == SERIES
+    assert message.header_detail == "all"
+    assert message.config == {"count_time": 0.1, "nimages": 3}
+    table_header, data = message.tables["pixel_mask"]
+    assert table_header["htype"] == "dpixelmask-1.0"
+    assert len(data) == SIZE[0] * SIZE[1] * 4
+
+    message = parse_message(header_parts("none"))
+    assert message.config is None and message.tables == {}
+
+
+def test_parse_frame():
+    message = parse_message(frame_parts(2, "<"))
+    assert isinstance(message, StreamFrame)
+    assert (message.series, message.frame) == (SERIES, 2)
+    assert message.shape == (SIZE[1], SIZE[0])
+    assert message.encoding == "<"
+    assert (message.start_time, message.stop_time,
+            message.real_time) == (200, 250, 50)
+    # only the headers are parsed on receipt
+    assert not message.decoded
+    numpy.testing.assert_array_equal(message.data, _image(2))
+    assert message.decoded
+
+
+@pytest.mark.parametrize("block_bytes", [1024, 4096, 65536])
+def test_parse_bslz4_block_size(block_bytes):
+    parts = frame_parts(1, "bs32-lz4<")
+    image = _image(1)
+    parts[2] = _encode(image, "bs32-lz4<", block_bytes)
+    size, block = struct.unpack(">QI", parts[2][:12])
+    assert (size, block) == (image.nbytes, block_bytes)
+    # the block size is taken from the blob's 12 byte header
+    numpy.testing.assert_array_equal(parse_message(parts).data, image)
+
+
+def test_parse_end():
+    message = parse_message(end_parts())
+    assert isinstance(message, SeriesEnd)
+    assert message.series == SERIES
+
+
+def test_parse_unknown():
+    with pytest.raises(StreamError):
+        parse_message([_json({"htype": "dunknown-1.0"})])
+
+
+@pytest.mark.parametrize("encoding,dtype", [("<", "uint32"),
+                                            ("lz4<", "uint32"),
+                                            ("bs32-lz4<", "uint32"),
+                                            ("bs16-lz4<", "uint16")])
+def test_receiver(publisher, encoding, dtype):
+    socket, port = publisher
+    receiver = EigerStreamReceiver("127.0.0.1", port, decode=True)
+    try:
+        socket.send_multipart(header_parts())
+        for frame in range(3):
+            socket.send_multipart(frame_parts(frame, encoding, dtype))
+        socket.send_multipart(end_parts())
+
+        header = receiver.receive(timeout=5)
+        assert isinstance(header, SeriesHeader)
+        assert header.config["nimages"] == 3
+        frames = list(receiver.frames(timeout=5))
+    finally:
+        receiver.close()
+
+    assert [f.frame for f in frames] == [0, 1, 2]
+    for frame in frames:
+        assert frame.series == SERIES
+        assert frame.decoded
+        assert frame.data.shape == (SIZE[1], SIZE[0])
+        assert frame.data.dtype == numpy.dtype(dtype)
+        numpy.testing.assert_array_equal(frame.data,
+                                         _image(frame.frame, dtype))
+
+
+def test_receiver_timeout(publisher):
+    socket, port = publisher
+    with EigerStreamReceiver("127.0.0.1", port) as receiver:
+        assert receiver.receive(timeout=0.05) is None